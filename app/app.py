@@ -1,6 +1,6 @@
-from flask import Flask, render_template, request, session, redirect, url_for, flash, send_file, send_from_directory
+from flask import Flask, render_template, request, session, redirect, url_for, flash, send_file, send_from_directory, jsonify
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
 import math
 import os
 import pandas as pd
@@ -8,19 +8,38 @@ import tempfile
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.styles import ParagraphStyle
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.lib.enums import TA_CENTER
 from reportlab.lib.units import inch
+import atexit
+import bisect
+import csv
 import io
+import json
+import mimetypes
+import queue
+import re
+import shutil
+import threading
+import time
+from collections import deque
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from urllib.parse import quote, urlsplit
+import urllib3
 from minio import Minio
+from minio.commonconfig import CopySource
+from minio.deleteobjects import DeleteObject
 from minio.error import S3Error
+import gzip
 import hashlib
-import uuid
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
 from zoneinfo import ZoneInfo
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import URL
 import xlsxwriter
 import bcrypt
 from psycopg2 import errors
@@ -31,25 +50,61 @@ MINIO_ACCESS_KEY = os.getenv("MINIO_ACCESS_KEY", "minioadmin")
 MINIO_SECRET_KEY = os.getenv("MINIO_SECRET_KEY", "minioadmin")
 MINIO_BUCKET_NAME = "farmers-markets"
 
+# Регион задан явно — presigned-ссылки и первые запросы не ходят за GetBucketLocation
+MINIO_REGION = os.getenv("MINIO_REGION", "us-east-1")
+MINIO_POOL_SIZE = int(os.getenv("MINIO_POOL_SIZE", "16"))
+MINIO_CONNECT_TIMEOUT = float(os.getenv("MINIO_CONNECT_TIMEOUT", "5"))
+MINIO_READ_TIMEOUT = float(os.getenv("MINIO_READ_TIMEOUT", "60"))
+
 minio_client = None
+minio_client_pid = None
+minio_lock = threading.Lock()
+
+def build_minio_http_client():
+    """Пул keep-alive соединений к MinIO: хватает на параллельные части и фоновые потоки."""
+    return urllib3.PoolManager(
+        num_pools=4,
+        maxsize=MINIO_POOL_SIZE,
+        timeout=urllib3.Timeout(connect=MINIO_CONNECT_TIMEOUT, read=MINIO_READ_TIMEOUT),
+        retries=urllib3.Retry(total=3, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504])
+    )
 
 def get_minio_client():
-    global minio_client
-    if minio_client is None:
-        minio_client = Minio(
-            os.getenv("MINIO_ENDPOINT", "localhost:9000"),
-            access_key=os.getenv("MINIO_ACCESS_KEY", "minioadmin"),
-            secret_key=os.getenv("MINIO_SECRET_KEY", "minioadmin"),
-            secure=False
-        )
-        try:
-            if not minio_client.bucket_exists(MINIO_BUCKET_NAME):
-                minio_client.make_bucket(MINIO_BUCKET_NAME)
-        except S3Error as e:
-            if e.code != "BucketAlreadyOwnedByYou":
-                raise
+    """
+    Клиент MinIO текущего процесса. Создаётся один раз на воркер (после fork — заново)
+    вместе с проверкой бакета; обычно это делает init_worker() ещё до первого запроса.
+    """
+    global minio_client, minio_client_pid
+    if minio_client is not None and minio_client_pid == os.getpid():
+        return minio_client
+
+    with minio_lock:
+        if minio_client is None or minio_client_pid != os.getpid():
+            client = Minio(
+                MINIO_ENDPOINT,
+                access_key=MINIO_ACCESS_KEY,
+                secret_key=MINIO_SECRET_KEY,
+                secure=False,
+                region=MINIO_REGION,
+                http_client=build_minio_http_client()
+            )
+            try:
+                if not client.bucket_exists(MINIO_BUCKET_NAME):
+                    client.make_bucket(MINIO_BUCKET_NAME)
+            except S3Error as e:
+                if e.code != "BucketAlreadyOwnedByYou":
+                    raise
+            minio_client, minio_client_pid = client, os.getpid()
     return minio_client
 
+def _reset_minio_after_fork():
+    # Пул соединений родителя воркеру не достаётся: клиент создаётся заново
+    global minio_client, minio_client_pid, minio_lock
+    minio_client, minio_client_pid = None, None
+    minio_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_minio_after_fork)
+
 app = Flask(__name__)
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "k3Vz8fGq2XpL9mNwR4sT7yUoI1aB5cD6eF0hJ2nM4qP7rS9tW")
 
@@ -60,22 +115,207 @@ DB_USER = os.getenv("DB_USER", "postgres")
 DB_PORT = os.getenv("DB_PORT", "5432")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "135Qr680!")
 
+# Настройки общего пула соединений
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# Сколько строк за раз забирает серверный курсор при потоковом чтении
+DB_STREAM_ITERSIZE = int(os.getenv("DB_STREAM_ITERSIZE", "2000"))
+
+engine = None
+
+def _reset_cursor_factory(dbapi_connection, connection_record):
+    # Соединение возвращается в пул — убираем RealDictCursor,
+    # чтобы SQLAlchemy получал обычные курсоры
+    dbapi_connection.cursor_factory = psycopg2.extensions.cursor
+
+def get_engine():
+    """
+    Возвращает общий для процесса движок SQLAlchemy.
+    Через его пул работают и экспорт, и все маршруты на psycopg2.
+    """
+    global engine
+    if engine is None:
+        engine = create_engine(
+            URL.create(
+                "postgresql+psycopg2",
+                username=DB_USER,
+                password=DB_PASSWORD,
+                host=DB_HOST,
+                port=int(DB_PORT),
+                database=DB_NAME
+            ),
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_recycle=DB_POOL_RECYCLE,
+            pool_pre_ping=True
+        )
+        event.listen(engine, "checkin", _reset_cursor_factory)
+    return engine
+
+def _dispose_engine_after_fork():
+    # Дочерний процесс (воркер gunicorn) не должен использовать сокеты родителя
+    if engine is not None:
+        engine.dispose(close=False)
+
+os.register_at_fork(after_in_child=_dispose_engine_after_fork)
+
 def get_db_connection():
+    """
+    Берёт соединение из общего пула. conn.close() возвращает его в пул.
+    """
     try:
-        return psycopg2.connect(
-            host=DB_HOST,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            cursor_factory=RealDictCursor
-        )
+        conn = get_engine().raw_connection()
+        conn.driver_connection.cursor_factory = RealDictCursor
+        return conn
     except Exception as e:
         print(f"Ошибка подключения к БД: {e}")
         return None
 
-def save_file_to_minio_and_log(file_path, original_filename, operation_type, user_ip):
+def record_file_reference(cur, original_filename, hashed_name, operation_type, user_ip, content_key=None, size=None):
+    """
+    Добавляет строку file_logs и увеличивает счётчик ссылок на объект в file_objects.
+    Пока ref_count > 0, сборщик мусора объект не тронет; обновлённый last_referenced_at
+    не даёт перенести его в холодный префикс.
+    Возвращает {'cold_key': ключ холодной копии или None, 'log_key': (created_at, id) строки file_logs}.
+    """
+    ext = os.path.splitext(original_filename)[1].lower()
+    cur.execute("""
+        INSERT INTO file_objects (hashed_filename, size_bytes, ref_count)
+        VALUES (%s, %s, 1)
+        ON CONFLICT (hashed_filename) DO UPDATE
+        SET ref_count = file_objects.ref_count + 1,
+            size_bytes = COALESCE(file_objects.size_bytes, EXCLUDED.size_bytes),
+            last_referenced_at = now()
+        RETURNING cold_key
+    """, (hashed_name, size))
+    row = cur.fetchone()
+    cur.execute("""
+        INSERT INTO file_logs (
+            original_filename, hashed_filename, operation_type,
+            file_extension, user_ip, content_key
+        ) VALUES (%s, %s, %s, %s, %s, %s)
+        RETURNING created_at, id
+    """, (original_filename, hashed_name, operation_type, ext, user_ip, content_key))
+    log_row = cur.fetchone()
+    return {'cold_key': row['cold_key'] if row else None,
+            'log_key': (log_row.get('created_at'), log_row.get('id')) if log_row else None}
+
+def release_file_reference(cur, hashed_name, log_key):
+    """Отменяет record_file_reference: файл так и не удалось сохранить."""
+    if log_key:
+        cur.execute("DELETE FROM file_logs WHERE (created_at, id) = (%s, %s)", log_key)
+    cur.execute("""
+        UPDATE file_objects SET ref_count = ref_count - 1
+        WHERE hashed_filename = %s
+    """, (hashed_name,))
+
+def run_in_transaction(func):
+    """Выполняет func(cur) в отдельной транзакции на соединении из пула и возвращает результат."""
+    conn = get_db_connection()
+    if not conn:
+        raise Exception("Нет подключения к БД для логирования")
+    try:
+        with conn.cursor() as cur:
+            result = func(cur)
+        conn.commit()
+        return result
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def log_file_operation(original_filename, hashed_name, operation_type, user_ip, content_key=None):
+    """
+    Записывает операцию с уже сохранённым в MinIO файлом в file_logs.
+    content_key — необязательный ключ содержимого (например, вариант выгрузки).
+    """
+    conn = get_db_connection()
+    if not conn:
+        raise Exception("Нет подключения к БД для логирования")
+
+    try:
+        with conn.cursor() as cur:
+            record_file_reference(cur, original_filename, hashed_name, operation_type, user_ip, content_key)
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+# Крупные объекты грузятся multipart-частями этого размера, несколько частей параллельно
+MINIO_PART_SIZE = int(os.getenv("MINIO_PART_SIZE", str(16 * 1024 * 1024)))
+MINIO_PARALLEL_UPLOADS = int(os.getenv("MINIO_PARALLEL_UPLOADS", "4"))
+
+def upload_to_minio(object_name, source, length=None, content_type='application/octet-stream'):
+    """
+    Загружает в MinIO путь к файлу, байты или поток.
+    Байты и потоки отправляются напрямую, без промежуточного файла на диске.
+    """
+    client = get_minio_client()
+    options = {
+        'content_type': content_type,
+        'part_size': MINIO_PART_SIZE,
+        'num_parallel_uploads': MINIO_PARALLEL_UPLOADS
+    }
+    if isinstance(source, (str, os.PathLike)):
+        client.fput_object(MINIO_BUCKET_NAME, object_name, source, **options)
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        client.put_object(MINIO_BUCKET_NAME, object_name, io.BytesIO(source), len(source), **options)
+    else:
+        client.put_object(MINIO_BUCKET_NAME, object_name, source,
+                          length if length is not None else -1, **options)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def hash_source(source, length=None):
+    """
+    Считает SHA-256 содержимого, читая его порциями.
+    Возвращает (hexdigest, размер, источник для загрузки). Поток без seek()
+    по ходу чтения копируется во временный файл — его и нужно загружать.
+    """
+    digest = hashlib.sha256()
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        digest.update(source)
+        return digest.hexdigest(), len(source), source
+
+    if isinstance(source, (str, os.PathLike)):
+        size = 0
+        with open(source, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+                size += len(chunk)
+        return digest.hexdigest(), size, source
+
+    seekable = hasattr(source, 'seekable') and source.seekable()
+    target = source if seekable else tempfile.SpooledTemporaryFile(max_size=MINIO_PART_SIZE)
+    start = source.tell() if seekable else 0
+    size = 0
+    for chunk in iter(lambda: source.read(HASH_CHUNK_SIZE), b''):
+        digest.update(chunk)
+        size += len(chunk)
+        if not seekable:
+            target.write(chunk)
+    target.seek(start)
+    return digest.hexdigest(), size, target
+
+def minio_object_exists(object_name):
+    try:
+        get_minio_client().stat_object(MINIO_BUCKET_NAME, object_name)
+        return True
+    except S3Error as e:
+        if e.code in ("NoSuchKey", "NoSuchObject", "ResourceNotFound"):
+            return False
+        raise
+
+def save_file_to_minio_and_log(source, original_filename, operation_type, user_ip, content_key=None, length=None):
     """
     Сохраняет файл в MinIO и записывает метаданные в БД.
+    source — путь к файлу, байты или поток с read() (для потока желательно передать length).
+    Объект называется по SHA-256 содержимого: одинаковые файлы хранятся один раз,
+    а строки file_logs ссылаются на общий объект.
     Возвращает hashed_filename.
     """
     # Определяем расширение
@@ -83,38 +323,457 @@ def save_file_to_minio_and_log(file_path, original_filename, operation_type, use
     if not ext:
         raise ValueError("Файл должен иметь расширение")
 
-    # Генерируем хеш: UUID + timestamp + IP → SHA256
-    hash_input = f"{uuid.uuid4()}-{datetime.utcnow().isoformat()}-{user_ip}"
-    hashed_name = hashlib.sha256(hash_input.encode()).hexdigest() + ext
+    # Имя объекта — хеш содержимого
+    digest, size, upload_source = hash_source(source, length)
+    hashed_name = digest + ext
+    content_type = mimetypes.guess_type(original_filename)[0] or 'application/octet-stream'
+
+    # 1. Ссылка фиксируется короткой транзакцией; загрузка идёт уже без транзакции и блокировок,
+    #    поэтому медленный MinIO не держит соединение из пула и не блокирует других писателей
+    try:
+        reference = run_in_transaction(lambda cur: record_file_reference(
+            cur, original_filename, hashed_name, operation_type, user_ip, content_key, size))
+    except Exception:
+        if upload_source is not source:
+            upload_source.close()
+        raise
+    cold_key = reference['cold_key']
+
+    # 2. Загружаем только отсутствующий объект. Если объект в холодном префиксе, горячая копия
+    #    может удаляться переносом прямо сейчас — её наличию верить нельзя, загружаем заново
+    try:
+        if cold_key or not minio_object_exists(hashed_name):
+            upload_to_minio(hashed_name, upload_source, size, content_type)
+    except Exception as e:
+        # Файл не сохранён — ссылка снимается, объект без ссылок уберёт сборщик мусора
+        run_in_transaction(lambda cur: release_file_reference(cur, hashed_name, reference['log_key']))
+        if isinstance(e, S3Error):
+            raise Exception(f"Ошибка MinIO: {e}")
+        raise
+    finally:
+        if upload_source is not source:
+            upload_source.close()
+
+    # 3. Файл снова нужен: основной объект опять в горячем хранилище, холодная копия лишняя
+    if cold_key:
+        forget_cold_copy(hashed_name, cold_key)
+
+    return hashed_name
+
+def forget_cold_copy(hashed_name, cold_key):
+    """Горячая копия снова на месте: снимает cold_key и удаляет холодную копию."""
+    run_in_transaction(lambda cur: cur.execute("""
+        UPDATE file_objects SET cold_key = NULL, stored_bytes = NULL
+        WHERE hashed_filename = %s AND cold_key = %s
+    """, (hashed_name, cold_key)))
+    try:
+        get_minio_client().remove_object(MINIO_BUCKET_NAME, cold_key)
+    except S3Error as e:
+        print(f"Не удалось удалить холодную копию {cold_key}: {e}")
 
-    # Загружаем в MinIO
+def restore_cold_object(hashed_name):
+    """
+    Возвращает объект из холодного префикса в горячее хранилище (распаковывая gzip) и снимает cold_key.
+    Сначала сдвигает last_referenced_at: идущий в это время перенос увидит обращение
+    и не удалит восстановленную копию. Возвращает False, если объект и так горячий.
+    """
+    def touch(cur):
+        cur.execute("""
+            UPDATE file_objects SET last_referenced_at = now()
+            WHERE hashed_filename = %s AND cold_key IS NOT NULL
+            RETURNING cold_key
+        """, (hashed_name,))
+        row = cur.fetchone()
+        return row['cold_key'] if row else None
+
+    def current_cold_key(cur):
+        cur.execute("SELECT cold_key FROM file_objects WHERE hashed_filename = %s", (hashed_name,))
+        row = cur.fetchone()
+        return row['cold_key'] if row else None
+
+    cold_key = run_in_transaction(touch)
+    if not cold_key:
+        return False
+
+    client = get_minio_client()
     try:
-        client = get_minio_client()
-        client.fput_object(MINIO_BUCKET_NAME, hashed_name, file_path)
+        response = client.get_object(MINIO_BUCKET_NAME, cold_key)
     except S3Error as e:
-        raise Exception(f"Ошибка MinIO: {e}")
+        # Перенос отменили или объект уже восстановил параллельный запрос — горячая копия на месте
+        if e.code in ("NoSuchKey", "NoSuchObject", "ResourceNotFound") \
+                and run_in_transaction(current_cold_key) != cold_key:
+            return False
+        raise
+    try:
+        with tempfile.SpooledTemporaryFile(max_size=MINIO_PART_SIZE) as buffer:
+            gzipped = cold_key == COLD_PREFIX + hashed_name + '.gz'
+            source = gzip.GzipFile(fileobj=response, mode='rb') if gzipped else response
+            shutil.copyfileobj(source, buffer, HASH_CHUNK_SIZE)
+            size = buffer.tell()
+            buffer.seek(0)
+            upload_to_minio(hashed_name, buffer, size,
+                            mimetypes.guess_type(hashed_name)[0] or 'application/octet-stream')
+    finally:
+        response.close()
+        response.release_conn()
+
+    forget_cold_copy(hashed_name, cold_key)
+    return True
+
+# Сборка мусора: объекты без ссылок удаляются не раньше, чем через FILE_GC_GRACE_HOURS
+FILE_GC_GRACE_HOURS = int(os.getenv("FILE_GC_GRACE_HOURS", "24"))
+FILE_GC_BATCH_SIZE = int(os.getenv("FILE_GC_BATCH_SIZE", "500"))
+
+def collect_unreferenced_objects(batch_size=FILE_GC_BATCH_SIZE):
+    """
+    Удаляет из MinIO объекты, на которые больше не ссылается ни одна строка file_logs.
+    Работает пачками; строка удаляется в той же транзакции, что и объект.
+    Возвращает {'objects': ..., 'bytes': ...}.
+    """
+    removed = {'objects': 0, 'bytes': 0}
+    while True:
+        conn = get_db_connection()
+        if not conn:
+            raise Exception("Ошибка подключения к БД")
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    DELETE FROM file_objects
+                    WHERE hashed_filename IN (
+                        SELECT hashed_filename FROM file_objects
+                        WHERE ref_count <= 0
+                          AND last_referenced_at < now() - make_interval(hours => %s)
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    AND ref_count <= 0
+                    RETURNING hashed_filename, size_bytes, cold_key, stored_bytes
+                """, (FILE_GC_GRACE_HOURS, batch_size))
+                rows = cur.fetchall()
+                if not rows:
+                    conn.commit()
+                    return removed
+
+                # При записанном cold_key горячая копия тоже может остаться (перенос не смог её удалить) —
+                # удаляются оба ключа
+                delete_errors = list(get_minio_client().remove_objects(
+                    MINIO_BUCKET_NAME,
+                    [DeleteObject(key) for r in rows for key in (r['hashed_filename'], r['cold_key']) if key]
+                ))
+                if delete_errors:
+                    raise Exception(f"Ошибка MinIO при удалении: {delete_errors[0]}")
+                conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        removed['objects'] += len(rows)
+        removed['bytes'] += sum(r['stored_bytes'] or r['size_bytes'] or 0 for r in rows)
+        if len(rows) < batch_size:
+            return removed
+
+# Политика хранения по operation_type: через сколько дней без обращений файл переносится
+# в холодный префикс (cold_days) и через сколько дней удаляются строки file_logs (expire_days).
+# None — никогда. Переопределяется JSON-ом в FILE_RETENTION_POLICY.
+DEFAULT_RETENTION_POLICY = {
+    'import': {'cold_days': 30, 'expire_days': None},
+    'export': {'cold_days': 7, 'expire_days': 90},
+    'export_prebuilt': {'cold_days': None, 'expire_days': 7},
+    'pdf_export': {'cold_days': None, 'expire_days': 30},
+    'pdf_batch_export': {'cold_days': None, 'expire_days': 14},
+    'download': {'cold_days': None, 'expire_days': 90}
+}
+RETENTION_POLICY = {**DEFAULT_RETENTION_POLICY, **json.loads(os.getenv("FILE_RETENTION_POLICY", "{}"))}
+FILE_RETENTION_HOUR = int(os.getenv("FILE_RETENTION_HOUR", "3"))
+FILE_RETENTION_BATCH_SIZE = int(os.getenv("FILE_RETENTION_BATCH_SIZE", "1000"))
+COLD_PREFIX = os.getenv("MINIO_COLD_PREFIX", "cold/")
+# Эти форматы уже сжаты — в холодный префикс они копируются без gzip
+COMPRESSED_EXTENSIONS = {'.xlsx', '.zip', '.pdf', '.gz', '.png', '.jpg', '.jpeg'}
+
+def expire_file_logs(cur, operation_type, days, batch_size):
+    """
+    Удаляет одну пачку строк file_logs старше days дней и уменьшает счётчики ссылок.
+    Возвращает число удалённых строк.
+    """
+    cur.execute("""
+        WITH deleted AS (
+            DELETE FROM file_logs
+            WHERE (created_at, id) IN (
+                SELECT created_at, id FROM file_logs
+                WHERE operation_type = %s
+                  AND created_at < now() - make_interval(days => %s)
+                LIMIT %s
+            )
+            RETURNING hashed_filename
+        ), released AS (
+            UPDATE file_objects o
+            SET ref_count = o.ref_count - d.n
+            FROM (SELECT hashed_filename, COUNT(*) AS n FROM deleted GROUP BY hashed_filename) d
+            WHERE o.hashed_filename = d.hashed_filename
+        )
+        SELECT COUNT(*) AS deleted FROM deleted
+    """, (operation_type, days, batch_size))
+    return cur.fetchone()['deleted']
+
+def move_object_to_cold(client, hashed_name):
+    """
+    Копирует объект в COLD_PREFIX (со сжатием gzip, если формат ещё не сжат).
+    Возвращает (cold_key, stored_bytes). Исходный объект не удаляется.
+    """
+    if os.path.splitext(hashed_name)[1] in COMPRESSED_EXTENSIONS:
+        cold_key = COLD_PREFIX + hashed_name
+        client.copy_object(MINIO_BUCKET_NAME, cold_key, CopySource(MINIO_BUCKET_NAME, hashed_name))
+        return cold_key, client.stat_object(MINIO_BUCKET_NAME, cold_key).size
+
+    cold_key = COLD_PREFIX + hashed_name + '.gz'
+    response = client.get_object(MINIO_BUCKET_NAME, hashed_name)
+    try:
+        with tempfile.SpooledTemporaryFile(max_size=MINIO_PART_SIZE) as buffer:
+            with gzip.GzipFile(fileobj=buffer, mode='wb') as gz:
+                shutil.copyfileobj(response, gz, HASH_CHUNK_SIZE)
+            stored = buffer.tell()
+            buffer.seek(0)
+            upload_to_minio(cold_key, buffer, stored, 'application/gzip')
+    finally:
+        response.close()
+        response.release_conn()
+    return cold_key, stored
+
+def tier_cold_objects(client, operation_type, days, batch_size):
+    """
+    Переносит в холодный префикс пачку объектов, на которые ссылаются операции operation_type
+    и к которым не обращались days дней. Каждый объект — отдельно и без долгих транзакций:
+    копия пишется без блокировок, cold_key фиксируется, только если за время копирования
+    к объекту не обращались, а горячая копия удаляется под блокировкой строки после повторной проверки.
+    Возвращает список (hashed_filename, size, stored_bytes) перенесённых объектов.
+    """
+    def select_candidates(cur):
+        cur.execute("""
+            SELECT o.hashed_filename, o.size_bytes, o.last_referenced_at
+            FROM file_objects o
+            WHERE o.cold_key IS NULL
+              AND o.ref_count > 0
+              AND o.last_referenced_at < now() - make_interval(days => %s)
+              AND EXISTS (
+                  SELECT 1 FROM file_logs l
+                  WHERE l.hashed_filename = o.hashed_filename AND l.operation_type = %s
+              )
+            LIMIT %s
+        """, (days, operation_type, batch_size))
+        return cur.fetchall()
+
+    moved = []
+    for row in run_in_transaction(select_candidates):
+        name = row['hashed_filename']
+        cold_key, stored = move_object_to_cold(client, name)
+        try:
+            claimed = run_in_transaction(lambda cur: claim_cold_object(cur, name, cold_key, stored,
+                                                                        row['last_referenced_at']))
+        except Exception:
+            # Копия нигде не записана — удаляем, чтобы не осталась сиротой
+            client.remove_object(MINIO_BUCKET_NAME, cold_key)
+            raise
+        if claimed == 'lost':
+            client.remove_object(MINIO_BUCKET_NAME, cold_key)
+        if claimed != 'claimed':
+            continue
+
+        try:
+            outcome = run_in_transaction(lambda cur: drop_hot_copy(cur, client, name, cold_key,
+                                                                   row['last_referenced_at']))
+        except S3Error as e:
+            # cold_key уже записан, объект доступен; лишнюю горячую копию удалит сборщик мусора
+            # вместе с холодной или перезапишет восстановление
+            print(f"Не удалось удалить горячую копию {name}: {e}")
+            continue
+        if outcome == 'reverted':
+            client.remove_object(MINIO_BUCKET_NAME, cold_key)
+        elif outcome == 'dropped':
+            moved.append((name, row['size_bytes'] or stored, stored))
+    return moved
+
+def claim_cold_object(cur, hashed_name, cold_key, stored, last_referenced_at):
+    """
+    Фиксирует cold_key, если объект всё ещё горячий и к нему не обращались с момента выбора.
+    'claimed' — записано; 'taken' — тот же cold_key уже записал параллельный перенос; 'lost' — копия не нужна.
+    """
+    cur.execute("""
+        UPDATE file_objects SET cold_key = %s, stored_bytes = %s
+        WHERE hashed_filename = %s AND cold_key IS NULL AND last_referenced_at = %s
+        RETURNING hashed_filename
+    """, (cold_key, stored, hashed_name, last_referenced_at))
+    if cur.fetchone():
+        return 'claimed'
+    cur.execute("SELECT cold_key FROM file_objects WHERE hashed_filename = %s", (hashed_name,))
+    current = cur.fetchone()
+    return 'taken' if current and current['cold_key'] == cold_key else 'lost'
+
+def drop_hot_copy(cur, client, hashed_name, cold_key, last_referenced_at):
+    """
+    Удаляет горячую копию под блокировкой строки file_objects: повторная загрузка того же
+    содержимого ждёт блокировку и после неё увидит cold_key, а значит загрузит объект заново.
+    'dropped' — удалена; 'reverted' — к объекту обратились, перенос отменён (холодную копию удалить);
+    'restored' — объект уже вернули в горячее хранилище; 'gone' — строку удалил сборщик мусора.
+    """
+    cur.execute("""
+        SELECT cold_key, last_referenced_at FROM file_objects
+        WHERE hashed_filename = %s
+        FOR UPDATE
+    """, (hashed_name,))
+    row = cur.fetchone()
+    if row is None:
+        # Сборщик мусора удалил строку и холодную копию; горячая больше никому не нужна
+        client.remove_object(MINIO_BUCKET_NAME, hashed_name)
+        return 'gone'
+    if row['cold_key'] != cold_key:
+        return 'restored'
+    if row['last_referenced_at'] != last_referenced_at:
+        cur.execute("""
+            UPDATE file_objects SET cold_key = NULL, stored_bytes = NULL
+            WHERE hashed_filename = %s AND cold_key = %s
+        """, (hashed_name, cold_key))
+        return 'reverted'
+    client.remove_object(MINIO_BUCKET_NAME, hashed_name)
+    return 'dropped'
+
+def apply_retention_policy(policy=None, batch_size=FILE_RETENTION_BATCH_SIZE):
+    """
+    Применяет политику хранения: переносит старые файлы в холодный префикс,
+    удаляет устаревшие строки file_logs пачками и собирает объекты без ссылок.
+    Возвращает отчёт по каждому operation_type и общее число освобождённых байт.
+    """
+    policy = policy or RETENTION_POLICY
+    client = get_minio_client()
+    report = {'operations': {}, 'reclaimed_bytes': 0}
+
+    for operation_type, rules in policy.items():
+        stats = {'expired_rows': 0, 'tiered_objects': 0, 'saved_bytes': 0}
+        report['operations'][operation_type] = stats
+
+        while rules.get('cold_days') is not None:
+            moved = tier_cold_objects(client, operation_type, rules['cold_days'], batch_size)
+            stats['tiered_objects'] += len(moved)
+            stats['saved_bytes'] += sum(size - stored for _, size, stored in moved)
+            if len(moved) < batch_size:
+                break
+
+        while rules.get('expire_days') is not None:
+            conn = get_db_connection()
+            if not conn:
+                raise Exception("Ошибка подключения к БД")
+            try:
+                with conn.cursor() as cur:
+                    deleted = expire_file_logs(cur, operation_type, rules['expire_days'], batch_size)
+                    conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                conn.close()
+            stats['expired_rows'] += deleted
+            if deleted < batch_size:
+                break
+
+        report['reclaimed_bytes'] += stats['saved_bytes']
+
+    report['collected'] = collect_unreferenced_objects()
+    report['reclaimed_bytes'] += report['collected']['bytes']
+    return report
+
+# file_logs секционирована по месяцам (init/07): секции создаются заранее на FILE_LOGS_PARTITIONS_AHEAD месяцев
+FILE_LOGS_PARTITIONS_AHEAD = int(os.getenv("FILE_LOGS_PARTITIONS_AHEAD", "2"))
+# Дневные агрегаты пересчитываются за последние FILE_LOGS_ROLLUP_DAYS дней
+FILE_LOGS_ROLLUP_DAYS = int(os.getenv("FILE_LOGS_ROLLUP_DAYS", "2"))
+FILE_LOGS_MAINTENANCE_HOUR = int(os.getenv("FILE_LOGS_MAINTENANCE_HOUR", "1"))
 
-    # Логируем в БД
+def ensure_file_logs_partitions(months_ahead=FILE_LOGS_PARTITIONS_AHEAD):
+    """
+    Создаёт секции file_logs на текущий и months_ahead следующих месяцев.
+    Границы — полночь первого числа по UTC, как в init/07. Если задание пропустило запуск
+    и строки месяца уже легли в file_logs_default, Postgres не даст создать секцию поверх них:
+    default-секция отсоединяется, строки месяца переносятся в новую секцию, default возвращается.
+    """
     conn = get_db_connection()
     if not conn:
-        raise Exception("Нет подключения к БД для логирования")
+        raise Exception("Ошибка подключения к БД")
+    try:
+        with conn.cursor() as cur:
+            month = datetime.now(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+            for _ in range(months_ahead + 1):
+                next_month = (month + timedelta(days=32)).replace(day=1)
+                partition = f"file_logs_{month:%Y_%m}"
+                cur.execute("SELECT to_regclass(%s) AS existing, to_regclass('file_logs_default') AS fallback",
+                            (partition,))
+                row = cur.fetchone()
+                if not row['existing']:
+                    if row['fallback']:
+                        cur.execute("ALTER TABLE file_logs DETACH PARTITION file_logs_default")
+                    cur.execute(f"""
+                        CREATE TABLE {partition}
+                        PARTITION OF file_logs FOR VALUES FROM (%s::timestamptz) TO (%s::timestamptz)
+                    """, (month, next_month))
+                    if row['fallback']:
+                        cur.execute("""
+                            WITH moved AS (
+                                DELETE FROM file_logs_default
+                                WHERE created_at >= %s::timestamptz AND created_at < %s::timestamptz
+                                RETURNING *
+                            )
+                            INSERT INTO file_logs SELECT * FROM moved
+                        """, (month, next_month))
+                        cur.execute("ALTER TABLE file_logs ATTACH PARTITION file_logs_default DEFAULT")
+                month = next_month
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
 
+def rollup_file_logs_daily(days=FILE_LOGS_ROLLUP_DAYS):
+    """
+    Пересчитывает file_logs_daily за последние days дней (по московскому времени).
+    Агрегаты остаются и после того, как политика хранения удалит исходные строки.
+    """
+    conn = get_db_connection()
+    if not conn:
+        raise Exception("Ошибка подключения к БД")
     try:
         with conn.cursor() as cur:
             cur.execute("""
-                INSERT INTO file_logs (
-                    original_filename, hashed_filename, operation_type,
-                    file_extension, user_ip
-                ) VALUES (%s, %s, %s, %s, %s)
-            """, (original_filename, hashed_name, operation_type, ext, user_ip))
+                INSERT INTO file_logs_daily (day, operation_type, operations, bytes, unique_ips)
+                SELECT (l.created_at AT TIME ZONE 'Europe/Moscow')::date AS day,
+                       l.operation_type,
+                       COUNT(*),
+                       COALESCE(SUM(o.size_bytes), 0),
+                       COUNT(DISTINCT l.user_ip)
+                FROM file_logs l
+                LEFT JOIN file_objects o ON o.hashed_filename = l.hashed_filename
+                WHERE l.created_at >= (date_trunc('day', now() AT TIME ZONE 'Europe/Moscow')
+                                       - make_interval(days => %s)) AT TIME ZONE 'Europe/Moscow'
+                GROUP BY 1, 2
+                ON CONFLICT (day, operation_type) DO UPDATE
+                SET operations = EXCLUDED.operations,
+                    bytes = EXCLUDED.bytes,
+                    unique_ips = EXCLUDED.unique_ips
+            """, (days - 1,))
             conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
     finally:
         conn.close()
 
-    return hashed_name
+def maintain_file_logs():
+    ensure_file_logs_partitions()
+    rollup_file_logs_daily()
+
+EARTH_RADIUS_MILES = 3958.8
 
 def haversine(lat1, lon1, lat2, lon2):
-    R = 3958.8
+    R = EARTH_RADIUS_MILES
     dlat = math.radians(lat2 - lat1)
     dlon = math.radians(lon2 - lon1)
     a = (math.sin(dlat / 2) ** 2 +
@@ -122,6 +781,252 @@ def haversine(lat1, lon1, lat2, lon2):
     c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
     return R * c
 
+# Фоновые службы (планировщик) запускаются в каждом процессе-воркере один раз
+BACKGROUND_SERVICES_ENABLED = os.getenv("BACKGROUND_SERVICES_ENABLED", "1") == "1"
+SCHEDULER_TZ = ZoneInfo("Europe/Moscow")
+SCHEDULER_POLL_SECONDS = 60
+# Задача запускается только в течение этого окна после назначенного часа
+SCHEDULER_WINDOW_HOURS = int(os.getenv("SCHEDULER_WINDOW_HOURS", "3"))
+
+scheduled_jobs = {}
+background_pid = None
+background_lock = threading.Lock()
+
+def schedule_daily(name, hour, func):
+    """Регистрирует ежедневную задачу, которая выполняется в hour часов по Москве."""
+    scheduled_jobs[name] = (hour, func)
+
+def run_scheduled_job(name, func, due_at):
+    """
+    Выполняет задачу не более одного раза за сутки на весь кластер:
+    advisory-блокировка исключает параллельный запуск в нескольких воркерах,
+    а scheduled_job_runs — повторный запуск после завершения.
+    Возвращает True, если задача выполнена (сейчас или ранее).
+    """
+    conn = get_db_connection()
+    if not conn:
+        return False
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_lock(hashtext(%s)) AS locked", (name,))
+            locked = cur.fetchone()['locked']
+            conn.commit()
+            if not locked:
+                return False
+            try:
+                cur.execute("SELECT last_run_at FROM scheduled_job_runs WHERE job_name = %s", (name,))
+                row = cur.fetchone()
+                conn.commit()
+                if row and row['last_run_at'] >= due_at:
+                    return True
+
+                func()
+
+                cur.execute("""
+                    INSERT INTO scheduled_job_runs (job_name, last_run_at)
+                    VALUES (%s, now())
+                    ON CONFLICT (job_name) DO UPDATE SET last_run_at = EXCLUDED.last_run_at
+                """, (name,))
+                conn.commit()
+                return True
+            finally:
+                conn.rollback()
+                cur.execute("SELECT pg_advisory_unlock(hashtext(%s))", (name,))
+                conn.commit()
+    finally:
+        conn.close()
+
+def scheduler_loop():
+    completed = {}
+    while True:
+        now = datetime.now(SCHEDULER_TZ)
+        for name, (hour, func) in list(scheduled_jobs.items()):
+            due_at = now.replace(hour=hour, minute=0, second=0, microsecond=0)
+            in_window = due_at <= now < due_at + timedelta(hours=SCHEDULER_WINDOW_HOURS)
+            if not in_window or completed.get(name) == due_at:
+                continue
+            try:
+                if run_scheduled_job(name, func, due_at):
+                    completed[name] = due_at
+            except Exception as e:
+                print(f"Ошибка фоновой задачи {name}: {e}")
+        time.sleep(SCHEDULER_POLL_SECONDS)
+
+# Фоновая архивация в MinIO: ограниченная очередь, повторы с экспоненциальной паузой
+ARCHIVE_QUEUE_SIZE = int(os.getenv("ARCHIVE_QUEUE_SIZE", "100"))
+ARCHIVE_MAX_RETRIES = int(os.getenv("ARCHIVE_MAX_RETRIES", "5"))
+ARCHIVE_RETRY_DELAY = float(os.getenv("ARCHIVE_RETRY_DELAY", "2"))
+# Сколько секунд запрос ждёт места в заполненной очереди, прежде чем загрузить файл сам
+ARCHIVE_ENQUEUE_TIMEOUT = float(os.getenv("ARCHIVE_ENQUEUE_TIMEOUT", "5"))
+ARCHIVE_DRAIN_TIMEOUT = float(os.getenv("ARCHIVE_DRAIN_TIMEOUT", "30"))
+
+archive_queue = queue.Queue(maxsize=ARCHIVE_QUEUE_SIZE)
+archive_metrics = {
+    'enqueued': 0,
+    'uploaded': 0,
+    'retried': 0,
+    'failed': 0,
+    'queue_full': 0,
+    'inline': 0
+}
+archive_failures = deque(maxlen=20)
+archive_metrics_lock = threading.Lock()
+
+def count_archive_metric(name):
+    with archive_metrics_lock:
+        archive_metrics[name] += 1
+
+def process_archive_job(job):
+    """
+    Загружает файл в MinIO и логирует его, повторяя попытки при ошибках.
+    В любом случае освобождает источник: временный файл удаляется, поток закрывается.
+    """
+    source, original_filename, operation_type, user_ip, content_key, length = job
+    try:
+        for attempt in range(ARCHIVE_MAX_RETRIES + 1):
+            try:
+                if hasattr(source, 'seek'):
+                    source.seek(0)
+                save_file_to_minio_and_log(source, original_filename, operation_type, user_ip,
+                                           content_key=content_key, length=length)
+                count_archive_metric('uploaded')
+                return True
+            except Exception as e:
+                error = e
+                if attempt < ARCHIVE_MAX_RETRIES:
+                    count_archive_metric('retried')
+                    time.sleep(ARCHIVE_RETRY_DELAY * 2 ** attempt)
+
+        count_archive_metric('failed')
+        with archive_metrics_lock:
+            archive_failures.append({
+                'time': datetime.now(timezone.utc).isoformat(),
+                'filename': original_filename,
+                'operation_type': operation_type,
+                'error': str(error)[:300]
+            })
+        print(f"Не удалось архивировать {original_filename}: {error}")
+        return False
+    finally:
+        if isinstance(source, (str, os.PathLike)):
+            try:
+                os.unlink(source)
+            except OSError:
+                pass
+        elif hasattr(source, 'close'):
+            source.close()
+
+def archive_file(source, original_filename, operation_type, user_ip, content_key=None, length=None):
+    """
+    Архивирует файл в MinIO вне пути запроса. source — байты, поток с seek() или путь
+    к временному файлу. Источник переходит во владение загрузчика: файл будет удалён,
+    поток закрыт — вызывающий код не должен их трогать.
+    Если очередь заполнена дольше ARCHIVE_ENQUEUE_TIMEOUT, файл загружается сразу.
+    """
+    job = (source, original_filename, operation_type, user_ip, content_key, length)
+    if BACKGROUND_SERVICES_ENABLED:
+        start_background_services()
+        try:
+            archive_queue.put(job, timeout=ARCHIVE_ENQUEUE_TIMEOUT)
+            count_archive_metric('enqueued')
+            return
+        except queue.Full:
+            count_archive_metric('queue_full')
+
+    count_archive_metric('inline')
+    process_archive_job(job)
+
+def archive_worker_loop():
+    while True:
+        job = archive_queue.get()
+        try:
+            process_archive_job(job)
+        except Exception as e:
+            print(f"Ошибка фонового загрузчика: {e}")
+        finally:
+            archive_queue.task_done()
+
+def drain_archive_queue(timeout=ARCHIVE_DRAIN_TIMEOUT):
+    # При остановке воркера даём загрузчику дописать очередь
+    deadline = time.monotonic() + timeout
+    while archive_queue.unfinished_tasks and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+atexit.register(drain_archive_queue)
+
+def get_archive_metrics():
+    with archive_metrics_lock:
+        return dict(
+            archive_metrics,
+            queue_size=archive_queue.qsize(),
+            queue_capacity=ARCHIVE_QUEUE_SIZE,
+            recent_failures=list(archive_failures)
+        )
+
+def start_background_services():
+    """Запускает фоновые потоки в текущем процессе (после fork — заново)."""
+    global background_pid, archive_queue
+    if not BACKGROUND_SERVICES_ENABLED:
+        return
+    with background_lock:
+        if background_pid == os.getpid():
+            return
+        background_pid = os.getpid()
+        # Очередь родительского процесса после fork не используем
+        archive_queue = queue.Queue(maxsize=ARCHIVE_QUEUE_SIZE)
+        threading.Thread(target=scheduler_loop, name='scheduler', daemon=True).start()
+        threading.Thread(target=archive_worker_loop, name='archive-uploader', daemon=True).start()
+        threading.Thread(target=stats_refresh_loop, name='stats-refresh', daemon=True).start()
+
+def init_worker():
+    """
+    Подготовка воркера сразу после fork (хук post_fork в gunicorn.conf.py):
+    клиент MinIO с проверкой бакета и фоновые потоки — до первого запроса.
+    """
+    try:
+        get_minio_client()
+    except Exception as e:
+        # Воркер всё равно стартует; клиент будет создан при первом обращении
+        print(f"MinIO недоступен при старте воркера: {e}")
+    start_background_services()
+
+@app.before_request
+def ensure_background_services():
+    start_background_services()
+
+def check_health():
+    """Состояние БД и MinIO с временем отклика каждой проверки, мс."""
+    checks = {}
+    start = time.perf_counter()
+    conn = get_db_connection()
+    try:
+        if conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+        checks['db'] = {'ok': conn is not None}
+    except Exception as e:
+        checks['db'] = {'ok': False, 'error': str(e)}
+    finally:
+        if conn:
+            conn.close()
+    checks['db']['ms'] = round((time.perf_counter() - start) * 1000, 1)
+
+    start = time.perf_counter()
+    try:
+        checks['minio'] = {'ok': get_minio_client().bucket_exists(MINIO_BUCKET_NAME)}
+    except Exception as e:
+        checks['minio'] = {'ok': False, 'error': str(e)}
+    checks['minio']['ms'] = round((time.perf_counter() - start) * 1000, 1)
+    return checks
+
+@app.route('/health')
+def health():
+    """Проверка готовности для docker healthcheck и балансировщика (без авторизации)."""
+    checks = check_health()
+    ok = all(c['ok'] for c in checks.values())
+    return jsonify(status='ok' if ok else 'error', pid=os.getpid(), **checks), 200 if ok else 503
+
 @app.route('/', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
@@ -195,29 +1100,32 @@ def markets():
 
     try:
         with conn.cursor() as cur:
-            cur.execute("SELECT COUNT(*) AS total FROM farmers_markets")
-            total = cur.fetchone()['total']
+            # Для больших таблиц число рынков — оценка планировщика, поэтому страниц «примерно столько»
+            total_count = get_table_counts(cur, ('farmers_markets',))['farmers_markets']
+            approximate = total_count['mode'] == 'estimate'
+            total = total_count['value']
             total_pages = (total + per_page - 1) // per_page
 
-            if page > total_pages and total_pages > 0:
+            if page > total_pages and total_pages > 0 and not approximate:
                 return redirect(url_for('markets', page=total_pages))
 
             cur.execute("""
                 SELECT fm.market_name, fm.city, fm.state,
-                       COALESCE(AVG(r.rating), 0) AS avg_rating,
-                       COUNT(r.review_id) AS review_count
+                       COALESCE(s.rating_sum::numeric / NULLIF(s.review_count, 0), 0) AS avg_rating,
+                       COALESCE(s.review_count, 0) AS review_count
                 FROM farmers_markets fm
-                LEFT JOIN reviews r ON fm.market_id = r.market_id
-                GROUP BY fm.market_id, fm.market_name, fm.city, fm.state
+                LEFT JOIN market_rating_stats s ON s.market_id = fm.market_id
                 ORDER BY fm.market_name
                 LIMIT %s OFFSET %s
             """, (per_page, offset))
 
             paginated = cur.fetchall()
+            if approximate and not paginated and page > 1:
+                return redirect(url_for('markets', page=max(total_pages, 1)))
 
             markets = []
             for m in paginated:
-                rating = round(m['avg_rating'], 1)
+                rating = round(float(m['avg_rating']), 1)
                 stars = "★" * int(round(rating)) + "☆" * (5 - int(round(rating)))
                 markets.append({
                     "name": m['market_name'],
@@ -231,10 +1139,181 @@ def markets():
             return render_template('markets.html',
                                    markets=markets,
                                    current_page=page,
-                                   total_pages=total_pages)
+                                   total_pages=max(total_pages, page) if approximate else total_pages,
+                                   approximate=approximate,
+                                   has_next=len(paginated) == per_page)
     finally:
         conn.close()
 
+# Поиск: фильтр, сортировка и LIMIT выполняются в БД, из неё приходит только SEARCH_PAGE_SIZE строк
+SEARCH_MODES = ('city', 'state', 'zip')
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "50"))
+
+# Ключ постраничного просмотра для каждой сортировки: (столбец, направление, тип значения в cursor).
+# При равенстве значения порядок задаёт market_id по возрастанию.
+SEARCH_KEYSETS = {
+    "1": ("market_name", "ASC", str),
+    "2": ("market_name", "DESC", str),
+    "3": ("rank_rating", "DESC", Decimal),
+}
+
+def search_keyset(sort, point):
+    if sort in SEARCH_KEYSETS:
+        return SEARCH_KEYSETS[sort]
+    if point:
+        return ("distance", "ASC", float)
+    return (None, "ASC", None)
+
+# Фасеты поиска: параметр запроса -> (столбец market_facets, справочник, его id и название)
+SEARCH_FACETS = {
+    'product': ('product_ids', 'products', 'product_id', 'product_name'),
+    'payment': ('payment_ids', 'payment_methods', 'payment_id', 'payment_name'),
+}
+
+def parse_search_facets(args):
+    """{'product': [id, ...], 'payment': [...]} из параметров запроса; не-id (в т.ч. '²') отбрасываются."""
+    return {name: sorted({int(v) for v in args.getlist(name) if v.isascii() and v.isdigit()})
+            for name in SEARCH_FACETS}
+
+def build_search_query(mode, q, point, sort, cursor=None, facets=None):
+    """
+    SQL поиска рынков без LIMIT: (sql, params, order_sql).
+    point — (lat, lon, radius) для поиска по радиусу (в милях), иначе фильтр LOWER(TRIM(mode)) = q (если q задан).
+    Рейтинг для сортировки — байесовский по market_rating_stats, соединение по market_id.
+    cursor — строка из search_cursor(): продолжить после этой строки результатов (ValueError, если испорчен).
+    facets — {'product': [id, ...], 'payment': [...]}: рынок должен иметь все перечисленные значения.
+    """
+    columns = ["fm.market_id", "fm.market_name", "fm.city", "fm.state",
+               "COALESCE(s.rating_sum::numeric / NULLIF(s.review_count, 0), 0) AS avg_rating",
+               f"COALESCE({bayesian_rating_sql('s')}, 0) AS rank_rating"]
+    params = []
+    outer_where, outer_params = [], []
+    if point:
+        lat, lon, radius = point
+        columns.append(f"""
+            2 * {EARTH_RADIUS_MILES} * ASIN(SQRT(LEAST(1,
+                POWER(SIN(RADIANS(fm.y - %s) / 2), 2)
+                + COS(RADIANS(%s)) * COS(RADIANS(fm.y)) * POWER(SIN(RADIANS(fm.x - %s) / 2), 2)
+            ))) AS distance""")
+        params += [lat, lat, lon]
+        # Прямоугольник вокруг точки отсекает дальние рынки по индексу до расчёта расстояния
+        dlat = math.degrees(radius / EARTH_RADIUS_MILES)
+        where = ["fm.y BETWEEN %s AND %s"]
+        params += [lat - dlat, lat + dlat]
+        cos_lat = math.cos(math.radians(lat))
+        # Круг, задевающий полюс или широкий по долготе, по x не ограничивается
+        if abs(lat) + dlat < 90 and cos_lat > 1e-6 and dlat / cos_lat < 180:
+            west, east = lon - dlat / cos_lat, lon + dlat / cos_lat
+            if west < -180 or east > 180:
+                # Прямоугольник пересекает ±180° — две полосы по обе стороны антимеридиана
+                where.append("(fm.x BETWEEN %s AND 180 OR fm.x BETWEEN -180 AND %s)")
+                params += [west + 360 if west < -180 else west, east - 360 if east > 180 else east]
+            else:
+                where.append("fm.x BETWEEN %s AND %s")
+                params += [west, east]
+        outer_where.append("m.distance <= %s")
+        outer_params.append(radius)
+    elif q:
+        where = [f"LOWER(TRIM(fm.{mode})) = %s"]
+        params.append(q.lower())
+    else:
+        where = []
+
+    joins = ["LEFT JOIN market_rating_stats s ON s.market_id = fm.market_id"]
+    if facets and any(facets.values()):
+        # Пересечение фасетов — по GIN-индексам market_facets, без соединения с таблицами связей
+        joins.append("JOIN market_facets f ON f.market_id = fm.market_id")
+        for name, ids in facets.items():
+            if ids:
+                where.append(f"f.{SEARCH_FACETS[name][0]} @> %s::int[]")
+                params.append(list(ids))
+
+    column, direction, value_type = search_keyset(sort, point)
+    if column:
+        order_sql = f"m.{column} {direction}, m.market_id"
+    else:
+        order_sql = "m.market_id"
+
+    if cursor:
+        value, market_id = cursor.rsplit('|', 1) if column else (None, cursor)
+        market_id = int(market_id)
+        if column:
+            op = '<' if direction == 'DESC' else '>'
+            outer_where.append(f"(m.{column} {op} %s OR (m.{column} = %s AND m.market_id > %s))")
+            outer_params += [value_type(value), value_type(value), market_id]
+        else:
+            outer_where.append("m.market_id > %s")
+            outer_params.append(market_id)
+
+    sql = f"""
+        SELECT m.* FROM (
+            SELECT {', '.join(columns)}
+            FROM farmers_markets fm
+            {' '.join(joins)}
+            WHERE {' AND '.join(where) or 'TRUE'}
+        ) m
+        {'WHERE ' + ' AND '.join(outer_where) if outer_where else ''}
+    """
+    return sql, params + outer_params, order_sql
+
+def fetch_facet_counts(cur, sql, params, facets):
+    """
+    Число найденных запросом sql рынков по каждому продукту и способу оплаты:
+    {'product': [{'id', 'name', 'count'}, ...], 'payment': [...]}. Выбранные значения есть в списке и при нуле.
+    """
+    counts_sql = []
+    select_sql = []
+    select_params = []
+    for name, (array_column, table, id_column, name_column) in SEARCH_FACETS.items():
+        counts_sql.append(f"""
+            {name}_counts AS (
+                SELECT u.id, COUNT(*) AS count
+                FROM matched
+                JOIN market_facets f ON f.market_id = matched.market_id
+                CROSS JOIN LATERAL unnest(f.{array_column}) AS u(id)
+                GROUP BY u.id
+            )""")
+        select_sql.append(f"""
+            SELECT '{name}' AS facet, t.{id_column} AS id, t.{name_column} AS name, COALESCE(c.count, 0) AS count
+            FROM {table} t
+            LEFT JOIN {name}_counts c ON c.id = t.{id_column}
+            WHERE c.count > 0 OR t.{id_column} = ANY(%s)""")
+        select_params.append(list(facets.get(name) or []))
+
+    cur.execute(f"""
+        WITH matched AS ({sql}),{','.join(counts_sql)}
+        {' UNION ALL '.join(select_sql)}
+        ORDER BY facet, count DESC, name
+    """, (*params, *select_params))
+
+    result = {name: [] for name in SEARCH_FACETS}
+    for r in cur.fetchall():
+        result[r['facet']].append({'id': r['id'], 'name': r['name'], 'count': int(r['count'])})
+    return result
+
+def search_cursor(row, sort, point):
+    """Cursor для продолжения поиска после строки row."""
+    column, _, _ = search_keyset(sort, point)
+    if not column:
+        return str(row['market_id'])
+    return f"{row[column]}|{row['market_id']}"
+
+def estimate_query_rows(cur, sql, params):
+    """Оценка числа строк запроса по плану (EXPLAIN без выполнения)."""
+    cur.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+    plan = cur.fetchone()['QUERY PLAN']
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+def search_result(row, sort):
+    result = {"name": row['market_name'], "city": row['city'], "state": row['state']}
+    if row.get('distance') is not None:
+        result["distance"] = round(float(row['distance']), 1)
+    if sort == "3":
+        result["rating"] = float(row['avg_rating'])
+    return result
+
 @app.route('/search', methods=['GET'])
 @require_auth
 def search_page():
@@ -246,78 +1325,56 @@ def search_page():
     lon = request.args.get('lon')
     radius_val = request.args.get('radius_val')
 
+    cursor = request.args.get('cursor') or None
+    selected_facets = parse_search_facets(request.args)
+
     results = []
+    next_url = None
+    total = None
+    facets = None
     if request.args:
+        point = None
+        if radius:
+            try:
+                point = (float(lat), float(lon), float(radius_val))
+            except (ValueError, TypeError):
+                flash("Некорректные координаты или радиус", "error")
+                return render_template('search.html', mode=mode, radius=radius, sort=sort, lat=lat, lon=lon, radius_val=radius_val)
+        elif not q and not any(selected_facets.values()):
+            flash("Для поиска по городу/субъекту/индексу введите значение", "error")
+            return render_template('search.html', mode=mode, radius=radius, sort=sort, q=q, lat=lat,
+                                   lon=lon, radius_val=radius_val)
+        elif q and mode not in SEARCH_MODES:
+            flash("Неизвестный тип поиска", "error")
+            return render_template('search.html', mode=mode, radius=radius, sort=sort, q=q, lat=lat,
+                                   lon=lon, radius_val=radius_val)
+
         conn = get_db_connection()
         if not conn:
             flash("Ошибка подключения к БД", "error")
         else:
             try:
                 with conn.cursor() as cur:
-                    if radius:
-                        try:
-                            lat_f = float(lat)
-                            lon_f = float(lon)
-                            radius_f = float(radius_val)
-                        except (ValueError, TypeError):
-                            flash("Некорректные координаты или радиус", "error")
-                            return render_template('search.html', mode=mode, radius=radius, sort=sort, lat=lat, lon=lon, radius_val=radius_val)
-
-                        cur.execute("SELECT market_name, city, state, y AS lat, x AS lon FROM farmers_markets")
-                        for row in cur.fetchall():
-                            if row['lat'] is None or row['lon'] is None:
-                                continue
-                            dist = haversine(lat_f, lon_f, row['lat'], row['lon'])
-                            if dist <= radius_f:
-                                results.append({
-                                    "name": row['market_name'],
-                                    "city": row['city'],
-                                    "state": row['state'],
-                                    "distance": round(dist, 1)
-                                })
+                    sql, params, order_sql = build_search_query(mode, q, point, sort, cursor, selected_facets)
+                    cur.execute(f"{sql} ORDER BY {order_sql} LIMIT %s", (*params, SEARCH_PAGE_SIZE + 1))
+                    rows = cur.fetchall()
+                    has_next = len(rows) > SEARCH_PAGE_SIZE
+                    rows = rows[:SEARCH_PAGE_SIZE]
+                    results = [search_result(r, sort) for r in rows]
+
+                    # Одна страница без курсора — число известно точно, иначе оценка планировщика
+                    all_sql, all_params, _ = build_search_query(mode, q, point, sort, facets=selected_facets)
+                    if has_next or cursor:
+                        total = {'value': max(estimate_query_rows(cur, all_sql, all_params), len(results)),
+                                 'mode': 'estimate'}
                     else:
-                        if not radius and not q:
-                            flash("Для поиска по городу/субъекту/индексу введите значение", "error")
-                            return render_template('search.html', mode=mode, radius=radius, sort=sort, q=q, lat=lat,
-                                                   lon=lon, radius_val=radius_val)
-
-                        elif radius:
-                            try:
-                                lat_f = float(lat)
-                                lon_f = float(lon)
-                                radius_f = float(radius_val)
-                            except (ValueError, TypeError):
-                                flash("Некорректные координаты или радиус", "error")
-                                return render_template('search.html', mode=mode, radius=radius, sort=sort, lat=lat,
-                                                       lon=lon, radius_val=radius_val)
-
-                        cur.execute(f"""
-                            SELECT market_name, city, state
-                            FROM farmers_markets
-                            WHERE LOWER(TRIM({mode})) = %s
-                        """, (q.lower(),))
-                        results = [{"name": r['market_name'], "city": r['city'], "state": r['state']} for r in cur.fetchall()]
-
-                    # Сортировка по рейтингу
-                    if sort == "3" and results:
-                        market_names = [m["name"] for m in results]
-                        placeholders = ','.join(['%s'] * len(market_names))
-                        cur.execute(f"""
-                            SELECT fm.market_name, COALESCE(AVG(r.rating), 0) AS avg_rating
-                            FROM farmers_markets fm
-                            LEFT JOIN reviews r ON fm.market_id = r.market_id
-                            WHERE fm.market_name IN ({placeholders})
-                            GROUP BY fm.market_name
-                        """, market_names)
-                        rating_map = {r['market_name']: float(r['avg_rating']) for r in cur.fetchall()}
-                        for m in results:
-                            m['rating'] = rating_map.get(m['name'], 0.0)
-                        results.sort(key=lambda x: x.get('rating', 0), reverse=True)
-                    elif sort == "1":
-                        results.sort(key=lambda x: x["name"])
-                    elif sort == "2":
-                        results.sort(key=lambda x: x["name"], reverse=True)
-
+                        total = {'value': len(results), 'mode': 'exact'}
+                    if has_next:
+                        next_url = url_for('search_page', **dict(request.args.to_dict(flat=False),
+                                                                 cursor=search_cursor(rows[-1], sort, point)))
+                    facets = fetch_facet_counts(cur, all_sql, all_params, selected_facets)
+            except (ValueError, ArithmeticError):
+                flash("Некорректная ссылка на следующую страницу результатов", "error")
             except Exception as e:
                 flash(f"Ошибка поиска: {e}", "error")
             finally:
@@ -331,7 +1388,155 @@ def search_page():
                          lat=lat,
                          lon=lon,
                          radius_val=radius_val,
-                         results=results)
+                         results=results,
+                         total=total,
+                         next_url=next_url,
+                         first_url=url_for('search_page', **{k: v for k, v in request.args.lists() if k != 'cursor'}) if cursor else None,
+                         facets=facets,
+                         selected_facets=selected_facets,
+                         pdf_batch_limit=PDF_BATCH_LIMIT)
+
+# Автодополнение названий рынков, городов и субъектов: по каждому полю — отсортированный список
+# нормализованных значений в памяти процесса, поиск префикса — bisect. Индекс догружает изменения
+# по farmers_markets.updated_at и market_tombstones раз в AUTOCOMPLETE_REFRESH_SECONDS и сразу
+# после изменения рынков в этом воркере; полная загрузка — только при первом обращении.
+AUTOCOMPLETE_FIELDS = ('market_name', 'city', 'state')
+AUTOCOMPLETE_LIMIT = int(os.getenv("AUTOCOMPLETE_LIMIT", "10"))
+AUTOCOMPLETE_REFRESH_SECONDS = int(os.getenv("AUTOCOMPLETE_REFRESH_SECONDS", "30"))
+# Транзакция, начатая до синхронизации, может закоммитить строку с updated_at раньше отметки —
+# поэтому изменения перечитываются с запасом (повторное применение ничего не меняет)
+AUTOCOMPLETE_SYNC_OVERLAP = timedelta(minutes=5)
+
+autocomplete_index = {
+    'markets': {},                                            # market_id -> {поле: значение}
+    'keys': {field: [] for field in AUTOCOMPLETE_FIELDS},     # отсортированные нормализованные значения
+    'values': {field: {} for field in AUTOCOMPLETE_FIELDS},   # нормализованное -> [как показывать, число рынков]
+    'synced_at': None,                                        # время БД, до которого изменения учтены
+    'checked_at': None                                        # None — обновить при следующем запросе
+}
+autocomplete_lock = threading.Lock()
+
+def normalize_autocomplete(value):
+    return (value or '').strip().lower()
+
+def _autocomplete_remove(market_id):
+    market = autocomplete_index['markets'].pop(market_id, None)
+    if not market:
+        return
+    for field, value in market.items():
+        key = normalize_autocomplete(value)
+        entry = autocomplete_index['values'][field].get(key)
+        if not entry:
+            continue
+        entry[1] -= 1
+        if entry[1] == 0:
+            del autocomplete_index['values'][field][key]
+            keys = autocomplete_index['keys'][field]
+            del keys[bisect.bisect_left(keys, key)]
+
+def _autocomplete_add(row):
+    _autocomplete_remove(row['market_id'])
+    market = {}
+    for field in AUTOCOMPLETE_FIELDS:
+        key = normalize_autocomplete(row[field])
+        if not key:
+            continue
+        market[field] = row[field]
+        entry = autocomplete_index['values'][field].get(key)
+        if entry:
+            entry[1] += 1
+        else:
+            autocomplete_index['values'][field][key] = [row[field].strip(), 1]
+            bisect.insort(autocomplete_index['keys'][field], key)
+    autocomplete_index['markets'][row['market_id']] = market
+
+def refresh_autocomplete_index():
+    """Догружает изменения рынков с прошлой синхронизации (в первый раз — все рынки)."""
+    conn = get_db_connection()
+    if not conn:
+        return False
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT now() AS now")
+            now = cur.fetchone()['now']
+            since = autocomplete_index['synced_at']
+            if since is None:
+                cur.execute(f"SELECT market_id, {', '.join(AUTOCOMPLETE_FIELDS)} FROM farmers_markets")
+                changed, deleted = cur.fetchall(), []
+            else:
+                cur.execute(f"""
+                    SELECT market_id, {', '.join(AUTOCOMPLETE_FIELDS)}
+                    FROM farmers_markets
+                    WHERE updated_at > %s
+                """, (since - AUTOCOMPLETE_SYNC_OVERLAP,))
+                changed = cur.fetchall()
+                cur.execute("SELECT market_id FROM market_tombstones WHERE deleted_at > %s",
+                            (since - AUTOCOMPLETE_SYNC_OVERLAP,))
+                deleted = cur.fetchall()
+    finally:
+        conn.close()
+
+    for row in changed:
+        _autocomplete_add(row)
+    for row in deleted:
+        _autocomplete_remove(row['market_id'])
+    autocomplete_index['synced_at'] = now
+    autocomplete_index['checked_at'] = time.monotonic()
+    return True
+
+def mark_autocomplete_stale():
+    """Рынки изменены в этом воркере — следующий запрос автодополнения догрузит изменения."""
+    autocomplete_index['checked_at'] = None
+
+def autocomplete_needs_refresh():
+    checked_at = autocomplete_index['checked_at']
+    return checked_at is None or time.monotonic() - checked_at > AUTOCOMPLETE_REFRESH_SECONDS
+
+def autocomplete_suggestions(field, prefix, limit=AUTOCOMPLETE_LIMIT):
+    """Первые limit значений поля, начинающихся с prefix, по алфавиту."""
+    key = normalize_autocomplete(prefix)
+    keys = autocomplete_index['keys'][field]
+    values = autocomplete_index['values'][field]
+    start = bisect.bisect_left(keys, key)
+    suggestions = []
+    for candidate in keys[start:start + limit]:
+        if not candidate.startswith(key):
+            break
+        entry = values.get(candidate)
+        if entry:
+            suggestions.append(entry[0])
+    return suggestions
+
+@app.route('/autocomplete')
+@require_auth
+def autocomplete():
+    """Подсказки по префиксу: ?field=market_name|city|state&q=...&limit=..."""
+    field = request.args.get('field', 'market_name')
+    if field not in AUTOCOMPLETE_FIELDS:
+        return jsonify({'error': f"field: одно из {', '.join(AUTOCOMPLETE_FIELDS)}"}), 400
+    q = request.args.get('q', '')
+    try:
+        limit = min(max(int(request.args.get('limit', AUTOCOMPLETE_LIMIT)), 1), 50)
+    except ValueError:
+        return jsonify({'error': 'Неверный limit'}), 400
+
+    if autocomplete_needs_refresh():
+        # Синхронизацию выполняет один поток; остальные отвечают по текущему индексу
+        blocking = autocomplete_index['synced_at'] is None
+        if autocomplete_lock.acquire(blocking=blocking):
+            try:
+                if autocomplete_needs_refresh():
+                    refresh_autocomplete_index()
+            except Exception as e:
+                print(f"Ошибка обновления автодополнения: {e}")
+            finally:
+                autocomplete_lock.release()
+
+    if autocomplete_index['synced_at'] is None:
+        return jsonify({'error': 'Ошибка подключения к БД'}), 503
+    if not q.strip():
+        return jsonify(field=field, suggestions=[])
+    return jsonify(field=field, suggestions=autocomplete_suggestions(field, q, limit))
 
 @app.route('/detail', methods=['GET'])
 @require_auth
@@ -376,24 +1581,10 @@ def detail_page():
                         """, (row['market_id'],))
                         socials = [{"name": r['social_networks'], "url": r['url'] or "нет ссылки"} for r in cur.fetchall()]
 
-                        # Отзывы
-                        cur.execute("""
-                            SELECT user_name, rating, review_text, created_at
-                            FROM reviews
-                            WHERE market_id = %s
-                            ORDER BY created_at DESC
-                        """, (row['market_id'],))
-                        reviews = []
-                        for r in cur.fetchall():
-                            stars = "★" * r['rating'] + "☆" * (5 - r['rating'])
-                            date_str = r['created_at'].strftime('%d.%m.%Y')
-                            reviews.append({
-                                "user": r['user_name'],
-                                "stars": stars,
-                                "rating": r['rating'],
-                                "date": date_str,
-                                "text": r['review_text']
-                            })
+                        # Отзывы: первая страница, остальные подгружаются по кнопке
+                        review_rows, next_cursor = fetch_reviews_page(cur, row['market_id'])
+                        reviews = [format_review(r) for r in review_rows]
+                        summary = fetch_review_summaries(cur, [row['market_id']]).get(row['market_id'], EMPTY_REVIEW_SUMMARY)
 
                         market = {
                             "name": row['market_name'],
@@ -403,7 +1594,12 @@ def detail_page():
                             "products": products,
                             "payments": payments,
                             "socials": socials,
-                            "reviews": reviews
+                            "reviews": reviews,
+                            "market_id": row['market_id'],
+                            "review_count": summary['review_count'],
+                            "avg_rating": summary['avg_rating'],
+                            "rating_distribution": summary['distribution'],
+                            "next_reviews_cursor": next_cursor
                         }
                     else:
                         flash("Рынок не найден", "error")
@@ -411,6 +1607,141 @@ def detail_page():
                 conn.close()
     return render_template('detail.html', name=name, market=market)
 
+# Отзывы показываются страницами по REVIEWS_PAGE_SIZE; в PDF попадают последние PDF_REVIEW_LIMIT
+REVIEWS_PAGE_SIZE = int(os.getenv("REVIEWS_PAGE_SIZE", "10"))
+PDF_REVIEW_LIMIT = int(os.getenv("PDF_REVIEW_LIMIT", "50"))
+EMPTY_REVIEW_SUMMARY = {'review_count': 0, 'avg_rating': None, 'distribution': {}}
+
+# Байесовский рейтинг для сортировки: оценки рынка дополняются RATING_PRIOR_WEIGHT воображаемыми
+# отзывами со средней оценкой по всем рынкам, чтобы одна пятёрка не обгоняла сотню четвёрок.
+RATING_PRIOR_WEIGHT = int(os.getenv("RATING_PRIOR_WEIGHT", "5"))
+RATING_STARS = (5, 4, 3, 2, 1)
+
+def bayesian_rating_sql(alias):
+    """SQL-выражение байесовского рейтинга по строке market_rating_stats с псевдонимом alias."""
+    return f"""(
+        ({RATING_PRIOR_WEIGHT} * COALESCE((SELECT SUM(rating_sum)::numeric / NULLIF(SUM(review_count), 0)
+                                           FROM market_rating_stats), 0)
+         + COALESCE({alias}.rating_sum, 0))
+        / NULLIF({RATING_PRIOR_WEIGHT} + COALESCE({alias}.review_count, 0), 0)
+    )"""
+
+def rating_summary(row):
+    """Число отзывов, средний рейтинг и распределение {звёзды: число} из строки market_rating_stats."""
+    distribution = {stars: int(row[f'stars_{stars}'] or 0) for stars in RATING_STARS}
+    review_count = sum(distribution.values())
+    if not review_count:
+        return EMPTY_REVIEW_SUMMARY
+    rating_sum = sum(stars * count for stars, count in distribution.items())
+    return {'review_count': review_count,
+            'avg_rating': round(rating_sum / review_count, 2),
+            'distribution': distribution}
+
+def fetch_reviews_page(cur, market_id, cursor=None, limit=REVIEWS_PAGE_SIZE):
+    """
+    Страница отзывов рынка, новые сверху, по индексу (market_id, created_at, review_id).
+    cursor — строка из предыдущего вызова. Возвращает (строки, cursor следующей страницы или None).
+    """
+    if cursor:
+        created_at, review_id = cursor.rsplit('|', 1)
+        cur.execute("""
+            SELECT review_id, user_name, rating, review_text, created_at
+            FROM reviews
+            WHERE market_id = %s AND (created_at, review_id) < (%s, %s)
+            ORDER BY created_at DESC, review_id DESC
+            LIMIT %s
+        """, (market_id, datetime.fromisoformat(created_at), int(review_id), limit + 1))
+    else:
+        cur.execute("""
+            SELECT review_id, user_name, rating, review_text, created_at
+            FROM reviews
+            WHERE market_id = %s
+            ORDER BY created_at DESC, review_id DESC
+            LIMIT %s
+        """, (market_id, limit + 1))
+    rows = cur.fetchall()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, f"{rows[-1]['created_at'].isoformat()}|{rows[-1]['review_id']}"
+
+def fetch_review_summaries(cur, market_ids):
+    """Число отзывов, средний рейтинг и распределение оценок по рынкам — из market_rating_stats, без чтения reviews."""
+    cur.execute("""
+        SELECT market_id, stars_1, stars_2, stars_3, stars_4, stars_5
+        FROM market_rating_stats
+        WHERE market_id = ANY(%s)
+    """, (list(market_ids),))
+    return {r['market_id']: rating_summary(r) for r in cur.fetchall()}
+
+@app.route('/detail/reviews')
+@require_auth
+def detail_reviews():
+    """Следующая страница отзывов для кнопки «Показать ещё» на странице рынка."""
+    try:
+        market_id = int(request.args.get('market_id', ''))
+    except ValueError:
+        return jsonify({'error': 'Не указан market_id'}), 400
+
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({'error': 'Ошибка подключения к БД'}), 503
+
+    try:
+        with conn.cursor() as cur:
+            rows, next_cursor = fetch_reviews_page(cur, market_id, request.args.get('cursor') or None)
+    except ValueError:
+        return jsonify({'error': 'Неверный cursor'}), 400
+    finally:
+        conn.close()
+
+    return jsonify(reviews=[format_review(r) for r in rows], next_cursor=next_cursor)
+
+def record_review_rollups(cur, review_ids):
+    """
+    Добавляет новые отзывы в распределение оценок рынка и в дневные сводки по рынку
+    и субъекту (одним запросом на пачку). Вызывается в той же транзакции, что и INSERT INTO reviews.
+    """
+    cur.execute("""
+        WITH new_reviews AS (
+            SELECT r.market_id, r.created_at::date AS day, r.rating, COALESCE(fm.state, '') AS state
+            FROM reviews r
+            JOIN farmers_markets fm ON fm.market_id = r.market_id
+            WHERE r.review_id = ANY(%s)
+        ), by_stars AS (
+            INSERT INTO market_rating_stats (market_id, stars_1, stars_2, stars_3, stars_4, stars_5)
+            SELECT market_id,
+                   COUNT(*) FILTER (WHERE rating = 1),
+                   COUNT(*) FILTER (WHERE rating = 2),
+                   COUNT(*) FILTER (WHERE rating = 3),
+                   COUNT(*) FILTER (WHERE rating = 4),
+                   COUNT(*) FILTER (WHERE rating = 5)
+            FROM new_reviews
+            GROUP BY market_id
+            ON CONFLICT (market_id) DO UPDATE
+            SET stars_1 = market_rating_stats.stars_1 + EXCLUDED.stars_1,
+                stars_2 = market_rating_stats.stars_2 + EXCLUDED.stars_2,
+                stars_3 = market_rating_stats.stars_3 + EXCLUDED.stars_3,
+                stars_4 = market_rating_stats.stars_4 + EXCLUDED.stars_4,
+                stars_5 = market_rating_stats.stars_5 + EXCLUDED.stars_5
+        ), by_market AS (
+            INSERT INTO review_daily_market (day, market_id, review_count, rating_sum)
+            SELECT day, market_id, COUNT(*), SUM(rating)
+            FROM new_reviews
+            GROUP BY day, market_id
+            ON CONFLICT (market_id, day) DO UPDATE
+            SET review_count = review_daily_market.review_count + EXCLUDED.review_count,
+                rating_sum = review_daily_market.rating_sum + EXCLUDED.rating_sum
+        )
+        INSERT INTO review_daily_state (day, state, review_count, rating_sum)
+        SELECT day, state, COUNT(*), SUM(rating)
+        FROM new_reviews
+        GROUP BY day, state
+        ON CONFLICT (state, day) DO UPDATE
+        SET review_count = review_daily_state.review_count + EXCLUDED.review_count,
+            rating_sum = review_daily_state.rating_sum + EXCLUDED.rating_sum
+    """, (list(review_ids),))
+
 @app.route('/feedback', methods=['GET', 'POST'])
 @require_auth
 def feedback_page():
@@ -442,7 +1773,9 @@ def feedback_page():
                                 cur.execute("""
                                     INSERT INTO reviews (market_id, user_name, rating, review_text)
                                     VALUES (%s, %s, %s, %s)
+                                    RETURNING review_id
                                 """, (market['market_id'], user_name, rating, review_text))
+                                record_review_rollups(cur, [cur.fetchone()['review_id']])
                                 conn.commit()
                                 flash("✅ Отзыв успешно добавлен!", "success")
                     except Exception as e:
@@ -452,21 +1785,154 @@ def feedback_page():
                         conn.close()
     return render_template('feedback.html')
 
-@app.route('/delete', methods=['GET', 'POST'])
-@require_admin
-def delete_page():
-    if request.method == 'POST':
-        market_name = request.form.get('market_name', '').strip()
-        if not market_name:
-            flash("Введите название рынка", "error")
+BULK_REVIEWS_MAX_ROWS = int(os.getenv("BULK_REVIEWS_MAX_ROWS", "5000"))
+BULK_REVIEW_FIELDS = ('market_name', 'user_name', 'rating', 'review_text')
+
+def parse_bulk_reviews():
+    """Строки пакета из JSON ({"reviews": [...]} или список) либо CSV (файл file или тело text/csv)."""
+    if request.is_json:
+        payload = request.get_json()
+        rows = payload.get('reviews') if isinstance(payload, dict) else payload
+        if not isinstance(rows, list) or not all(isinstance(r, dict) for r in rows):
+            raise ValueError("Ожидается список отзывов")
+        return rows
+
+    upload = request.files.get('file')
+    raw = upload.read() if upload else request.get_data()
+    if not raw:
+        raise ValueError("Пустой пакет")
+    reader = csv.DictReader(io.StringIO(raw.decode('utf-8-sig')))
+    if not reader.fieldnames or 'market_name' not in reader.fieldnames:
+        raise ValueError(f"В CSV нужны колонки: {', '.join(BULK_REVIEW_FIELDS)}")
+    return list(reader)
+
+def parse_bulk_rating(value):
+    """Целый рейтинг из JSON-числа или строки из цифр; 4.9, true, "5.0" и прочее — None."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float):
+        return int(value) if value.is_integer() else None
+    if isinstance(value, str):
+        value = value.strip()
+        if value.isascii() and value.isdigit():
+            return int(value)
+    return None
+
+def validate_bulk_review(row):
+    """Возвращает (market_name, user_name, rating, review_text) или текст ошибки."""
+    market_name = str(row.get('market_name') or '').strip()
+    user_name = str(row.get('user_name') or '').strip()
+    if not market_name or not user_name:
+        return "Не заполнены market_name или user_name"
+    rating = parse_bulk_rating(row.get('rating'))
+    if rating is None or not (1 <= rating <= 5):
+        return "Рейтинг должен быть числом от 1 до 5"
+    review_text = str(row.get('review_text') or '').strip() or None
+    return market_name, user_name, rating, review_text
+
+@app.route('/reviews/bulk', methods=['POST'])
+@require_auth
+def bulk_reviews():
+    """
+    Пакетная загрузка отзывов (JSON или CSV с колонками market_name, user_name, rating, review_text).
+    Рынки ищутся одним запросом на весь пакет, отзывы вставляются одной командой,
+    сводки обновляются один раз. В ответе — результат по каждой строке.
+    """
+    try:
+        rows = parse_bulk_reviews()
+    except (ValueError, UnicodeDecodeError) as e:
+        return jsonify({'error': str(e)}), 400
+    if len(rows) > BULK_REVIEWS_MAX_ROWS:
+        return jsonify({'error': f"Не больше {BULK_REVIEWS_MAX_ROWS} отзывов за раз"}), 400
+
+    results = [{'row': i} for i in range(len(rows))]
+    valid = []
+    for result, row in zip(results, rows):
+        checked = validate_bulk_review(row)
+        if isinstance(checked, str):
+            result.update(status='error', error=checked)
         else:
-            conn = get_db_connection()
-            if conn:
-                try:
-                    with conn.cursor() as cur:
-                        cur.execute("DELETE FROM farmers_markets WHERE LOWER(TRIM(market_name)) = %s RETURNING market_id", (market_name.lower(),))
+            valid.append((result, checked))
+
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({'error': 'Ошибка подключения к БД'}), 503
+
+    try:
+        with conn.cursor() as cur:
+            names = sorted({checked[0].lower() for _, checked in valid})
+            market_ids = {}
+            if names:
+                cur.execute("""
+                    SELECT DISTINCT ON (LOWER(TRIM(market_name)))
+                           LOWER(TRIM(market_name)) AS name_key, market_id
+                    FROM farmers_markets
+                    WHERE LOWER(TRIM(market_name)) = ANY(%s)
+                    ORDER BY LOWER(TRIM(market_name)), market_id
+                """, (names,))
+                market_ids = {r['name_key']: r['market_id'] for r in cur.fetchall()}
+
+            to_insert = []
+            for result, (market_name, user_name, rating, review_text) in valid:
+                market_id = market_ids.get(market_name.lower())
+                if market_id is None:
+                    result.update(status='error', error="Рынок не найден")
+                else:
+                    to_insert.append((result, (market_id, user_name, rating, review_text)))
+
+            if to_insert:
+                inserted = execute_values(cur, """
+                    INSERT INTO reviews (market_id, user_name, rating, review_text)
+                    VALUES %s
+                    RETURNING review_id, market_id, user_name, rating, review_text
+                """, [values for _, values in to_insert], page_size=1000, fetch=True)
+                # Порядок строк RETURNING не гарантирован — сопоставляем по вставленным значениям
+                # (одинаковые строки пакета неразличимы, им достаются их review_id в любом порядке)
+                review_ids = {}
+                for row in sorted(inserted, key=lambda r: r['review_id']):
+                    key = (row['market_id'], row['user_name'], row['rating'], row['review_text'])
+                    review_ids.setdefault(key, deque()).append(row['review_id'])
+                for result, values in to_insert:
+                    result.update(status='created', review_id=review_ids[values].popleft(), market_id=values[0])
+                record_review_rollups(cur, [row['review_id'] for row in inserted])
+            conn.commit()
+    except Exception as e:
+        conn.rollback()
+        return jsonify({'error': f"Ошибка загрузки отзывов: {e}"}), 500
+    finally:
+        conn.close()
+
+    created = sum(1 for r in results if r['status'] == 'created')
+    return jsonify(created=created, failed=len(results) - created, results=results)
+
+@app.route('/delete', methods=['GET', 'POST'])
+@require_admin
+def delete_page():
+    if request.method == 'POST':
+        market_name = request.form.get('market_name', '').strip()
+        if not market_name:
+            flash("Введите название рынка", "error")
+        else:
+            conn = get_db_connection()
+            if conn:
+                try:
+                    with conn.cursor() as cur:
+                        # Удаляем и оставляем «надгробие» для дельта-выгрузок
+                        cur.execute("""
+                            WITH deleted AS (
+                                DELETE FROM farmers_markets
+                                WHERE LOWER(TRIM(market_name)) = %s
+                                RETURNING market_id, market_name
+                            )
+                            INSERT INTO market_tombstones (market_id, market_name)
+                            SELECT market_id, market_name FROM deleted
+                            RETURNING market_id
+                        """, (market_name.lower(),))
                         if cur.fetchone():
                             conn.commit()
+                            mark_autocomplete_stale()
                             flash(f"✅ Рынок '{market_name}' удалён.", "success")
                         else:
                             flash("❌ Рынок не найден.", "error")
@@ -477,6 +1943,19 @@ def delete_page():
                     conn.close()
     return render_template('delete.html')
 
+def refresh_market_facets(cur, market_ids):
+    """Пересобирает массивы продуктов и способов оплаты рынков в market_facets (в транзакции изменения рынка)."""
+    cur.execute("""
+        INSERT INTO market_facets (market_id, product_ids, payment_ids)
+        SELECT fm.market_id,
+               COALESCE((SELECT array_agg(product_id ORDER BY product_id) FROM market_products WHERE market_id = fm.market_id), '{}'),
+               COALESCE((SELECT array_agg(payment_id ORDER BY payment_id) FROM market_payments WHERE market_id = fm.market_id), '{}')
+        FROM farmers_markets fm
+        WHERE fm.market_id = ANY(%s)
+        ON CONFLICT (market_id) DO UPDATE
+        SET product_ids = EXCLUDED.product_ids, payment_ids = EXCLUDED.payment_ids
+    """, (list(market_ids),))
+
 @app.route('/add_market', methods=['GET', 'POST'])
 @require_admin
 def add_market():
@@ -542,8 +2021,8 @@ def add_market():
     try:
         with conn.cursor() as cur:
             cur.execute("""
-                INSERT INTO farmers_markets (market_name, street, city, state, zip, x, y, location)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                INSERT INTO farmers_markets (market_name, street, city, state, zip, x, y, location, updated_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, now())
                 RETURNING market_id
             """, (market_name, street, city, state, zip_code, x, y, location))
             market_id = cur.fetchone()['market_id']
@@ -553,6 +2032,7 @@ def add_market():
 
             for pid in payment_ids:
                 cur.execute("INSERT INTO market_payments (market_id, payment_id) VALUES (%s, %s)", (market_id, int(pid)))
+            refresh_market_facets(cur, [market_id])
 
             if len(social_ids) == len(social_urls):
                 for sn_id, url in zip(social_ids, social_urls):
@@ -563,6 +2043,7 @@ def add_market():
                     """, (market_id, int(sn_id), url_clean))
 
             conn.commit()
+            mark_autocomplete_stale()
             flash(f"✅ Рынок '{market_name}' успешно добавлен!", "success")
             return redirect(url_for('markets'))
 
@@ -594,23 +2075,17 @@ def import_markets():
         return redirect(url_for('import_markets'))
 
     try:
-        # Сохраняем временный файл
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.xlsx') as tmp:
-            file.save(tmp.name)
-            tmp_path = tmp.name
+        # Читаем загрузку в память один раз: из этих же байтов читает pandas и грузится MinIO
+        file_bytes = file.read()
 
         # Читаем Excel
-        df = pd.read_excel(tmp_path, dtype=str).fillna('')
+        df = pd.read_excel(io.BytesIO(file_bytes), dtype=str).fillna('')
         # Обязательные колонки
         required_cols = {'market_name', 'street', 'city', 'state', 'zip'}
         if not required_cols.issubset(df.columns):
             missing = required_cols - set(df.columns)
             flash(f"В файле отсутствуют обязательные колонки: {', '.join(missing)}", "error")
-            os.unlink(tmp_path)  # удаляем временный файл
             return redirect(url_for('import_markets'))
-        # После успешного импорта — сохраняем исходный файл в MinIO
-        save_file_to_minio_and_log(tmp_path, filename, operation_type, user_ip)
-        os.unlink(tmp_path)  # удаляем временный файл
 
         added = 0
         errors = []
@@ -627,6 +2102,9 @@ def import_markets():
 
         with conn.cursor() as cur:
             for idx, row in df.iterrows():
+                # Ошибка в строке откатывает только её: без точки сохранения транзакция прервалась бы
+                # и commit молча отменил бы все строки
+                cur.execute("SAVEPOINT import_row")
                 try:
                     market_name = row['market_name'].strip()
                     street = row['street'].strip()
@@ -650,8 +2128,8 @@ def import_markets():
 
                     # Вставка рынка
                     cur.execute("""
-                        INSERT INTO farmers_markets (market_name, street, city, state, zip, x, y, location)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                        INSERT INTO farmers_markets (market_name, street, city, state, zip, x, y, location, updated_at)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, now())
                         RETURNING market_id
                     """, (market_name, street, city, state, zip_code, x, y, location))
                     market_id = cur.fetchone()['market_id']
@@ -671,6 +2149,7 @@ def import_markets():
                             if p_key in payments_map:
                                 cur.execute("INSERT INTO market_payments (market_id, payment_id) VALUES (%s, %s)",
                                             (market_id, payments_map[p_key]))
+                    refresh_market_facets(cur, [market_id])
 
                     # Обработка соцсетей
                     if 'socials' in row and row['socials']:
@@ -686,12 +2165,19 @@ def import_markets():
                                         VALUES (%s, %s, %s)
                                     """, (market_id, socials_map[sn_key], url))
 
+                    cur.execute("RELEASE SAVEPOINT import_row")
                     added += 1
 
                 except Exception as e:
+                    cur.execute("ROLLBACK TO SAVEPOINT import_row")
                     errors.append(f"Строка {idx + 2}: {str(e)[:100]}")
 
             conn.commit()
+            mark_autocomplete_stale()
+
+        # После успешного импорта — сохраняем исходный файл в MinIO (в фоне)
+        if added:
+            archive_file(file_bytes, filename, operation_type, user_ip)
 
         if errors:
             flash(f"✅ Добавлено рынков: {added}. Ошибки ({len(errors)}):<br>" + "<br>".join(errors), "error")
@@ -843,7 +2329,8 @@ def edit_market():
             # Обновляем основную запись
             cur.execute("""
                 UPDATE farmers_markets
-                SET street = %s, city = %s, state = %s, zip = %s, x = %s, y = %s, location = %s
+                SET street = %s, city = %s, state = %s, zip = %s, x = %s, y = %s, location = %s,
+                    updated_at = now()
                 WHERE market_id = %s
             """, (street, city, state, zip_code, x, y, location, market_id))
 
@@ -858,6 +2345,7 @@ def edit_market():
 
             for pid in payment_ids:
                 cur.execute("INSERT INTO market_payments (market_id, payment_id) VALUES (%s, %s)", (market_id, pid))
+            refresh_market_facets(cur, [market_id])
 
             if len(social_ids) == len(social_urls):
                 for sn_id, url in zip(social_ids, social_urls):
@@ -868,6 +2356,7 @@ def edit_market():
                     """, (market_id, sn_id, url_clean))
 
             conn.commit()
+            mark_autocomplete_stale()
             flash("✅ Рынок успешно обновлён!", "success")
             return redirect(url_for('markets'))
 
@@ -904,6 +2393,285 @@ if os.path.exists(noto_emoji_path):
 else:
     emoji_font = base_font
 
+# Эмодзи, которые нужно выводить шрифтом emoji_font
+EMOJI_PATTERN = re.compile(
+    "["
+    "\U0001F600-\U0001F64F"  # эмоции
+    "\U0001F300-\U0001F5FF"  # символы и пиктограммы
+    "\U0001F680-\U0001F6FF"  # транспорт
+    "\U0001F1E0-\U0001F1FF"  # флаги
+    "\U00002702-\U000027B0"  # другие
+    "\U000024C2-\U0001F251"
+    "]+", flags=re.UNICODE
+)
+
+def build_pdf_styles():
+    """Стили PDF. Строятся один раз при загрузке модуля и переиспользуются всеми запросами."""
+    return {
+        # Стиль для обычного текста
+        'normal': ParagraphStyle(
+            'Normal',
+            fontName=base_font,
+            fontSize=11,
+            leading=14
+        ),
+        'heading1': ParagraphStyle('Heading1', fontName=base_font, fontSize=16, alignment=TA_CENTER),
+        'heading2': ParagraphStyle('H2', fontName=base_font, fontSize=14),
+        'stamp': ParagraphStyle(
+            'Stamp',
+            fontName=base_font,
+            fontSize=10,
+            alignment=TA_CENTER,
+            textColor=colors.grey,
+            borderWidth=1,
+            borderColor=colors.grey,
+            borderPadding=8,
+            borderRadius=5
+        )
+    }
+
+PDF_STYLES = build_pdf_styles()
+
+def make_mixed_text(text):
+    """Заменяет эмодзи на <font> с другим шрифтом"""
+    parts = []
+    last_end = 0
+    for match in EMOJI_PATTERN.finditer(text):
+        if match.start() > last_end:
+            parts.append(f'<font name="{base_font}">{text[last_end:match.start()]}</font>')
+        parts.append(f'<font name="{emoji_font}">{match.group()}</font>')
+        last_end = match.end()
+    if last_end < len(text):
+        parts.append(f'<font name="{base_font}">{text[last_end:]}</font>')
+    return ''.join(parts)
+
+# Пакетная выгрузка PDF: максимум рынков в одном архиве и число процессов для рендеринга
+PDF_BATCH_LIMIT = int(os.getenv("PDF_BATCH_LIMIT", "500"))
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(os.cpu_count() or 1)))
+
+# Кэш готовых PDF на локальном диске: ключ — хеш данных рынка и отзывов
+PDF_CACHE_DIR = os.getenv("PDF_CACHE_DIR", os.path.join(tempfile.gettempdir(), 'pdf-cache'))
+# Сколько секунд кэшированный PDF считается актуальным (штамп времени может устареть на столько же)
+PDF_CACHE_TTL = int(os.getenv("PDF_CACHE_TTL", "3600"))
+
+pdf_cache_pruned_at = 0.0
+
+def format_review(r):
+    stars = "★" * r['rating'] + "☆" * (5 - r['rating'])
+    date_str = r['created_at'].strftime('%d.%m.%Y')
+    return {"user": r['user_name'], "stars": stars, "rating": r['rating'], "date": date_str, "text": r['review_text'] or ""}
+
+def build_market_pdf_dict(row, products, payments, socials, reviews, summary=None):
+    summary = summary or EMPTY_REVIEW_SUMMARY
+    return {
+        "name": row['market_name'],
+        "address": f"{row['street']}, {row['city']}, {row['state']} {row['zip']}",
+        "coords": f"({row['x']}, {row['y']})" if row['x'] is not None and row['y'] is not None else "не указаны",
+        "location": row['location'] or "—",
+        "products": products,
+        "payments": payments,
+        "socials": socials,
+        "reviews": reviews,
+        "review_count": max(summary['review_count'], len(reviews)),
+        "avg_rating": summary['avg_rating']
+    }
+
+def fetch_market_pdf_data(cur, market_name):
+    """Собирает данные рынка для PDF или возвращает None, если рынок не найден."""
+    cur.execute("SELECT * FROM farmers_markets WHERE LOWER(TRIM(market_name)) = %s", (market_name.lower(),))
+    row = cur.fetchone()
+    if not row:
+        return None
+
+    # Сбор данных
+    cur.execute("SELECT p.product_name FROM market_products mp JOIN products p ON mp.product_id = p.product_id WHERE mp.market_id = %s ORDER BY p.product_name", (row['market_id'],))
+    products = [r['product_name'] for r in cur.fetchall()]
+
+    cur.execute("SELECT py.payment_name FROM market_payments mp JOIN payment_methods py ON mp.payment_id = py.payment_id WHERE mp.market_id = %s ORDER BY py.payment_name", (row['market_id'],))
+    payments = [r['payment_name'] for r in cur.fetchall()]
+
+    cur.execute("SELECT sn.social_networks, msl.url FROM market_social_links msl JOIN social_networks sn ON msl.social_network_id = sn.social_network_id WHERE msl.market_id = %s ORDER BY sn.social_networks", (row['market_id'],))
+    socials = [{"name": r['social_networks'], "url": r['url'] or "нет ссылки"} for r in cur.fetchall()]
+
+    review_rows, _ = fetch_reviews_page(cur, row['market_id'], limit=PDF_REVIEW_LIMIT)
+    reviews = [format_review(r) for r in review_rows]
+    summary = fetch_review_summaries(cur, [row['market_id']]).get(row['market_id'])
+
+    return build_market_pdf_dict(row, products, payments, socials, reviews, summary)
+
+def fetch_markets_pdf_data(cur, where_sql, params):
+    """
+    Набор рынков для пакетного PDF: по одному запросу на каждую таблицу
+    вместо пяти запросов на рынок. where_sql — условие по farmers_markets.
+    """
+    cur.execute(f"""
+        SELECT * FROM farmers_markets
+        WHERE {where_sql}
+        ORDER BY market_name, market_id
+        LIMIT %s
+    """, (*params, PDF_BATCH_LIMIT))
+    rows = cur.fetchall()
+    if not rows:
+        return []
+    market_ids = [row['market_id'] for row in rows]
+
+    def grouped(query):
+        cur.execute(query, (market_ids,))
+        groups = {}
+        for r in cur.fetchall():
+            groups.setdefault(r['market_id'], []).append(r)
+        return groups
+
+    products = grouped("SELECT mp.market_id, p.product_name FROM market_products mp JOIN products p ON mp.product_id = p.product_id WHERE mp.market_id = ANY(%s) ORDER BY mp.market_id, p.product_name")
+    payments = grouped("SELECT mp.market_id, py.payment_name FROM market_payments mp JOIN payment_methods py ON mp.payment_id = py.payment_id WHERE mp.market_id = ANY(%s) ORDER BY mp.market_id, py.payment_name")
+    socials = grouped("SELECT msl.market_id, sn.social_networks, msl.url FROM market_social_links msl JOIN social_networks sn ON msl.social_network_id = sn.social_network_id WHERE msl.market_id = ANY(%s) ORDER BY msl.market_id, sn.social_networks")
+    # Последние PDF_REVIEW_LIMIT отзывов каждого рынка — по индексу, без чтения всех отзывов
+    cur.execute("""
+        SELECT r.*
+        FROM unnest(%s::int[]) AS m(market_id)
+        CROSS JOIN LATERAL (
+            SELECT market_id, review_id, user_name, rating, review_text, created_at
+            FROM reviews
+            WHERE market_id = m.market_id
+            ORDER BY created_at DESC, review_id DESC
+            LIMIT %s
+        ) r
+    """, (market_ids, PDF_REVIEW_LIMIT))
+    reviews = {}
+    for r in cur.fetchall():
+        reviews.setdefault(r['market_id'], []).append(r)
+    summaries = fetch_review_summaries(cur, market_ids)
+
+    return [
+        build_market_pdf_dict(
+            row,
+            [r['product_name'] for r in products.get(row['market_id'], [])],
+            [r['payment_name'] for r in payments.get(row['market_id'], [])],
+            [{"name": r['social_networks'], "url": r['url'] or "нет ссылки"} for r in socials.get(row['market_id'], [])],
+            [format_review(r) for r in reviews.get(row['market_id'], [])],
+            summaries.get(row['market_id'])
+        )
+        for row in rows
+    ]
+
+def market_content_hash(market):
+    """Хеш всего, что попадает в PDF: поля рынка, продукты, оплата, соцсети и отзывы."""
+    payload = json.dumps(market, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def pdf_cache_path(content_hash):
+    return os.path.join(PDF_CACHE_DIR, f"{content_hash}.pdf")
+
+def get_cached_pdf(content_hash):
+    """Возвращает байты PDF из кэша или None, если его нет или он старше PDF_CACHE_TTL."""
+    path = pdf_cache_path(content_hash)
+    try:
+        if time.time() - os.path.getmtime(path) > PDF_CACHE_TTL:
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+def prune_pdf_cache():
+    """Удаляет просроченные PDF. Выполняется не чаще раза за PDF_CACHE_TTL."""
+    global pdf_cache_pruned_at
+    now = time.time()
+    if now - pdf_cache_pruned_at < PDF_CACHE_TTL:
+        return
+    pdf_cache_pruned_at = now
+    try:
+        with os.scandir(PDF_CACHE_DIR) as entries:
+            for entry in entries:
+                try:
+                    if now - entry.stat().st_mtime > PDF_CACHE_TTL:
+                        os.unlink(entry.path)
+                except OSError:
+                    pass
+    except OSError:
+        pass
+
+def store_cached_pdf(content_hash, pdf_bytes):
+    # Пишем во временный файл и атомарно переименовываем — параллельные запросы не увидят половину файла
+    try:
+        os.makedirs(PDF_CACHE_DIR, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=PDF_CACHE_DIR, delete=False, suffix='.tmp') as tmp:
+            tmp.write(pdf_bytes)
+        os.replace(tmp.name, pdf_cache_path(content_hash))
+    except OSError as e:
+        print(f"Не удалось сохранить PDF в кэш: {e}")
+    prune_pdf_cache()
+
+def render_market_pdf(market):
+    """Строит PDF карточки рынка средствами reportlab и возвращает байты."""
+    # Генерация PDF с эмодзи
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=0.8*inch, bottomMargin=0.6*inch)
+    normal_style = PDF_STYLES['normal']
+
+    title = make_mixed_text("🌾 Фермерские рынки")
+    story = [Paragraph(title, PDF_STYLES['heading1']), Spacer(1, 12)]
+
+    story.append(Paragraph(market['name'], PDF_STYLES['heading2']))
+    story.append(Spacer(1, 12))
+
+    info_lines = [
+        make_mixed_text(f"📍 Адрес: {market['address']}"),
+        make_mixed_text(f"🌐 Координаты: {market['coords']}"),
+        make_mixed_text(f"📌 Местоположение: {market['location']}")
+    ]
+    for line in info_lines:
+        story.append(Paragraph(line, normal_style))
+        story.append(Spacer(1, 6))
+
+    story.append(Spacer(1, 12))
+
+    def add_section(title_text, items):
+        if items:
+            title_with_emoji = make_mixed_text(title_text)
+            story.append(Paragraph(title_with_emoji, normal_style))
+            for item in items:
+                story.append(Paragraph(f" • {item}", normal_style))
+            story.append(Spacer(1, 8))
+
+    add_section("🍎 Продукты", market['products'])
+    add_section("💳 Способы оплаты", market['payments'])
+
+    if market['socials']:
+        title = make_mixed_text("🌐 Социальные сети")
+        story.append(Paragraph(title, normal_style))
+        for s in market['socials']:
+            story.append(Paragraph(f" • {s['name']}: {s['url']}", normal_style))
+        story.append(Spacer(1, 8))
+
+    if market['reviews']:
+        title = make_mixed_text("💬 Отзывы")
+        story.append(Paragraph(title, normal_style))
+        review_count = market.get('review_count', len(market['reviews']))
+        if review_count > len(market['reviews']):
+            summary = f"Показаны последние {len(market['reviews'])} из {review_count}"
+            if market.get('avg_rating') is not None:
+                summary += f", средний рейтинг {market['avg_rating']:.2f}"
+            story.append(Paragraph(summary, normal_style))
+        for r in market['reviews']:
+            review_text = f"[{r['user']}] {r['stars']} ({r['date']})"
+            if r['text']:
+                review_text += f"<br/>&nbsp;&nbsp;&nbsp;&nbsp;«{r['text']}»"
+            story.append(Paragraph(review_text, normal_style))
+            story.append(Spacer(1, 6))
+    else:
+        story.append(Paragraph(make_mixed_text("💬 Отзывов нет."), normal_style))
+        story.append(Spacer(1, 8))
+
+    story.append(Spacer(1, 24))
+    moscow_time = datetime.now(ZoneInfo("Europe/Moscow"))
+    now = moscow_time.strftime("%d.%m.%Y %H:%M:%S")
+    stamp_text = make_mixed_text(f"Информация верна на {now}")
+    story.append(Paragraph(stamp_text, PDF_STYLES['stamp']))
+
+    doc.build(story)
+    return buffer.getvalue()
+
 @app.route('/download_pdf')
 @require_auth
 def download_pdf():
@@ -922,174 +2690,539 @@ def download_pdf():
 
     try:
         with conn.cursor() as cur:
-            cur.execute("SELECT * FROM farmers_markets WHERE LOWER(TRIM(market_name)) = %s", (market_name.lower(),))
-            row = cur.fetchone()
-            if not row:
+            market = fetch_market_pdf_data(cur, market_name)
+            if not market:
                 flash("Рынок не найден", "error")
                 return redirect(url_for('detail_page'))
 
-            # Сбор данных
-            cur.execute("SELECT p.product_name FROM market_products mp JOIN products p ON mp.product_id = p.product_id WHERE mp.market_id = %s ORDER BY p.product_name", (row['market_id'],))
-            products = [r['product_name'] for r in cur.fetchall()]
-
-            cur.execute("SELECT py.payment_name FROM market_payments mp JOIN payment_methods py ON mp.payment_id = py.payment_id WHERE mp.market_id = %s ORDER BY py.payment_name", (row['market_id'],))
-            payments = [r['payment_name'] for r in cur.fetchall()]
-
-            cur.execute("SELECT sn.social_networks, msl.url FROM market_social_links msl JOIN social_networks sn ON msl.social_network_id = sn.social_network_id WHERE msl.market_id = %s ORDER BY sn.social_networks", (row['market_id'],))
-            socials = [{"name": r['social_networks'], "url": r['url'] or "нет ссылки"} for r in cur.fetchall()]
-
-            cur.execute("SELECT user_name, rating, review_text, created_at FROM reviews WHERE market_id = %s ORDER BY created_at DESC", (row['market_id'],))
-            reviews = []
-            for r in cur.fetchall():
-                stars = "★" * r['rating'] + "☆" * (5 - r['rating'])
-                date_str = r['created_at'].strftime('%d.%m.%Y')
-                reviews.append({"user": r['user_name'], "stars": stars, "rating": r['rating'], "date": date_str, "text": r['review_text'] or ""})
-
-            market = {
-                "name": row['market_name'],
-                "address": f"{row['street']}, {row['city']}, {row['state']} {row['zip']}",
-                "coords": f"({row['x']}, {row['y']})" if row['x'] is not None and row['y'] is not None else "не указаны",
-                "location": row['location'] or "—",
-                "products": products,
-                "payments": payments,
-                "socials": socials,
-                "reviews": reviews
-            }
-
-        # Генерация PDF с эмодзи
-        buffer = io.BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=0.8*inch, bottomMargin=0.6*inch)
-        styles = getSampleStyleSheet()
+        content_hash = market_content_hash(market)
+        original_filename = pdf_filename(market_name)
 
-        # Стиль для обычного текста
-        normal_style = ParagraphStyle(
-            'Normal',
-            fontName=base_font,
-            fontSize=11,
-            leading=14
+        # Уже сохранённый в MinIO PDF того же содержимого отдаётся мимо воркера
+        if FILE_DELIVERY_MODE != 'proxy':
+            try:
+                artifact = find_archived_artifact(operation_type, f"pdf:{content_hash}", PDF_CACHE_TTL)
+                if artifact:
+                    log_file_operation(original_filename, artifact['hashed_filename'], operation_type,
+                                       user_ip, artifact['content_key'])
+                    return serve_archived_file(artifact['hashed_filename'], original_filename, 'application/pdf',
+                                               artifact['cold_key'])
+            except Exception as e:
+                print(f"Не удалось отдать PDF из MinIO: {e}")
+
+        # Неизменившийся рынок отдаём из кэша, не вызывая reportlab
+        pdf_bytes = get_cached_pdf(content_hash)
+        if pdf_bytes is None:
+            pdf_bytes = render_market_pdf(market)
+            store_cached_pdf(content_hash, pdf_bytes)
+
+        # Сохраняем в MinIO и логируем — не задерживая ответ и без временных файлов
+        archive_file(pdf_bytes, original_filename, operation_type, user_ip,
+                     content_key=f"pdf:{content_hash}")
+
+        # Отправляем пользователю
+        return send_file(io.BytesIO(pdf_bytes), mimetype='application/pdf',
+                         as_attachment=True, download_name=original_filename)
+
+    except Exception as e:
+        flash(f"Ошибка генерации PDF: {e}", "error")
+        return redirect(url_for('detail_page', name=market_name))
+    finally:
+        conn.close()
+
+# Как отдаются файлы, уже лежащие в MinIO:
+#   proxy     — потоком через воркер gunicorn;
+#   presigned — редирект на короткоживущую ссылку MinIO (MINIO_PUBLIC_ENDPOINT должен быть доступен браузеру);
+#   nginx     — X-Accel-Redirect: файл из MinIO забирает сам nginx (location /minio-internal/).
+FILE_DELIVERY_MODE = os.getenv("FILE_DELIVERY_MODE", "proxy")
+PRESIGNED_URL_TTL = int(os.getenv("PRESIGNED_URL_TTL", "300"))
+MINIO_PUBLIC_ENDPOINT = os.getenv("MINIO_PUBLIC_ENDPOINT", MINIO_ENDPOINT)
+MINIO_PUBLIC_SECURE = os.getenv("MINIO_PUBLIC_SECURE", "0") == "1"
+NGINX_MINIO_LOCATION = "/minio-internal"
+# Эти файлы доступны всем пользователям; загруженные импорты и прочее — только администраторам
+SHARED_ARTIFACT_TYPES = ('export_prebuilt', 'pdf_export', 'pdf_batch_export')
+
+presign_client = None
+
+def get_presign_client():
+    """Клиент только для подписи ссылок на публичный адрес MinIO: по сети не обращается."""
+    global presign_client
+    if presign_client is None:
+        presign_client = Minio(
+            MINIO_PUBLIC_ENDPOINT,
+            access_key=MINIO_ACCESS_KEY,
+            secret_key=MINIO_SECRET_KEY,
+            secure=MINIO_PUBLIC_SECURE,
+            region=MINIO_REGION
         )
+    return presign_client
+
+def presigned_download_url(hashed_filename, download_name, mimetype, client=None):
+    return (client or get_presign_client()).presigned_get_object(
+        MINIO_BUCKET_NAME, hashed_filename,
+        expires=timedelta(seconds=PRESIGNED_URL_TTL),
+        response_headers={
+            'response-content-type': mimetype,
+            'response-content-disposition': f"attachment; filename*=UTF-8''{quote(download_name)}"
+        }
+    )
 
-        # Стиль для заголовков со смайликами
-        def make_mixed_text(text):
-            """Заменяет эмодзи на <font> с другим шрифтом"""
-            import re
-            emoji_pattern = re.compile(
-                "["
-                "\U0001F600-\U0001F64F"  # эмоции
-                "\U0001F300-\U0001F5FF"  # символы и пиктограммы
-                "\U0001F680-\U0001F6FF"  # транспорт
-                "\U0001F1E0-\U0001F1FF"  # флаги
-                "\U00002702-\U000027B0"  # другие
-                "\U000024C2-\U0001F251" 
-                "]+", flags=re.UNICODE
-            )
-            parts = []
-            last_end = 0
-            for match in emoji_pattern.finditer(text):
-                if match.start() > last_end:
-                    parts.append(f'<font name="{base_font}">{text[last_end:match.start()]}</font>')
-                parts.append(f'<font name="{emoji_font}">{match.group()}</font>')
-                last_end = match.end()
-            if last_end < len(text):
-                parts.append(f'<font name="{base_font}">{text[last_end:]}</font>')
-            return ''.join(parts)
-
-        title = make_mixed_text("🌾 Фермерские рынки")
-        heading1_style = ParagraphStyle('Heading1', fontName=base_font, fontSize=16, alignment=TA_CENTER)
-        story = [Paragraph(title, heading1_style), Spacer(1, 12)]
-
-        story.append(Paragraph(market['name'], ParagraphStyle('H2', fontName=base_font, fontSize=14)))
-        story.append(Spacer(1, 12))
-
-        info_lines = [
-            make_mixed_text(f"📍 Адрес: {market['address']}"),
-            make_mixed_text(f"🌐 Координаты: {market['coords']}"),
-            make_mixed_text(f"📌 Местоположение: {market['location']}")
-        ]
-        for line in info_lines:
-            story.append(Paragraph(line, normal_style))
-            story.append(Spacer(1, 6))
+def find_archived_artifact(operation_type, content_key, max_age_seconds):
+    """Последний файл операции с данным content_key не старше max_age_seconds (cold_key — если он в холодном хранилище)."""
+    conn = get_db_connection()
+    if not conn:
+        return None
 
-        story.append(Spacer(1, 12))
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT l.hashed_filename, l.original_filename, l.content_key, l.created_at, o.cold_key
+                FROM file_logs l
+                JOIN file_objects o ON o.hashed_filename = l.hashed_filename
+                WHERE l.operation_type = %s
+                  AND l.content_key = %s
+                  AND l.created_at > now() - make_interval(secs => %s)
+                ORDER BY l.created_at DESC
+                LIMIT 1
+            """, (operation_type, content_key, max_age_seconds))
+            return cur.fetchone()
+    finally:
+        conn.close()
 
-        def add_section(title_text, items):
-            if items:
-                title_with_emoji = make_mixed_text(title_text)
-                story.append(Paragraph(title_with_emoji, normal_style))
-                for item in items:
-                    story.append(Paragraph(f" • {item}", normal_style))
-                story.append(Spacer(1, 8))
+def serve_archived_file(hashed_filename, download_name, mimetype, cold_key=None):
+    """
+    Отдаёт объект из MinIO способом FILE_DELIVERY_MODE.
+    Объект в холодном хранилище (cold_key) сначала возвращается в горячее.
+    """
+    if cold_key:
+        restore_cold_object(hashed_filename)
 
-        add_section("🍎 Продукты", market['products'])
-        add_section("💳 Способы оплаты", market['payments'])
+    if FILE_DELIVERY_MODE == 'presigned':
+        return redirect(presigned_download_url(hashed_filename, download_name, mimetype))
 
-        if market['socials']:
-            title = make_mixed_text("🌐 Социальные сети")
-            story.append(Paragraph(title, normal_style))
-            for s in market['socials']:
-                story.append(Paragraph(f" • {s['name']}: {s['url']}", normal_style))
-            story.append(Spacer(1, 8))
+    if FILE_DELIVERY_MODE == 'nginx':
+        # Подпись — для внутреннего адреса MinIO, с которым работает nginx
+        url = urlsplit(presigned_download_url(hashed_filename, download_name, mimetype, get_minio_client()))
+        response = app.response_class(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = f"{NGINX_MINIO_LOCATION}{url.path}?{url.query}"
+        return response
 
-        if market['reviews']:
-            title = make_mixed_text("💬 Отзывы")
-            story.append(Paragraph(title, normal_style))
-            for r in market['reviews']:
-                review_text = f"[{r['user']}] {r['stars']} ({r['date']})"
-                if r['text']:
-                    review_text += f"<br/>&nbsp;&nbsp;&nbsp;&nbsp;«{r['text']}»"
-                story.append(Paragraph(review_text, normal_style))
-                story.append(Spacer(1, 6))
-        else:
-            story.append(Paragraph(make_mixed_text("💬 Отзывов нет."), normal_style))
-            story.append(Spacer(1, 8))
+    obj = get_minio_client().get_object(MINIO_BUCKET_NAME, hashed_filename)
+    try:
+        response = send_file(obj, mimetype=mimetype, as_attachment=True, download_name=download_name)
+    except Exception:
+        obj.close()
+        obj.release_conn()
+        raise
 
-        story.append(Spacer(1, 24))
-        moscow_time = datetime.now(ZoneInfo("Europe/Moscow"))
-        now = moscow_time.strftime("%d.%m.%Y %H:%M:%S")
-        stamp_text = make_mixed_text(f"Информация верна на {now}")
-        stamp_style = ParagraphStyle(
-            'Stamp',
-            fontName=base_font,
-            fontSize=10,
-            alignment=TA_CENTER,
-            textColor=colors.grey,
-            borderWidth=1,
-            borderColor=colors.grey,
-            borderPadding=8,
-            borderRadius=5
-        )
-        story.append(Paragraph(stamp_text, stamp_style))
+    @response.call_on_close
+    def release_object():
+        obj.close()
+        obj.release_conn()
 
-        doc.build(story)
-        buffer.seek(0)
+    return response
 
-        # Сохраняем PDF во временный файл
-        original_filename = f"Рынок_{market_name.replace(' ', '_')}.pdf"
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp:
-            tmp.write(buffer.getvalue())
-            tmp_path = tmp.name
+class ZipStream(io.RawIOBase):
+    """Приёмник для zipfile без seek: накапливает записанные байты до следующего pop()."""
 
-        # Сохраняем в MinIO и логируем
-        save_file_to_minio_and_log(tmp_path, original_filename, operation_type, user_ip)
+    def __init__(self):
+        self.chunks = []
 
-        # Отправляем пользователю
-        response = send_file(tmp_path, as_attachment=True, download_name=original_filename)
+    def writable(self):
+        return True
 
-        @response.call_on_close
-        def remove_file():
-            try:
-                os.unlink(tmp_path)
-            except:
-                pass
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
 
-        return response
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+def pdf_filename(market_name):
+    return f"Рынок_{market_name.replace(' ', '_')}.pdf"
+
+def iter_batch_pdfs(markets):
+    """
+    Отдаёт (market, pdf_bytes) по мере готовности: сначала из кэша,
+    остальные строятся параллельно в пуле процессов.
+    """
+    pending = []
+    for market in markets:
+        content_hash = market_content_hash(market)
+        pdf_bytes = get_cached_pdf(content_hash)
+        if pdf_bytes is None:
+            pending.append((market, content_hash))
+        else:
+            yield market, pdf_bytes
+
+    if not pending:
+        return
+
+    pool = ProcessPoolExecutor(max_workers=min(PDF_WORKERS, len(pending)))
+    try:
+        futures = {pool.submit(render_market_pdf, market): (market, content_hash) for market, content_hash in pending}
+        for future in as_completed(futures):
+            market, content_hash = futures[future]
+            pdf_bytes = future.result()
+            store_cached_pdf(content_hash, pdf_bytes)
+            yield market, pdf_bytes
+    finally:
+        # Клиент мог закрыть соединение — не достраиваем оставшиеся PDF
+        pool.shutdown(wait=False, cancel_futures=True)
+
+@app.route('/download_pdf_batch')
+@require_auth
+def download_pdf_batch():
+    """
+    Архив PDF для нескольких рынков: по списку названий (names, можно несколько
+    или через перевод строки) либо по фильтру mode=city|state|zip и q, как в поиске.
+    Архив отдаётся потоком по мере построения PDF.
+    """
+    names = [n.strip().lower() for value in request.args.getlist('names') for n in value.splitlines() if n.strip()]
+    mode = request.args.get('mode', '')
+    q = request.args.get('q', '').strip()
+    facets = parse_search_facets(request.args)
+
+    if names:
+        where_sql, params = "LOWER(TRIM(market_name)) = ANY(%s)", (names,)
+        search_url = url_for('search_page')
+    elif (q and mode in SEARCH_MODES) or (not q and any(facets.values())):
+        # Тот же набор рынков, что на странице поиска: фильтр по mode/q и выбранные фасеты
+        conditions, params = [], []
+        if q:
+            conditions.append(f"LOWER(TRIM({mode})) = %s")
+            params.append(q.lower())
+        for name, ids in facets.items():
+            if ids:
+                conditions.append(f"market_id IN (SELECT market_id FROM market_facets WHERE {SEARCH_FACETS[name][0]} @> %s::int[])")
+                params.append(ids)
+        where_sql, params = " AND ".join(conditions), tuple(params)
+        search_url = url_for('search_page', mode=mode, q=q, **facets)
+    else:
+        flash("Укажите названия рынков или фильтр поиска", "error")
+        return redirect(url_for('search_page'))
+
+    user_ip = request.environ.get('HTTP_X_REAL_IP') or request.remote_addr
+
+    conn = get_db_connection()
+    if not conn:
+        flash("Ошибка подключения к БД", "error")
+        return redirect(url_for('search_page'))
 
+    try:
+        with conn.cursor() as cur:
+            # Архив не обрезается молча: если рынков больше PDF_BATCH_LIMIT, поиск нужно уточнить
+            cur.execute(f"""
+                SELECT COUNT(*) AS found FROM (SELECT 1 FROM farmers_markets WHERE {where_sql} LIMIT %s) c
+            """, (*params, PDF_BATCH_LIMIT + 1))
+            if cur.fetchone()['found'] > PDF_BATCH_LIMIT:
+                flash(f"Найдено больше {PDF_BATCH_LIMIT} рынков — архив PDF собирается не больше чем для "
+                      f"{PDF_BATCH_LIMIT}. Уточните поиск", "error")
+                return redirect(search_url)
+            markets = fetch_markets_pdf_data(cur, where_sql, params)
     except Exception as e:
         flash(f"Ошибка генерации PDF: {e}", "error")
-        return redirect(url_for('detail_page', name=market_name))
+        return redirect(url_for('search_page'))
     finally:
         conn.close()
 
+    if not markets:
+        flash("Рынки не найдены", "error")
+        return redirect(url_for('search_page'))
+
+    original_filename = f"рынки_pdf_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+
+    def generate():
+        stream = ZipStream()
+        pdfs = iter_batch_pdfs(markets)
+        # Копия архива для MinIO копится в памяти (крупная — на диске), пользователь получает его потоком
+        archive = tempfile.SpooledTemporaryFile(max_size=MINIO_PART_SIZE)
+        archived = False
+        try:
+            used_names = {}
+            with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+                for market, pdf_bytes in pdfs:
+                    filename = pdf_filename(market['name'])
+                    used_names[filename] = used_names.get(filename, 0) + 1
+                    if used_names[filename] > 1:
+                        filename = filename[:-4] + f"_{used_names[filename]}.pdf"
+                    zf.writestr(filename, pdf_bytes)
+                    chunk = stream.pop()
+                    archive.write(chunk)
+                    yield chunk
+            chunk = stream.pop()
+            archive.write(chunk)
+            yield chunk
+            length = archive.tell()
+            archive_file(archive, original_filename, 'pdf_batch_export', user_ip, length=length)
+            archived = True
+        finally:
+            pdfs.close()
+            if not archived:
+                archive.close()
+
+    response = app.response_class(generate(), mimetype='application/zip')
+    quoted = quote(original_filename)
+    response.headers['Content-Disposition'] = f"attachment; filename=markets_pdf.zip; filename*=UTF-8''{quoted}"
+    return response
+
+# Типы колонок mv_markets_export: читаются из схемы один раз на процесс
+export_column_types = None
+
+NUMERIC_PG_TYPES = ('smallint', 'integer', 'bigint', 'numeric', 'real', 'double precision')
+
+# Ширина колонок в выгрузке (по умолчанию — EXPORT_DEFAULT_WIDTH)
+EXPORT_COLUMN_WIDTHS = {
+    'market_name': 40,
+    'street': 30,
+    'city': 20,
+    'state': 20,
+    'zip': 10,
+    'location': 40,
+    'products': 60,
+    'payments': 40,
+    'socials': 60
+}
+EXPORT_DEFAULT_WIDTH = 15
+# Формат чисел по колонкам; остальные числа (id, счётчики) пишутся в формате по умолчанию
+EXPORT_NUMBER_FORMATS = {
+    'x': '0.000000',
+    'y': '0.000000'
+}
+
+def get_export_column_types(conn):
+    """
+    Возвращает {колонка: 'number' | 'string'} для mv_markets_export.
+    Материализованного представления нет в information_schema, поэтому читаем pg_attribute.
+    """
+    global export_column_types
+    if export_column_types is None:
+        rows = conn.execute(text("""
+            SELECT a.attname, format_type(a.atttypid, a.atttypmod) AS type_name
+            FROM pg_attribute a
+            WHERE a.attrelid = 'mv_markets_export'::regclass
+              AND a.attnum > 0
+              AND NOT a.attisdropped
+        """))
+        types = {
+            name: 'number' if type_name.startswith(NUMERIC_PG_TYPES) else 'string'
+            for name, type_name in rows
+        }
+        if not types:
+            return {}
+        export_column_types = types
+    return export_column_types
+
+def write_export_rows(workbook, worksheet, columns, rows, column_types):
+    """
+    Пишет заголовок и строки выгрузки, выбирая метод записи для каждой колонки заранее.
+    Пустые значения пропускаются — в constant_memory режиме ячейка остаётся пустой.
+    Возвращает количество записанных строк.
+    """
+    header_format = workbook.add_format({'bold': True})
+    number_formats = {name: workbook.add_format({'num_format': num_format})
+                      for name, num_format in EXPORT_NUMBER_FORMATS.items()}
+
+    writers = []
+    for col, name in enumerate(columns):
+        kind = column_types.get(name)
+        width = EXPORT_COLUMN_WIDTHS.get(name, EXPORT_DEFAULT_WIDTH)
+        if kind == 'number':
+            worksheet.set_column(col, col, width, number_formats.get(name))
+            writers.append(worksheet.write_number)
+        elif kind == 'string':
+            worksheet.set_column(col, col, width)
+            writers.append(worksheet.write_string)
+        else:
+            worksheet.set_column(col, col, width)
+            writers.append(worksheet.write)
+
+    worksheet.write_row(0, 0, columns, header_format)
+
+    row_num = 1
+    for row in rows:
+        for col, value in enumerate(row):
+            if value is None or value == '':
+                continue
+            writers[col](row_num, col, value)
+        row_num += 1
+    return row_num - 1
+
+def iter_result_rows(result):
+    # Потоковое чтение серверного курсора порциями DB_STREAM_ITERSIZE
+    while True:
+        chunk = result.fetchmany(DB_STREAM_ITERSIZE)
+        if not chunk:
+            break
+        yield from chunk
+
+# Параллельная выгрузка: число процессов и частей (по умолчанию — по числу ядер)
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS", str(os.cpu_count() or 1)))
+EXPORT_SHARDS = int(os.getenv("EXPORT_SHARDS", str(EXPORT_WORKERS)))
+
+def get_export_shard_bounds(conn, shards):
+    """
+    Возвращает границы market_name, делящие mv_markets_export на shards частей
+    примерно одинакового размера, в порядке сортировки БД (её collation, а не Python).
+    """
+    if shards < 2:
+        return []
+    fractions = [i / shards for i in range(1, shards)]
+    bounds = conn.execute(text("""
+        SELECT percentile_disc(CAST(:fractions AS double precision[]))
+               WITHIN GROUP (ORDER BY market_name) AS bounds
+        FROM mv_markets_export
+    """), {'fractions': fractions}).scalar()
+    # percentile_disc уже отдаёт границы по возрастанию; повторная сортировка в Python
+    # переставила бы их (регистр, кавычки) и части пересекались бы
+    return list(dict.fromkeys(b for b in bounds or [] if b is not None))
+
+def export_shard_ranges(bounds):
+    """
+    Превращает границы в полуинтервалы [lo, hi). None — открытая граница.
+    Строки без названия попадают в последнюю часть (ORDER BY ставит NULL в конец).
+    """
+    edges = [None] + list(bounds) + [None]
+    return [(edges[i], edges[i + 1]) for i in range(len(edges) - 1)]
+
+def export_shard_query(lo, hi):
+    conditions = []
+    params = {}
+    if lo is not None:
+        conditions.append("market_name >= :lo")
+        params['lo'] = lo
+    if hi is not None:
+        conditions.append("market_name < :hi")
+        params['hi'] = hi
+    where = " AND ".join(conditions)
+    if hi is None:
+        where = f"({where}) OR market_name IS NULL" if where else ""
+    sql = "SELECT * FROM mv_markets_export"
+    if where:
+        sql += f" WHERE {where}"
+    return sql + " ORDER BY market_name", params
+
+def export_shard(part_path, lo, hi, column_types):
+    """
+    Выполняется в отдельном процессе: выгружает одну часть mv_markets_export в xlsx.
+    Возвращает (путь, число строк).
+    """
+    sql, params = export_shard_query(lo, hi)
+    workbook = xlsxwriter.Workbook(part_path, {'constant_memory': True})
+    worksheet = workbook.add_worksheet('Рынки')
+    with get_engine().connect() as conn:
+        result = conn.execution_options(
+            stream_results=True,
+            yield_per=DB_STREAM_ITERSIZE
+        ).execute(text(sql), params)
+        count = write_export_rows(workbook, worksheet, list(result.keys()), iter_result_rows(result), column_types)
+    workbook.close()
+    return part_path, count
+
+def build_sharded_export(zip_path, shards=None):
+    """
+    Делит mv_markets_export по диапазонам market_name, строит части параллельно
+    в пуле процессов и упаковывает их в zip (части идут в порядке названий).
+    Возвращает общее число строк.
+    """
+    shards = shards or EXPORT_SHARDS
+    with get_engine().connect() as conn:
+        column_types = get_export_column_types(conn)
+        ranges = export_shard_ranges(get_export_shard_bounds(conn, shards))
+
+    part_dir = tempfile.mkdtemp(prefix='export_parts_')
+    try:
+        with ProcessPoolExecutor(max_workers=min(EXPORT_WORKERS, len(ranges))) as pool:
+            futures = [
+                pool.submit(export_shard, os.path.join(part_dir, f"часть_{i:02d}.xlsx"), lo, hi, column_types)
+                for i, (lo, hi) in enumerate(ranges, 1)
+            ]
+            parts = [f.result() for f in futures]
+
+        # xlsx уже сжат, поэтому складываем части без повторного сжатия
+        total = 0
+        with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_STORED) as zf:
+            for part_path, count in parts:
+                zf.write(part_path, arcname=os.path.basename(part_path))
+                total += count
+        return total
+    finally:
+        shutil.rmtree(part_dir, ignore_errors=True)
+
+# Предварительная сборка выгрузок в непиковое время
+EXPORT_PREBUILD_HOUR = int(os.getenv("EXPORT_PREBUILD_HOUR", "4"))
+# Дополнительные варианты выгрузки по субъектам, через запятую
+EXPORT_PREBUILD_STATES = [s.strip() for s in os.getenv("EXPORT_PREBUILD_STATES", "").split(',') if s.strip()]
+EXPORT_PREBUILT_MAX_AGE_HOURS = int(os.getenv("EXPORT_PREBUILT_MAX_AGE_HOURS", "24"))
+SCHEDULER_IP = '127.0.0.1'
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+def export_variant_key(state=None):
+    return f"export:state:{state.strip().lower()}" if state else "export:all"
+
+def export_filename(state=None):
+    stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    if state:
+        return f"рынки_{state.strip().replace(' ', '_')}_{stamp}.xlsx"
+    return f"все_рынки_{stamp}.xlsx"
+
+def build_export_workbook(path, state=None):
+    """
+    Выгружает mv_markets_export (целиком или по одному субъекту) в xlsx.
+    Возвращает количество строк.
+    """
+    sql = "SELECT * FROM mv_markets_export"
+    params = {}
+    if state:
+        sql += " WHERE LOWER(TRIM(state)) = :state"
+        params['state'] = state.strip().lower()
+
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+    worksheet = workbook.add_worksheet('Рынки')
+
+    with get_engine().connect() as conn:
+        column_types = get_export_column_types(conn)
+        result = conn.execution_options(
+            stream_results=True,
+            yield_per=DB_STREAM_ITERSIZE
+        ).execute(text(sql + " ORDER BY market_name"), params)
+        count = write_export_rows(workbook, worksheet, list(result.keys()), iter_result_rows(result), column_types)
+
+    workbook.close()
+    return count
+
+def prebuild_exports():
+    """Собирает стандартную выгрузку и настроенные варианты и кладёт их в MinIO."""
+    for state in [None] + EXPORT_PREBUILD_STATES:
+        tmp_path = None
+        try:
+            with tempfile.NamedTemporaryFile(delete=False, suffix='.xlsx') as tmp:
+                tmp_path = tmp.name
+            build_export_workbook(tmp_path, state)
+            save_file_to_minio_and_log(tmp_path, export_filename(state), 'export_prebuilt',
+                                       SCHEDULER_IP, content_key=export_variant_key(state))
+        finally:
+            if tmp_path and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+schedule_daily('prebuild_exports', EXPORT_PREBUILD_HOUR, prebuild_exports)
+schedule_daily('apply_retention_policy', FILE_RETENTION_HOUR, apply_retention_policy)
+schedule_daily('maintain_file_logs', FILE_LOGS_MAINTENANCE_HOUR, maintain_file_logs)
+
+def find_prebuilt_export(state=None):
+    """Последняя заранее собранная выгрузка не старше EXPORT_PREBUILT_MAX_AGE_HOURS или None."""
+    return find_archived_artifact('export_prebuilt', export_variant_key(state),
+                                  EXPORT_PREBUILT_MAX_AGE_HOURS * 3600)
+
+def send_prebuilt_export(prebuilt, user_ip):
+    """Отдаёт готовую выгрузку из MinIO, не собирая её заново."""
+    log_file_operation(prebuilt['original_filename'], prebuilt['hashed_filename'], 'export',
+                       user_ip, prebuilt['content_key'])
+    return serve_archived_file(prebuilt['hashed_filename'], prebuilt['original_filename'], XLSX_MIMETYPE,
+                               prebuilt.get('cold_key'))
+
 @app.route('/export_all')
 @require_auth
 def export_all():
@@ -1099,38 +3232,42 @@ def export_all():
 
 
     try:
-        engine = create_engine(
-            f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
-        )
+        if request.args.get('parallel') == '1':
+            with tempfile.NamedTemporaryFile(delete=False, suffix='.zip') as tmp:
+                tmp_path = tmp.name
+            build_sharded_export(tmp_path)
+
+            original_filename = f"все_рынки_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+            response = send_file(tmp_path, as_attachment=True, download_name=original_filename)
+            # Файл уже открыт для ответа — дальше им владеет фоновый загрузчик
+            archive_file(tmp_path, original_filename, operation_type, user_ip)
+            tmp_path = None
+            return response
+
+        state = request.args.get('state', '').strip() or None
+
+        # Сначала пробуем отдать выгрузку, собранную планировщиком
+        if request.args.get('fresh') != '1':
+            try:
+                prebuilt = find_prebuilt_export(state)
+                if prebuilt:
+                    return send_prebuilt_export(prebuilt, user_ip)
+            except Exception as e:
+                print(f"Не удалось отдать готовую выгрузку: {e}")
+
         with tempfile.NamedTemporaryFile(delete=False, suffix='.xlsx') as tmp:
             tmp_path = tmp.name
 
         # Создаём Excel
-        workbook = xlsxwriter.Workbook(tmp_path, {'constant_memory': True})
-        worksheet = workbook.add_worksheet('Рынки')
-
-        with engine.connect() as conn:
-            result = conn.execution_options(stream_results=True).execute(
-                text("SELECT * FROM mv_markets_export ORDER BY market_name")
-            )
-            columns = result.keys()
-            worksheet.write_row(0, 0, columns)
-
-            row_num = 1
-            while True:
-                chunk = result.fetchmany(1000)
-                if not chunk:
-                    break
-                for row in chunk:
-                    worksheet.write_row(row_num, 0, row)
-                    row_num += 1
+        build_export_workbook(tmp_path, state)
 
-        workbook.close()
-
-        original_filename = f"все_рынки_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-        save_file_to_minio_and_log(tmp_path, original_filename, operation_type, user_ip)
-
-        return send_file(tmp_path, as_attachment=True, download_name=original_filename)
+        original_filename = export_filename(state)
+        response = send_file(tmp_path, as_attachment=True, download_name=original_filename)
+        # Файл уже открыт для ответа — дальше им владеет фоновый загрузчик
+        archive_file(tmp_path, original_filename, operation_type, user_ip,
+                     content_key=export_variant_key(state))
+        tmp_path = None
+        return response
 
     except Exception as e:
         flash(f"Ошибка экспорта: {e}", "error")
@@ -1142,81 +3279,558 @@ def export_all():
             except:
                 pass
 
-@app.route('/stats')
+# updated_at = now() — время начала транзакции писателя, а видна строка станет только после коммита.
+# Поэтому курсор не новее начала самой старой открытой транзакции в БД (по pg_stat_activity; писатели
+# и выгрузка работают под одной ролью, так что xact_start чужих сеансов виден) и дополнительно
+# отстаёт на EXPORT_CHANGES_LAG секунд. Изменения после курсора отдаются повторно при следующем запросе.
+EXPORT_CHANGES_LAG = int(os.getenv("EXPORT_CHANGES_LAG", "300"))
+
+@app.route('/export_changes')
 @require_auth
-def stats():
+def export_changes():
+    """
+    Дельта-выгрузка: рынки, изменённые после since, и удалённые рынки.
+    В ответе есть cursor — его нужно передать как since в следующий раз.
+    """
+    since_str = request.args.get('since', '').strip()
+    try:
+        since = datetime.fromisoformat(since_str)
+    except ValueError:
+        return jsonify({"error": "Параметр since должен быть датой в формате ISO 8601"}), 400
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+
     conn = get_db_connection()
     if not conn:
-        flash("Ошибка подключения к БД", "error")
-        return redirect(url_for('login'))
+        return jsonify({"error": "Ошибка подключения к БД"}), 503
 
     try:
         with conn.cursor() as cur:
-            # Общая статистика
-            cur.execute("SELECT COUNT(*) AS total FROM farmers_markets")
-            total_markets = cur.fetchone()['total']
+            # Курсор — до чтения изменений: всё, что зафиксировано раньше, попадёт в выборку ниже,
+            # а незафиксированное начато не раньше курсора и придёт в следующий раз
+            cur.execute("""
+                SELECT LEAST(
+                    now() - make_interval(secs => %s),
+                    (SELECT min(xact_start) FROM pg_stat_activity
+                     WHERE datname = current_database() AND backend_type = 'client backend')
+                ) AS safe_cursor
+            """, (EXPORT_CHANGES_LAG,))
+            cursor = max(since, cur.fetchone()['safe_cursor'])
+
+            cur.execute("""
+                SELECT fm.market_id, fm.market_name, fm.street, fm.city, fm.state, fm.zip, fm.x, fm.y,
+                       COALESCE(fm.location, '') AS location,
+                       COALESCE((
+                           SELECT STRING_AGG(p.product_name, ', ' ORDER BY p.product_name)
+                           FROM market_products mp
+                           JOIN products p ON mp.product_id = p.product_id
+                           WHERE mp.market_id = fm.market_id
+                       ), '') AS products,
+                       COALESCE((
+                           SELECT STRING_AGG(pm.payment_name, ', ' ORDER BY pm.payment_name)
+                           FROM market_payments mpy
+                           JOIN payment_methods pm ON mpy.payment_id = pm.payment_id
+                           WHERE mpy.market_id = fm.market_id
+                       ), '') AS payments,
+                       COALESCE((
+                           SELECT STRING_AGG(sn.social_networks || ':' || COALESCE(msl.url, ''), ', '
+                                             ORDER BY sn.social_networks)
+                           FROM market_social_links msl
+                           JOIN social_networks sn ON msl.social_network_id = sn.social_network_id
+                           WHERE msl.market_id = fm.market_id
+                       ), '') AS socials,
+                       fm.updated_at
+                FROM farmers_markets fm
+                WHERE fm.updated_at > %s
+                ORDER BY fm.updated_at, fm.market_id
+            """, (since,))
+            changed = cur.fetchall()
 
-            cur.execute("SELECT COUNT(*) AS total FROM reviews")
-            total_reviews = cur.fetchone()['total']
+            cur.execute("""
+                SELECT market_id, market_name, deleted_at
+                FROM market_tombstones
+                WHERE deleted_at > %s
+                ORDER BY deleted_at, market_id
+            """, (since,))
+            deleted = cur.fetchall()
+
+        for row in changed:
+            row['x'] = float(row['x']) if row['x'] is not None else None
+            row['y'] = float(row['y']) if row['y'] is not None else None
+            row['updated_at'] = row['updated_at'].isoformat()
+        for row in deleted:
+            row['deleted_at'] = row['deleted_at'].isoformat()
+
+        return jsonify({
+            "since": since.isoformat(),
+            "cursor": cursor.isoformat(),
+            "changed": changed,
+            "deleted": deleted
+        })
+    finally:
+        conn.close()
 
-            cur.execute("SELECT COUNT(*) AS total FROM products")
-            total_products = cur.fetchone()['total']
+@app.route('/metrics/archive')
+@require_admin
+def archive_metrics_page():
+    """Счётчики фоновой архивации текущего воркера, включая неудачные загрузки."""
+    return jsonify(get_archive_metrics())
 
-            cur.execute("SELECT COUNT(*) AS total FROM payment_methods")
-            total_payments = cur.fetchone()['total']
+@app.route('/files/recent')
+@require_auth
+def recent_files():
+    """
+    Недавние файлы из file_logs (по одному на объект MinIO) со ссылками на скачивание.
+    Параметры: operation_type, q (часть имени файла), hours (по умолчанию 168), limit (до 200).
+    Не администраторам видны только общие выгрузки и PDF.
+    """
+    allowed = None if session.get('is_admin') else list(SHARED_ARTIFACT_TYPES)
+    operation_type = request.args.get('operation_type', '').strip() or None
+    q = request.args.get('q', '').strip()
+    try:
+        hours = max(int(request.args.get('hours', 168)), 1)
+        limit = min(max(int(request.args.get('limit', 50)), 1), 200)
+    except ValueError:
+        return jsonify({'error': 'hours и limit должны быть числами'}), 400
 
-            cur.execute("SELECT COUNT(*) AS total FROM social_networks")
-            total_socials = cur.fetchone()['total']
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({'error': 'Ошибка подключения к БД'}), 503
 
-            # Средний рейтинг
+    try:
+        with conn.cursor() as cur:
             cur.execute("""
-                SELECT COALESCE(ROUND(AVG(rating), 2), 0) AS avg_rating
-                FROM reviews
-            """)
-            avg_rating = float(cur.fetchone()['avg_rating'])
+                SELECT * FROM (
+                    SELECT DISTINCT ON (l.hashed_filename)
+                           l.hashed_filename, l.original_filename, l.operation_type,
+                           l.content_key, l.created_at, o.size_bytes
+                    FROM file_logs l
+                    JOIN file_objects o ON o.hashed_filename = l.hashed_filename
+                    WHERE l.created_at > now() - make_interval(hours => %s)
+                      AND (%s::text[] IS NULL OR l.operation_type = ANY(%s::text[]))
+                      AND (%s::text IS NULL OR l.operation_type = %s)
+                      AND l.original_filename ILIKE %s
+                    ORDER BY l.hashed_filename, l.created_at DESC
+                ) latest
+                ORDER BY created_at DESC
+                LIMIT %s
+            """, (hours, allowed, allowed, operation_type, operation_type, f"%{q}%", limit))
+            rows = cur.fetchall()
+    finally:
+        conn.close()
+
+    return jsonify(files=[
+        dict(row, created_at=row['created_at'].isoformat(),
+             url=url_for('download_archived_file', hashed_filename=row['hashed_filename']))
+        for row in rows
+    ])
+
+@app.route('/files/<hashed_filename>')
+@require_auth
+def download_archived_file(hashed_filename):
+    """Скачивание ранее сохранённого файла прямо из MinIO (см. FILE_DELIVERY_MODE)."""
+    allowed = None if session.get('is_admin') else list(SHARED_ARTIFACT_TYPES)
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({'error': 'Ошибка подключения к БД'}), 503
 
-            # Топ-5 рынков по рейтингу
+    try:
+        with conn.cursor() as cur:
             cur.execute("""
-                SELECT fm.market_name, fm.city, fm.state, 
-                       COALESCE(ROUND(AVG(r.rating), 2), 0) AS avg_rating,
-                       COUNT(r.review_id) AS review_count
-                FROM farmers_markets fm
-                LEFT JOIN reviews r ON fm.market_id = r.market_id
-                GROUP BY fm.market_id, fm.market_name, fm.city, fm.state
-                HAVING COUNT(r.review_id) > 0
-                ORDER BY avg_rating DESC, review_count DESC
-                LIMIT 5
-            """)
-            top_markets = cur.fetchall()
+                SELECT l.original_filename, o.cold_key
+                FROM file_logs l
+                JOIN file_objects o ON o.hashed_filename = l.hashed_filename
+                WHERE l.hashed_filename = %s
+                  AND (%s::text[] IS NULL OR l.operation_type = ANY(%s::text[]))
+                ORDER BY l.created_at DESC
+                LIMIT 1
+            """, (hashed_filename, allowed, allowed))
+            artifact = cur.fetchone()
+    finally:
+        conn.close()
+
+    if not artifact:
+        return jsonify({'error': 'Файл не найден'}), 404
+
+    user_ip = request.environ.get('HTTP_X_REAL_IP') or request.remote_addr
+    original_filename = artifact['original_filename']
+    log_file_operation(original_filename, hashed_filename, 'download', user_ip)
+    mimetype = mimetypes.guess_type(original_filename)[0] or 'application/octet-stream'
+    return serve_archived_file(hashed_filename, original_filename, mimetype, artifact['cold_key'])
+
+TREND_BUCKETS = ('day', 'week', 'month')
+
+@app.route('/stats/trends')
+@require_auth
+def review_trends():
+    """
+    Динамика отзывов из дневных сводок: число отзывов и средний рейтинг по периодам
+    (bucket=day|week|month) плюс скользящее среднее за window дней.
+    Область: market_id, state или вся страна, если не указано ни то, ни другое.
+    """
+    bucket = request.args.get('bucket', 'week')
+    if bucket not in TREND_BUCKETS:
+        return jsonify({'error': 'bucket должен быть day, week или month'}), 400
+    try:
+        days = min(max(int(request.args.get('days', 365)), 1), 3660)
+        window = min(max(int(request.args.get('window', 28)), 1), 365)
+        market_id = int(request.args['market_id']) if request.args.get('market_id') else None
+    except ValueError:
+        return jsonify({'error': 'days, window и market_id должны быть числами'}), 400
+    state = request.args.get('state', '').strip() or None
+
+    if market_id is not None:
+        source_sql, scope_params = "review_daily_market WHERE market_id = %s AND", (market_id,)
+    elif state:
+        source_sql, scope_params = "review_daily_state WHERE state = %s AND", (state,)
+    else:
+        source_sql, scope_params = "review_daily_state WHERE", ()
+
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({'error': 'Ошибка подключения к БД'}), 503
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                WITH buckets AS (
+                    SELECT date_trunc(%s, day)::date AS period,
+                           SUM(review_count) AS reviews,
+                           SUM(rating_sum) AS rating_sum
+                    FROM {source_sql} day > current_date - %s
+                    GROUP BY 1
+                )
+                SELECT period, reviews,
+                       ROUND(rating_sum::numeric / reviews, 2) AS avg_rating,
+                       ROUND(SUM(rating_sum) OVER w::numeric / SUM(reviews) OVER w, 2) AS rolling_avg
+                FROM buckets
+                WINDOW w AS (ORDER BY period RANGE BETWEEN make_interval(days => %s) PRECEDING AND CURRENT ROW)
+                ORDER BY period
+            """, (bucket, *scope_params, days, window - 1))
+            rows = cur.fetchall()
+    finally:
+        conn.close()
+
+    return jsonify(
+        bucket=bucket, window_days=window,
+        points=[{'period': r['period'].isoformat(), 'reviews': int(r['reviews']),
+                 'avg_rating': float(r['avg_rating']), 'rolling_avg': float(r['rolling_avg'])}
+                for r in rows]
+    )
 
-            # Рынки по субъектам (топ-10)
+def parse_iso_datetime(value):
+    """ISO 8601 → datetime с часовым поясом (без пояса считается UTC)."""
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+@app.route('/admin/file_logs')
+@require_admin
+def file_logs_audit():
+    """
+    Журнал операций с файлами, новые сверху. Фильтры: operation_type (можно несколько), ip,
+    from/to (ISO 8601), filename (часть имени). Страницы — по cursor из предыдущего ответа.
+    """
+    conditions, params = [], []
+    operation_types = [t for t in request.args.getlist('operation_type') if t]
+    if operation_types:
+        conditions.append("operation_type = ANY(%s)")
+        params.append(operation_types)
+    ip = request.args.get('ip', '').strip()
+    if ip:
+        conditions.append("user_ip = %s")
+        params.append(ip)
+    filename = request.args.get('filename', '').strip()
+    if filename:
+        conditions.append("original_filename ILIKE %s")
+        params.append(f"%{filename}%")
+
+    try:
+        for arg, op in (('from', '>='), ('to', '<')):
+            if request.args.get(arg):
+                conditions.append(f"created_at {op} %s")
+                params.append(parse_iso_datetime(request.args[arg]))
+        cursor = request.args.get('cursor', '')
+        if cursor:
+            cursor_time, cursor_id = cursor.rsplit('|', 1)
+            conditions.append("(created_at, id) < (%s, %s)")
+            params.extend([parse_iso_datetime(cursor_time), int(cursor_id)])
+        limit = min(max(int(request.args.get('limit', 100)), 1), 500)
+    except ValueError:
+        return jsonify({'error': 'Неверный формат даты, cursor или limit'}), 400
+
+    where_sql = "WHERE " + " AND ".join(conditions) if conditions else ""
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({'error': 'Ошибка подключения к БД'}), 503
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                SELECT id, created_at, operation_type, original_filename, hashed_filename,
+                       file_extension, user_ip, content_key
+                FROM file_logs
+                {where_sql}
+                ORDER BY created_at DESC, id DESC
+                LIMIT %s
+            """, (*params, limit))
+            rows = cur.fetchall()
+    finally:
+        conn.close()
+
+    next_cursor = None
+    if len(rows) == limit:
+        next_cursor = f"{rows[-1]['created_at'].isoformat()}|{rows[-1]['id']}"
+    return jsonify(
+        items=[dict(row, created_at=row['created_at'].isoformat()) for row in rows],
+        next_cursor=next_cursor
+    )
+
+@app.route('/admin/file_logs/daily')
+@require_admin
+def file_logs_daily():
+    """Дневные агрегаты file_logs: операции, байты и уникальные IP (по умолчанию за 30 дней)."""
+    try:
+        days = min(max(int(request.args.get('days', 30)), 1), 3660)
+    except ValueError:
+        return jsonify({'error': 'days должен быть числом'}), 400
+    operation_type = request.args.get('operation_type', '').strip() or None
+
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({'error': 'Ошибка подключения к БД'}), 503
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT day, operation_type, operations, bytes, unique_ips
+                FROM file_logs_daily
+                WHERE day > (now() AT TIME ZONE 'Europe/Moscow')::date - %s
+                  AND (%s::text IS NULL OR operation_type = %s)
+                ORDER BY day, operation_type
+            """, (days, operation_type, operation_type))
+            rows = cur.fetchall()
+    finally:
+        conn.close()
+
+    return jsonify(days=[dict(row, day=row['day'].isoformat()) for row in rows])
+
+@app.route('/admin/retention', methods=['POST'])
+@require_admin
+def retention_page():
+    """Запускает политику хранения файлов вручную и возвращает отчёт об освобождённом месте."""
+    try:
+        return jsonify(apply_retention_policy())
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Счётчики строк для отображения. Большие таблицы не сканируются: берётся оценка планировщика
+# (pg_class.reltuples, пересчитанная на текущий размер таблицы). Таблицы меньше EXACT_COUNT_THRESHOLD
+# строк и таблицы без статистики считаются точно. Точные значения для администраторов — /admin/counts.
+COUNTED_TABLES = ('farmers_markets', 'reviews', 'products', 'payment_methods', 'social_networks')
+EXACT_COUNT_THRESHOLD = int(os.getenv("EXACT_COUNT_THRESHOLD", "10000"))
+EXACT_COUNTS_TTL = int(os.getenv("EXACT_COUNTS_TTL", "600"))
+
+def get_table_counts(cur, tables=COUNTED_TABLES):
+    """{таблица: {'value': число строк, 'mode': 'estimate' | 'exact'}} — не больше двух запросов."""
+    if not set(tables) <= set(COUNTED_TABLES):
+        raise ValueError(f"Неизвестная таблица: {set(tables) - set(COUNTED_TABLES)}")
+
+    cur.execute("""
+        SELECT c.relname,
+               CASE WHEN c.reltuples < 0 OR c.relpages = 0 THEN NULL
+                    ELSE (c.reltuples / c.relpages
+                          * (pg_relation_size(c.oid) / current_setting('block_size')::int))::bigint
+               END AS estimate
+        FROM pg_class c
+        WHERE c.oid = ANY(%s::regclass[])
+    """, (list(tables),))
+    estimates = {row['relname']: row['estimate'] for row in cur.fetchall()}
+
+    counts = {}
+    exact_tables = []
+    for table in tables:
+        estimate = estimates.get(table)
+        if estimate is None or estimate < EXACT_COUNT_THRESHOLD:
+            exact_tables.append(table)
+        else:
+            counts[table] = {'value': int(estimate), 'mode': 'estimate'}
+
+    if exact_tables:
+        cur.execute("SELECT " + ", ".join(f"(SELECT COUNT(*) FROM {t}) AS {t}" for t in exact_tables))
+        row = cur.fetchone()
+        for table in exact_tables:
+            counts[table] = {'value': row[table], 'mode': 'exact'}
+    return counts
+
+exact_counts = {'counts': None, 'computed_at': None, 'running': False}
+exact_counts_lock = threading.Lock()
+
+def compute_exact_counts():
+    """Точный COUNT(*) по всем таблицам — полные сканирования, только в фоновом потоке."""
+    try:
+        conn = get_db_connection()
+        if not conn:
+            raise Exception("Ошибка подключения к БД")
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT " + ", ".join(f"(SELECT COUNT(*) FROM {t}) AS {t}" for t in COUNTED_TABLES))
+                row = cur.fetchone()
+        finally:
+            conn.close()
+        exact_counts.update(counts={t: row[t] for t in COUNTED_TABLES},
+                            computed_at=datetime.now(timezone.utc))
+    except Exception as e:
+        print(f"Ошибка подсчёта строк: {e}")
+    finally:
+        exact_counts['running'] = False
+
+def request_exact_counts():
+    """Запускает фоновый точный подсчёт, если он ещё не идёт."""
+    with exact_counts_lock:
+        if exact_counts['running']:
+            return
+        exact_counts['running'] = True
+    threading.Thread(target=compute_exact_counts, name='exact-counts', daemon=True).start()
+
+@app.route('/admin/counts')
+@require_admin
+def admin_counts():
+    """
+    Оценки и точные числа строк. Точные считаются в фоне: если их нет, они старше
+    EXACT_COUNTS_TTL или передан refresh=1 — подсчёт запускается, а ответ приходит сразу.
+    """
+    computed_at = exact_counts['computed_at']
+    stale = computed_at is None or datetime.now(timezone.utc) - computed_at > timedelta(seconds=EXACT_COUNTS_TTL)
+    if stale or request.args.get('refresh') == '1':
+        request_exact_counts()
+
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({'error': 'Ошибка подключения к БД'}), 503
+    try:
+        with conn.cursor() as cur:
+            counts = get_table_counts(cur)
+    finally:
+        conn.close()
+
+    return jsonify(
+        display=counts,
+        exact={t: {'value': v, 'mode': 'exact'} for t, v in (exact_counts['counts'] or {}).items()},
+        exact_computed_at=computed_at.isoformat() if computed_at else None,
+        exact_status='running' if exact_counts['running'] else 'ready'
+    )
+
+# Снимок статистики: считается одним запросом, обновляется фоновым потоком раз в STATS_CACHE_TTL секунд.
+# Запрос страницы читает снимок из памяти; сам идёт в БД, только если снимка нет или он устарел вдвое.
+STATS_CACHE_TTL = int(os.getenv("STATS_CACHE_TTL", "60"))
+
+stats_cache = {'data': None, 'computed_at': 0.0}
+stats_refresh_lock = threading.Lock()
+
+def compute_stats_snapshot():
+    """Все показатели страницы статистики за одно обращение к БД. None — нет подключения."""
+    conn = get_db_connection()
+    if not conn:
+        return None
+
+    try:
+        with conn.cursor() as cur:
             cur.execute("""
-                SELECT state, COUNT(*) AS count
-                FROM farmers_markets
-                GROUP BY state
-                ORDER BY count DESC
-                LIMIT 10
+                WITH review_totals AS (
+                    SELECT COALESCE(SUM(review_count), 0) AS total_reviews,
+                           COALESCE(ROUND(SUM(rating_sum)::numeric / NULLIF(SUM(review_count), 0), 2), 0) AS avg_rating,
+                           json_build_object(
+                               5, COALESCE(SUM(stars_5), 0), 4, COALESCE(SUM(stars_4), 0),
+                               3, COALESCE(SUM(stars_3), 0), 2, COALESCE(SUM(stars_2), 0),
+                               1, COALESCE(SUM(stars_1), 0)
+                           ) AS rating_distribution
+                    FROM market_rating_stats
+                )
+                SELECT
+                    rt.total_reviews,
+                    rt.avg_rating,
+                    rt.rating_distribution,
+                    COALESCE((
+                        SELECT json_agg(t) FROM (
+                            SELECT fm.market_name, fm.city, fm.state,
+                                   ROUND(s.rating_sum::numeric / NULLIF(s.review_count, 0), 2) AS avg_rating,
+                                   s.review_count
+                            FROM market_rating_stats s
+                            JOIN farmers_markets fm ON fm.market_id = s.market_id
+                            WHERE s.review_count > 0
+                            ORDER BY s.rating_sum::numeric / NULLIF(s.review_count, 0) DESC, s.review_count DESC
+                            LIMIT 5
+                        ) t
+                    ), '[]') AS top_markets,
+                    COALESCE((
+                        SELECT json_agg(s) FROM (
+                            SELECT state, COUNT(*) AS count
+                            FROM farmers_markets
+                            GROUP BY state
+                            ORDER BY count DESC
+                            LIMIT 10
+                        ) s
+                    ), '[]') AS markets_by_state
+                FROM review_totals rt
             """)
-            markets_by_state = cur.fetchall()
+            row = cur.fetchone()
+            counts = get_table_counts(cur, ('farmers_markets', 'products', 'payment_methods', 'social_networks'))
+    finally:
+        conn.close()
 
-            stats_data = {
-                'total_markets': total_markets,
-                'total_reviews': total_reviews,
-                'avg_rating': avg_rating,
-                'total_products': total_products,
-                'total_payments': total_payments,
-                'total_socials': total_socials,
-                'top_markets': top_markets,
-                'markets_by_state': markets_by_state
-            }
+    return dict(
+        row,
+        total_reviews=int(row['total_reviews']),
+        avg_rating=float(row['avg_rating']),
+        rating_distribution={stars: int((row.get('rating_distribution') or {}).get(str(stars), 0)) for stars in RATING_STARS},
+        total_markets=counts['farmers_markets']['value'],
+        total_products=counts['products']['value'],
+        total_payments=counts['payment_methods']['value'],
+        total_socials=counts['social_networks']['value'],
+        count_modes={table: c['mode'] for table, c in counts.items()}
+    )
 
-        return render_template('stats.html', stats=stats_data)
+def refresh_stats_snapshot():
+    """Пересчитывает снимок; если его уже считает другой поток — ждёт и использует результат."""
+    started = time.monotonic()
+    with stats_refresh_lock:
+        if stats_cache['data'] is not None and stats_cache['computed_at'] >= started:
+            return stats_cache['data']
+        data = compute_stats_snapshot()
+        if data is not None:
+            stats_cache.update(data=data, computed_at=time.monotonic())
+        return data
+
+def stats_refresh_loop():
+    while True:
+        try:
+            refresh_stats_snapshot()
+        except Exception as e:
+            print(f"Ошибка обновления статистики: {e}")
+        time.sleep(STATS_CACHE_TTL)
+
+def get_stats_snapshot():
+    """Снимок статистики и его возраст в секундах."""
+    if stats_cache['data'] is None or time.monotonic() - stats_cache['computed_at'] > 2 * STATS_CACHE_TTL:
+        refresh_stats_snapshot()
+    if stats_cache['data'] is None:
+        return None, None
+    return stats_cache['data'], int(time.monotonic() - stats_cache['computed_at'])
 
+@app.route('/stats')
+@require_auth
+def stats():
+    try:
+        stats_data, age = get_stats_snapshot()
     except Exception as e:
         flash(f"Ошибка загрузки статистики: {e}", "error")
         return redirect(url_for('markets'))
-    finally:
-        conn.close()
+
+    if stats_data is None:
+        flash("Ошибка подключения к БД", "error")
+        return redirect(url_for('login'))
+
+    return render_template('stats.html', stats=stats_data, stats_age=age)
 
 @app.route('/help')
 @require_auth
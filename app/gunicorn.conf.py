@@ -0,0 +1,12 @@
+# Настройки gunicorn (запуск: gunicorn -c gunicorn.conf.py app:app)
+bind = "0.0.0.0:5000"
+workers = 1
+timeout = 300
+# Приложение импортируется один раз в мастере; соединения и потоки каждый воркер создаёт сам
+preload_app = True
+
+
+def post_fork(server, worker):
+    # С preload_app модуль уже загружен в мастере — берём тот же объект
+    from app import init_worker
+    init_worker()
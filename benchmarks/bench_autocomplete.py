@@ -0,0 +1,78 @@
+# benchmarks/bench_autocomplete.py
+"""
+Бенчмарк автодополнения: время ответа autocomplete_suggestions по индексу в памяти
+и время точечного обновления индекса при изменении рынка.
+
+Индекс заполняется синтетическими рынками; префиксы — от одной буквы до почти полного названия.
+    python benchmarks/bench_autocomplete.py --markets 100000 --queries 20000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('BACKGROUND_SERVICES_ENABLED', '0')
+
+import app.app as app_module
+
+SYLLABLES = ['ма', 'ко', 'ре', 'ни', 'ва', 'ло', 'сто', 'гра', 'бе', 'зе', 'цен', 'тра', 'ль', 'ный']
+
+
+def random_word(rng):
+    return ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 5))).capitalize()
+
+
+def fill_index(markets, rng):
+    cities = [random_word(rng) for _ in range(max(markets // 20, 1))]
+    states = [random_word(rng) for _ in range(85)]
+    for market_id in range(markets):
+        app_module._autocomplete_add({
+            'market_id': market_id,
+            'market_name': f"{random_word(rng)} {random_word(rng)}",
+            'city': rng.choice(cities),
+            'state': rng.choice(states)
+        })
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--markets', type=int, default=50000)
+    parser.add_argument('--queries', type=int, default=10000)
+    args = parser.parse_args()
+    rng = random.Random(42)
+
+    start = time.perf_counter()
+    fill_index(args.markets, rng)
+    print(f"построение индекса: {time.perf_counter() - start:.2f} с на {args.markets} рынков")
+
+    names = app_module.autocomplete_index['keys']['market_name']
+    timings = []
+    for _ in range(args.queries):
+        name = rng.choice(names)
+        prefix = name[:rng.randint(1, len(name))]
+        start = time.perf_counter()
+        app_module.autocomplete_suggestions('market_name', prefix)
+        timings.append(time.perf_counter() - start)
+    print(f"подсказки: p50 {percentile(timings, 0.5) * 1e6:.0f} мкс, "
+          f"p99 {percentile(timings, 0.99) * 1e6:.0f} мкс, max {max(timings) * 1e6:.0f} мкс")
+
+    timings = []
+    for _ in range(min(args.queries, 1000)):
+        market_id = rng.randrange(args.markets)
+        start = time.perf_counter()
+        app_module._autocomplete_add({'market_id': market_id, 'market_name': random_word(rng),
+                                      'city': random_word(rng), 'state': random_word(rng)})
+        timings.append(time.perf_counter() - start)
+    print(f"обновление рынка: p50 {percentile(timings, 0.5) * 1e6:.0f} мкс, "
+          f"p99 {percentile(timings, 0.99) * 1e6:.0f} мкс")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+# benchmarks/bench_export.py
+"""
+Бенчмарк записи xlsx-выгрузки: построчный write_row против типизированной записи.
+
+Запуск на синтетических данных (объём сравним с полным дампом):
+    python benchmarks/bench_export.py --rows 500000
+
+Запуск на реальной mv_markets_export (берутся переменные окружения DB_*):
+    python benchmarks/bench_export.py --from-db
+
+Каждый режим выполняется в отдельном процессе, чтобы пиковый RSS не смешивался.
+Печатает строк/сек, пиковый RSS и RSS по контрольным точкам — в режиме
+constant_memory он должен оставаться ровным.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import xlsxwriter
+
+COLUMNS = ['market_name', 'street', 'city', 'state', 'zip', 'x', 'y',
+           'location', 'products', 'payments', 'socials']
+COLUMN_TYPES = {name: 'string' for name in COLUMNS}
+COLUMN_TYPES.update({'x': 'number', 'y': 'number'})
+
+WORDS = ['рынок', 'ярмарка', 'центральный', 'зелёный', 'фермерский', 'базар',
+         'Москва', 'Казань', 'улица', 'проспект', 'Мёд', 'Овощи', 'Молоко']
+
+
+def current_rss_kb():
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+def synthetic_rows(count):
+    rnd = random.Random(42)
+    for i in range(count):
+        text = ' '.join(rnd.choices(WORDS, k=4))
+        yield (
+            f"Рынок {i:07d}", text, rnd.choice(WORDS), rnd.choice(WORDS), f"{rnd.randint(100000, 999999)}",
+            rnd.uniform(-180, 180), rnd.uniform(-90, 90), '' if i % 3 else text,
+            ', '.join(rnd.sample(WORDS, 5)), ', '.join(rnd.sample(WORDS, 2)),
+            '' if i % 2 else f"Telegram:@market{i}"
+        )
+
+
+def db_rows():
+    from sqlalchemy import text
+    from app.app import get_engine, get_export_column_types, iter_result_rows, DB_STREAM_ITERSIZE
+
+    with get_engine().connect() as conn:
+        COLUMN_TYPES.update(get_export_column_types(conn))
+        result = conn.execution_options(stream_results=True, yield_per=DB_STREAM_ITERSIZE).execute(
+            text("SELECT * FROM mv_markets_export ORDER BY market_name")
+        )
+        COLUMNS[:] = list(result.keys())
+        yield from iter_result_rows(result)
+
+
+def with_checkpoints(rows, checkpoints, every):
+    for i, row in enumerate(rows, 1):
+        if i % every == 0:
+            checkpoints.append((i, current_rss_kb()))
+        yield row
+
+
+def run_mode(mode, rows_count, from_db):
+    from app.app import write_export_rows
+
+    rows = db_rows() if from_db else synthetic_rows(rows_count)
+    checkpoints = []
+    rows = with_checkpoints(rows, checkpoints, max(rows_count // 10, 1))
+
+    with tempfile.NamedTemporaryFile(suffix='.xlsx', delete=False) as tmp:
+        path = tmp.name
+    try:
+        start = time.perf_counter()
+        workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+        worksheet = workbook.add_worksheet('Рынки')
+        if mode == 'write_row':
+            worksheet.write_row(0, 0, COLUMNS)
+            written = 0
+            for row_num, row in enumerate(rows, 1):
+                worksheet.write_row(row_num, 0, row)
+                written += 1
+        else:
+            written = write_export_rows(workbook, worksheet, COLUMNS, rows, COLUMN_TYPES)
+        workbook.close()
+        elapsed = time.perf_counter() - start
+        size = os.path.getsize(path)
+    finally:
+        os.unlink(path)
+
+    return {
+        'mode': mode,
+        'rows': written,
+        'seconds': round(elapsed, 3),
+        'rows_per_sec': round(written / elapsed) if elapsed else None,
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'file_mb': round(size / 1024 / 1024, 1),
+        'rss_checkpoints_mb': [round(kb / 1024, 1) for _, kb in checkpoints]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=200000, help='число синтетических строк')
+    parser.add_argument('--from-db', action='store_true', help='читать mv_markets_export из БД')
+    parser.add_argument('--mode', choices=['write_row', 'typed'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(run_mode(args.mode, args.rows, args.from_db)))
+        return
+
+    for mode in ('write_row', 'typed'):
+        cmd = [sys.executable, __file__, '--mode', mode, '--rows', str(args.rows)]
+        if args.from_db:
+            cmd.append('--from-db')
+        out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+        stats = json.loads(out.strip().splitlines()[-1])
+        print(f"{stats['mode']:>10}: {stats['rows']} строк за {stats['seconds']} с "
+              f"({stats['rows_per_sec']} строк/с), пиковый RSS {stats['peak_rss_mb']} МБ, "
+              f"файл {stats['file_mb']} МБ")
+        print(f"{'':>10}  RSS по контрольным точкам, МБ: {stats['rss_checkpoints_mb']}")
+
+
+if __name__ == '__main__':
+    main()
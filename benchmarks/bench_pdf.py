@@ -0,0 +1,92 @@
+# benchmarks/bench_pdf.py
+"""
+Бенчмарк построения PDF карточки рынка.
+
+Сравнивает два режима:
+  per_request — как было раньше: на каждый PDF заново строятся стили,
+                вызывается getSampleStyleSheet() и компилируется регулярка эмодзи;
+  shared      — стили, шрифты и регулярка собраны один раз при загрузке модуля.
+
+Печатает процессорное время на один PDF и число/объём выделений памяти (tracemalloc).
+    python benchmarks/bench_pdf.py --iterations 200 --reviews 50
+"""
+import argparse
+import os
+import re
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('BACKGROUND_SERVICES_ENABLED', '0')
+
+from reportlab.lib.styles import getSampleStyleSheet
+
+import app.app as app_module
+
+
+def sample_market(reviews):
+    return {
+        "name": "Центральный рынок",
+        "address": "Ленина, 1, Москва, Москва 101000",
+        "coords": "(55.7558, 37.6176)",
+        "location": "У фонтана",
+        "products": ["Мёд", "Овощи", "Фрукты", "Молоко", "Хлеб"],
+        "payments": ["Наличные", "Карта"],
+        "socials": [{"name": "Telegram", "url": "@market"}],
+        "reviews": [
+            {"user": f"Покупатель {i}", "stars": "★★★★☆", "rating": 4, "date": "15.01.2025",
+             "text": "Хороший выбор, свежие продукты 🍎"}
+            for i in range(reviews)
+        ]
+    }
+
+
+def per_request_setup():
+    # То, что раньше выполнялось внутри download_pdf на каждый запрос
+    getSampleStyleSheet()
+    app_module.build_pdf_styles()
+    re.purge()
+    re.compile(app_module.EMOJI_PATTERN.pattern, flags=re.UNICODE)
+
+
+def measure(mode, market, iterations):
+    # Прогрев: шрифты, кэши reportlab
+    app_module.render_market_pdf(market)
+
+    start = time.process_time()
+    for _ in range(iterations):
+        if mode == 'per_request':
+            per_request_setup()
+        app_module.render_market_pdf(market)
+    cpu = (time.process_time() - start) / iterations
+
+    tracemalloc.start()
+    snapshot_before = tracemalloc.take_snapshot()
+    if mode == 'per_request':
+        per_request_setup()
+    app_module.render_market_pdf(market)
+    snapshot_after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    stats = snapshot_after.compare_to(snapshot_before, 'filename')
+    blocks = sum(max(s.count_diff, 0) for s in stats)
+    return cpu, blocks, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--reviews', type=int, default=20, help='число отзывов в карточке')
+    args = parser.parse_args()
+
+    market = sample_market(args.reviews)
+    for mode in ('per_request', 'shared'):
+        cpu, blocks, peak = measure(mode, market, args.iterations)
+        print(f"{mode:>12}: {cpu * 1000:.2f} мс CPU на PDF, "
+              f"удержано блоков {blocks}, пик выделений {peak / 1024:.0f} КБ")
+
+
+if __name__ == '__main__':
+    main()
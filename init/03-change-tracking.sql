@@ -0,0 +1,16 @@
+-- Отслеживание изменений рынков для дельта-выгрузок (/export_changes)
+ALTER TABLE farmers_markets
+    ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now();
+
+CREATE INDEX IF NOT EXISTS idx_farmers_markets_updated_at
+    ON farmers_markets (updated_at, market_id);
+
+-- Удалённые рынки: партнёры должны узнать и об удалениях
+CREATE TABLE IF NOT EXISTS market_tombstones (
+    market_id   INTEGER     NOT NULL,
+    market_name TEXT        NOT NULL,
+    deleted_at  TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS idx_market_tombstones_deleted_at
+    ON market_tombstones (deleted_at, market_id);
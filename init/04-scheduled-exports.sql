@@ -0,0 +1,12 @@
+-- Метаданные для заранее собранных выгрузок и планировщика фоновых задач
+ALTER TABLE file_logs ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT now();
+ALTER TABLE file_logs ADD COLUMN IF NOT EXISTS content_key TEXT;
+
+CREATE INDEX IF NOT EXISTS idx_file_logs_content_key
+    ON file_logs (operation_type, content_key, created_at DESC);
+
+-- Когда каждая задача планировщика выполнялась последний раз (общий для всех воркеров)
+CREATE TABLE IF NOT EXISTS scheduled_job_runs (
+    job_name    TEXT        PRIMARY KEY,
+    last_run_at TIMESTAMPTZ NOT NULL
+);
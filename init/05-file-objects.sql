@@ -0,0 +1,20 @@
+-- Объекты MinIO, адресуемые по содержимому: одно имя (sha256 + расширение) на одинаковые файлы.
+-- ref_count — число строк file_logs, ссылающихся на объект; при нуле объект можно удалить.
+CREATE TABLE IF NOT EXISTS file_objects (
+    hashed_filename    TEXT        PRIMARY KEY,
+    size_bytes         BIGINT,
+    ref_count          INTEGER     NOT NULL DEFAULT 0,
+    created_at         TIMESTAMPTZ NOT NULL DEFAULT now(),
+    last_referenced_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS idx_file_objects_unreferenced
+    ON file_objects (last_referenced_at)
+    WHERE ref_count <= 0;
+
+-- Старые объекты со случайными именами: по одной ссылке на каждую строку журнала
+INSERT INTO file_objects (hashed_filename, ref_count)
+SELECT hashed_filename, COUNT(*)
+FROM file_logs
+GROUP BY hashed_filename
+ON CONFLICT (hashed_filename) DO NOTHING;
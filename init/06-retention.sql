@@ -0,0 +1,9 @@
+-- Холодное хранение: куда перенесён объект (ключ в MinIO) и сколько он там занимает
+ALTER TABLE file_objects ADD COLUMN IF NOT EXISTS cold_key TEXT;
+ALTER TABLE file_objects ADD COLUMN IF NOT EXISTS stored_bytes BIGINT;
+
+-- Поиск устаревших строк по типу операции и проверка ссылок при переносе в холодный префикс
+CREATE INDEX IF NOT EXISTS idx_file_logs_operation_created
+    ON file_logs (operation_type, created_at);
+CREATE INDEX IF NOT EXISTS idx_file_logs_hashed_filename
+    ON file_logs (hashed_filename);
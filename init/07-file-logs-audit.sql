@@ -0,0 +1,71 @@
+-- Журнал file_logs: помесячное секционирование по created_at, индексы для аудита
+-- и дневные агрегаты для планирования объёма хранилища.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- Ключ для постраничного просмотра (created_at, id)
+ALTER TABLE file_logs ADD COLUMN IF NOT EXISTS id BIGSERIAL;
+
+-- Перенос обычной таблицы в секционированную (повторный запуск ничего не делает)
+DO $$
+DECLARE
+    seq   TEXT;
+    month DATE;
+    last  DATE;
+BEGIN
+    IF (SELECT relkind FROM pg_class WHERE oid = 'file_logs'::regclass) <> 'r' THEN
+        RETURN;
+    END IF;
+
+    ALTER TABLE file_logs RENAME TO file_logs_legacy;
+    CREATE TABLE file_logs (LIKE file_logs_legacy INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+        PARTITION BY RANGE (created_at);
+
+    -- Последовательность id должна пережить удаление старой таблицы
+    seq := pg_get_serial_sequence('file_logs_legacy', 'id');
+    IF seq IS NOT NULL THEN
+        EXECUTE format('ALTER SEQUENCE %s OWNED BY file_logs.id', seq);
+    END IF;
+
+    -- Границы секций — полночь первого числа по UTC, независимо от часового пояса сессии
+    -- (так же их задаёт ensure_file_logs_partitions в приложении)
+    month := date_trunc('month', COALESCE((SELECT min(created_at) FROM file_logs_legacy), now()) AT TIME ZONE 'UTC')::date;
+    last := (date_trunc('month', now() AT TIME ZONE 'UTC') + interval '2 months')::date;
+    WHILE month <= last LOOP
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS %I PARTITION OF file_logs FOR VALUES FROM (%L) TO (%L)',
+            'file_logs_' || to_char(month, 'YYYY_MM'),
+            month || ' 00:00:00+00', (month + interval '1 month')::date || ' 00:00:00+00'
+        );
+        month := (month + interval '1 month')::date;
+    END LOOP;
+    CREATE TABLE IF NOT EXISTS file_logs_default PARTITION OF file_logs DEFAULT;
+
+    INSERT INTO file_logs SELECT * FROM file_logs_legacy;
+    DROP TABLE file_logs_legacy;
+END $$;
+
+ALTER TABLE file_logs ALTER COLUMN id SET NOT NULL;
+
+-- Индексы создаются на родительской таблице и наследуются секциями
+CREATE INDEX IF NOT EXISTS idx_file_logs_created_id
+    ON file_logs (created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_file_logs_operation_created
+    ON file_logs (operation_type, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_file_logs_ip_created
+    ON file_logs (user_ip, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_file_logs_filename_trgm
+    ON file_logs USING gin (original_filename gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_file_logs_content_key
+    ON file_logs (operation_type, content_key, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_file_logs_hashed_filename
+    ON file_logs (hashed_filename);
+
+-- Число операций, объём и уникальные IP по дням (московское время) и типам операций
+CREATE TABLE IF NOT EXISTS file_logs_daily (
+    day            DATE    NOT NULL,
+    operation_type TEXT    NOT NULL,
+    operations     BIGINT  NOT NULL,
+    bytes          BIGINT  NOT NULL,
+    unique_ips     BIGINT  NOT NULL,
+    PRIMARY KEY (day, operation_type)
+);
@@ -0,0 +1,34 @@
+-- Дневные сводки отзывов для графиков динамики: пополняются при каждом новом отзыве.
+-- Сводка по рынку удаляется вместе с рынком; сводка по субъекту хранит историю
+-- по субъекту, указанному у рынка на момент отзыва.
+CREATE TABLE IF NOT EXISTS review_daily_market (
+    day          DATE    NOT NULL,
+    market_id    INTEGER NOT NULL REFERENCES farmers_markets (market_id) ON DELETE CASCADE,
+    review_count INTEGER NOT NULL,
+    rating_sum   INTEGER NOT NULL,
+    PRIMARY KEY (market_id, day)
+);
+
+CREATE TABLE IF NOT EXISTS review_daily_state (
+    day          DATE    NOT NULL,
+    state        TEXT    NOT NULL,
+    review_count INTEGER NOT NULL,
+    rating_sum   INTEGER NOT NULL,
+    PRIMARY KEY (state, day)
+);
+
+CREATE INDEX IF NOT EXISTS idx_review_daily_state_day ON review_daily_state (day);
+
+-- Заполнение по уже существующим отзывам
+INSERT INTO review_daily_market (day, market_id, review_count, rating_sum)
+SELECT created_at::date, market_id, COUNT(*), SUM(rating)
+FROM reviews
+GROUP BY created_at::date, market_id
+ON CONFLICT (market_id, day) DO NOTHING;
+
+INSERT INTO review_daily_state (day, state, review_count, rating_sum)
+SELECT r.created_at::date, COALESCE(fm.state, ''), COUNT(*), SUM(r.rating)
+FROM reviews r
+JOIN farmers_markets fm ON fm.market_id = r.market_id
+GROUP BY r.created_at::date, COALESCE(fm.state, '')
+ON CONFLICT (state, day) DO NOTHING;
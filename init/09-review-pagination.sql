@@ -0,0 +1,3 @@
+-- Постраничный вывод отзывов рынка: новые сверху, курсор по (created_at, review_id)
+CREATE INDEX IF NOT EXISTS idx_reviews_market_created
+    ON reviews (market_id, created_at DESC, review_id DESC);
@@ -0,0 +1,29 @@
+-- Распределение оценок по рынку (сколько отзывов с 1…5 звёздами): пополняется при каждом
+-- новом отзыве и удаляется вместе с рынком. Из него страницы берут средний рейтинг,
+-- число отзывов и гистограмму, не читая reviews.
+CREATE TABLE IF NOT EXISTS market_rating_stats (
+    market_id    INTEGER PRIMARY KEY REFERENCES farmers_markets (market_id) ON DELETE CASCADE,
+    stars_1      INTEGER NOT NULL DEFAULT 0,
+    stars_2      INTEGER NOT NULL DEFAULT 0,
+    stars_3      INTEGER NOT NULL DEFAULT 0,
+    stars_4      INTEGER NOT NULL DEFAULT 0,
+    stars_5      INTEGER NOT NULL DEFAULT 0,
+    review_count INTEGER GENERATED ALWAYS AS (stars_1 + stars_2 + stars_3 + stars_4 + stars_5) STORED,
+    rating_sum   INTEGER GENERATED ALWAYS AS (stars_1 + 2 * stars_2 + 3 * stars_3 + 4 * stars_4 + 5 * stars_5) STORED
+);
+
+-- Топ рынков по рейтингу на странице статистики
+CREATE INDEX IF NOT EXISTS idx_market_rating_stats_avg
+    ON market_rating_stats ((rating_sum::numeric / NULLIF(review_count, 0)) DESC, review_count DESC);
+
+-- Заполнение по уже существующим отзывам
+INSERT INTO market_rating_stats (market_id, stars_1, stars_2, stars_3, stars_4, stars_5)
+SELECT market_id,
+       COUNT(*) FILTER (WHERE rating = 1),
+       COUNT(*) FILTER (WHERE rating = 2),
+       COUNT(*) FILTER (WHERE rating = 3),
+       COUNT(*) FILTER (WHERE rating = 4),
+       COUNT(*) FILTER (WHERE rating = 5)
+FROM reviews
+GROUP BY market_id
+ON CONFLICT (market_id) DO NOTHING;
@@ -0,0 +1,10 @@
+-- Индексы поиска: равенство по городу/субъекту/индексу (как в WHERE LOWER(TRIM(...)) = %s)
+-- и прямоугольник вокруг точки для поиска по радиусу.
+CREATE INDEX IF NOT EXISTS idx_farmers_markets_city_search
+    ON farmers_markets (LOWER(TRIM(city)));
+CREATE INDEX IF NOT EXISTS idx_farmers_markets_state_search
+    ON farmers_markets (LOWER(TRIM(state)));
+CREATE INDEX IF NOT EXISTS idx_farmers_markets_zip_search
+    ON farmers_markets (LOWER(TRIM(zip)));
+CREATE INDEX IF NOT EXISTS idx_farmers_markets_coords
+    ON farmers_markets (y, x);
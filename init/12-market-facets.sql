@@ -0,0 +1,19 @@
+-- Фасеты поиска: продукты и способы оплаты рынка одной строкой в виде отсортированных массивов id.
+-- Пересобирается приложением при добавлении, изменении и импорте рынка; удаляется вместе с рынком.
+-- GIN-индексы отвечают на «продаёт всё из списка» (product_ids @> ARRAY[...]) без соединений.
+CREATE TABLE IF NOT EXISTS market_facets (
+    market_id   INTEGER   PRIMARY KEY REFERENCES farmers_markets (market_id) ON DELETE CASCADE,
+    product_ids INTEGER[] NOT NULL DEFAULT '{}',
+    payment_ids INTEGER[] NOT NULL DEFAULT '{}'
+);
+
+CREATE INDEX IF NOT EXISTS idx_market_facets_products ON market_facets USING gin (product_ids);
+CREATE INDEX IF NOT EXISTS idx_market_facets_payments ON market_facets USING gin (payment_ids);
+
+-- Заполнение по уже существующим рынкам
+INSERT INTO market_facets (market_id, product_ids, payment_ids)
+SELECT fm.market_id,
+       COALESCE((SELECT array_agg(product_id ORDER BY product_id) FROM market_products WHERE market_id = fm.market_id), '{}'),
+       COALESCE((SELECT array_agg(payment_id ORDER BY payment_id) FROM market_payments WHERE market_id = fm.market_id), '{}')
+FROM farmers_markets fm
+ON CONFLICT (market_id) DO NOTHING;
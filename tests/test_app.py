@@ -2,13 +2,17 @@
 import sys
 import os
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+# Фоновые потоки (планировщик и т.п.) в тестах не запускаем
+os.environ.setdefault('BACKGROUND_SERVICES_ENABLED', '0')
 
 from app.app import haversine, app
+import app.app as app_module
 
 import bcrypt
 from unittest.mock import patch, MagicMock
 from flask import session
 from datetime import datetime
+from decimal import Decimal
 
 import io
 import pandas as pd
@@ -144,8 +148,9 @@ def test_markets_db_error(mock_get_db):
         assert response.location.endswith('/')
 
 
+@patch('app.app.get_table_counts', return_value={'farmers_markets': {'value': 0, 'mode': 'exact'}})
 @patch('app.app.get_db_connection')
-def test_markets_empty_db(mock_get_db):
+def test_markets_empty_db(mock_get_db, mock_counts):
     """Пустая таблица → отображается пустой список"""
     mock_conn = MagicMock()
     mock_cursor = MagicMock()
@@ -172,8 +177,9 @@ def test_markets_empty_db(mock_get_db):
         # (в коде: total_pages = (0 + 10 - 1) // 10 = 0)
 
 
+@patch('app.app.get_table_counts', return_value={'farmers_markets': {'value': 2, 'mode': 'exact'}})
 @patch('app.app.get_db_connection')
-def test_markets_with_data(mock_get_db):
+def test_markets_with_data(mock_get_db, mock_counts):
     """Корректное отображение списка рынков"""
     mock_conn = MagicMock()
     mock_cursor = MagicMock()
@@ -212,8 +218,9 @@ def test_markets_with_data(mock_get_db):
         assert '★' in html  # звёзды рейтинга
 
 
+@patch('app.app.get_table_counts', return_value={'farmers_markets': {'value': 5, 'mode': 'exact'}})
 @patch('app.app.get_db_connection')
-def test_markets_invalid_page(mock_get_db):
+def test_markets_invalid_page(mock_get_db, mock_counts):
     """Некорректный номер страницы → исправляется на 1"""
     mock_conn = MagicMock()
     mock_cursor = MagicMock()
@@ -232,6 +239,70 @@ def test_markets_invalid_page(mock_get_db):
         assert response.status_code == 302
         assert 'page=1' in response.location
 
+def test_get_table_counts_uses_estimates_for_large_tables():
+    """Большие таблицы — оценка по pg_class, маленькие и без статистики — точный COUNT(*)"""
+    cur = MagicMock()
+    cur.fetchall.return_value = [
+        {'relname': 'reviews', 'estimate': 2500000},
+        {'relname': 'products', 'estimate': 40},
+        {'relname': 'farmers_markets', 'estimate': None}
+    ]
+    cur.fetchone.return_value = {'products': 41, 'farmers_markets': 9000}
+
+    counts = app_module.get_table_counts(cur, ('farmers_markets', 'reviews', 'products'))
+
+    assert counts == {
+        'reviews': {'value': 2500000, 'mode': 'estimate'},
+        'farmers_markets': {'value': 9000, 'mode': 'exact'},
+        'products': {'value': 41, 'mode': 'exact'}
+    }
+    exact_sql = cur.execute.call_args[0][0]
+    assert 'FROM farmers_markets' in exact_sql and 'FROM reviews' not in exact_sql
+
+
+@patch('app.app.get_table_counts', return_value={'farmers_markets': {'value': 95, 'mode': 'estimate'}})
+@patch('app.app.get_db_connection')
+def test_markets_approximate_total(mock_get_db, mock_counts):
+    """При оценке число страниц помечено «≈», а следующая страница доступна, пока есть строки"""
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_get_db.return_value = mock_conn
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_cursor.fetchall.return_value = [
+        {'market_name': f'Рынок {i}', 'city': 'Москва', 'state': 'Москва', 'avg_rating': 4, 'review_count': 1}
+        for i in range(10)
+    ]
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['authenticated'] = True
+
+        html = client.get('/markets?page=12').get_data(as_text=True)
+        assert 'из ≈12' in html
+        assert 'page=13' in html
+
+        mock_cursor.fetchall.return_value = []
+        response = client.get('/markets?page=20')
+        assert response.status_code == 302 and 'page=10' in response.location
+
+
+@patch('app.app.request_exact_counts')
+@patch('app.app.get_table_counts', return_value={'reviews': {'value': 2500000, 'mode': 'estimate'}})
+@patch('app.app.get_db_connection')
+def test_admin_counts_starts_exact_count_in_background(mock_get_db, mock_counts, mock_request):
+    with patch.object(app_module, 'exact_counts', {'counts': None, 'computed_at': None, 'running': False}):
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess['authenticated'] = True
+                sess['is_admin'] = True
+
+            data = client.get('/admin/counts').get_json()
+
+    mock_request.assert_called_once()
+    assert data['display']['reviews']['mode'] == 'estimate'
+    assert data['exact'] == {} and data['exact_computed_at'] is None
+
+
 @patch('app.app.get_db_connection')
 def test_search_requires_auth(mock_get_db):
     """Попытка доступа без авторизации → редирект на /login"""
@@ -261,10 +332,10 @@ def test_search_by_city_success(mock_get_db):
     mock_get_db.return_value = mock_conn
     mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
 
-    mock_cursor.fetchall.return_value = [
+    mock_cursor.fetchall.side_effect = [[
         {'market_name': 'Центральный рынок', 'city': 'Москва', 'state': 'Москва'},
         {'market_name': 'Овощной базар', 'city': 'Москва', 'state': 'Москва'}
-    ]
+    ], []]
 
     with app.test_client() as client:
         with client.session_transaction() as sess:
@@ -285,11 +356,11 @@ def test_search_by_radius_success(mock_get_db):
     mock_get_db.return_value = mock_conn
     mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
 
-    # Возвращаем все рынки (хаверсин фильтрует внутри)
-    mock_cursor.fetchall.return_value = [
-        {'market_name': 'Рынок у моря', 'city': 'Сочи', 'state': 'Краснодарский край', 'lat': 43.5855, 'lon': 39.7231},
-        {'market_name': 'Горный базар', 'city': 'Кисловодск', 'state': 'Ставропольский край', 'lat': 43.9167, 'lon': 42.7167}
-    ]
+    # Расстояние считает и фильтрует БД — приходят только рынки в радиусе
+    mock_cursor.fetchall.side_effect = [[
+        {'market_id': 1, 'market_name': 'Рынок у моря', 'city': 'Сочи', 'state': 'Краснодарский край',
+         'avg_rating': 0, 'rank_rating': None, 'distance': 0.04}
+    ], []]
 
     with app.test_client() as client:
         with client.session_transaction() as sess:
@@ -299,8 +370,42 @@ def test_search_by_radius_success(mock_get_db):
         response = client.get('/search?radius=1&lat=43.5855&lon=39.7231&radius_val=100')
         html = response.get_data(as_text=True)
         assert response.status_code == 200
-        assert 'Рынок у моря' in html
-        assert 'Горный базар' not in html  # слишком далеко (~200+ миль)
+        assert 'Рынок у моря' in html and '0.0 миль' in html
+
+        sql, params = mock_cursor.execute.call_args_list[0][0]
+        assert 'ASIN' in sql and 'fm.y BETWEEN %s AND %s' in sql and 'fm.x BETWEEN %s AND %s' in sql
+        assert 'm.distance <= %s' in sql and 'ORDER BY m.distance' in sql
+        # Прямоугольник ±100 миль: ~1.45° по широте, шире по долготе
+        assert abs(params[3] - (43.5855 - 1.447)) < 0.01 and params[5] < 39.7231 - 1.447
+        assert params[-2:] == (100.0, app_module.SEARCH_PAGE_SIZE + 1)
+
+
+def test_search_radius_sql_matches_haversine():
+    """Прямоугольник вокруг точки не отсекает рынки, до которых ровно радиус"""
+    lat, lon = 55.7558, 37.6176
+    radius = app_module.haversine(lat, lon, 59.9343, 30.3351)
+    sql, params, _ = app_module.build_search_query('city', '', (lat, lon, radius), '0')
+    y_min, y_max, x_min, x_max = params[3:7]
+    assert y_min <= 59.9343 <= y_max and x_min <= 30.3351 <= x_max
+    # У полюса прямоугольник по долготе не строится
+    sql, params, _ = app_module.build_search_query('city', '', (89.99, 0.0, 100.0), '0')
+    assert 'fm.x BETWEEN' not in sql
+
+
+def test_search_radius_box_wraps_antimeridian():
+    """Точка у 180°: рынок по ту сторону антимеридиана в радиусе не отсекается прямоугольником"""
+    lat, lon = 65.0, 179.9
+    market_lat, market_lon = 65.0, -179.8
+    radius = 50 / 1.609344
+    assert app_module.haversine(lat, lon, market_lat, market_lon) <= radius
+    sql, params, _ = app_module.build_search_query('city', '', (lat, lon, radius), '0')
+    assert '(fm.x BETWEEN %s AND 180 OR fm.x BETWEEN -180 AND %s)' in sql
+    east_from, west_to = params[5:7]
+    assert east_from <= lon and (east_from <= market_lon <= 180 or -180 <= market_lon <= west_to)
+    # То же с другой стороны
+    sql, params, _ = app_module.build_search_query('city', '', (lat, -179.9, radius), '0')
+    assert '(fm.x BETWEEN %s AND 180 OR fm.x BETWEEN -180 AND %s)' in sql
+    assert params[5] <= 179.8 <= 180 and -180 <= -179.9 <= params[6]
 
 
 @patch('app.app.get_db_connection')
@@ -323,12 +428,9 @@ def test_search_sort_by_rating(mock_get_db):
     mock_get_db.return_value = mock_conn
     mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
 
-    # Первый вызов — основной SELECT
-    mock_cursor.fetchall.side_effect = [
-        [{'market_name': 'Маркет А', 'city': 'СПб', 'state': 'СПб'}],
-        [{'market_name': 'Маркет А', 'avg_rating': 4.7}]
-    ]
-    mock_cursor.fetchone.return_value = {'avg_rating': 4.7}
+    mock_cursor.fetchall.side_effect = [[
+        {'market_id': 5, 'market_name': 'Маркет А', 'city': 'СПб', 'state': 'СПб', 'avg_rating': 4.7, 'rank_rating': 4.4}
+    ], []]
 
     with app.test_client() as client:
         with client.session_transaction() as sess:
@@ -337,9 +439,158 @@ def test_search_sort_by_rating(mock_get_db):
         response = client.get('/search?mode=city&q=СПб&sort=3')
         html = response.get_data(as_text=True)
         assert response.status_code == 200
-        assert 'Маркет А' in html
-        # Проверим, что был второй запрос к БД для рейтинга
-        assert mock_cursor.execute.call_count >= 2
+        assert 'Маркет А' in html and '★4.7' in html
+        # Рейтинг, сортировка и LIMIT — в одном запросе, без списка названий (второй — счётчики фасетов)
+        assert mock_cursor.execute.call_count == 2
+        sql, params = mock_cursor.execute.call_args_list[0][0]
+        assert 'market_rating_stats s ON s.market_id = fm.market_id' in sql
+        assert 'ORDER BY m.rank_rating DESC' in sql and sql.rstrip().endswith('LIMIT %s')
+        assert ' IN (' not in sql
+        assert params == ('спб', app_module.SEARCH_PAGE_SIZE + 1)
+
+
+@patch('app.app.get_db_connection')
+def test_search_paginates_with_keyset_cursor(mock_get_db):
+    """Страница поиска: LIMIT n+1, cursor по (рейтинг, market_id), оценка общего числа по плану"""
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_get_db.return_value = mock_conn
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    page = [
+        {'market_id': i, 'market_name': f'Рынок {i}', 'city': 'Москва', 'state': 'Москва',
+         'avg_rating': 4.0, 'rank_rating': Decimal('4.25')}
+        for i in (3, 8, 9)
+    ]
+    mock_cursor.fetchall.side_effect = [page, [], page, []]
+    mock_cursor.fetchone.return_value = {'QUERY PLAN': [{'Plan': {'Plan Rows': 40}}]}
+
+    with patch.object(app_module, 'SEARCH_PAGE_SIZE', 2), app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['authenticated'] = True
+
+        html = client.get('/search?mode=city&q=Москва&sort=3').get_data(as_text=True)
+        assert 'Рынок 8' in html and 'Рынок 9' not in html
+        assert 'Результаты (≈40)' in html
+        assert 'cursor=4.25%7C8' in html
+        explain_sql = mock_cursor.execute.call_args_list[1][0][0]
+        assert explain_sql.startswith('EXPLAIN (FORMAT JSON)') and 'LIMIT' not in explain_sql
+
+        mock_cursor.execute.reset_mock()
+        html = client.get('/search?mode=city&q=Москва&sort=3&cursor=4.25|8').get_data(as_text=True)
+        sql, params = mock_cursor.execute.call_args_list[0][0]
+        assert '(m.rank_rating < %s OR (m.rank_rating = %s AND m.market_id > %s))' in sql
+        assert params == ('москва', Decimal('4.25'), Decimal('4.25'), 8, 3)
+        assert '← В начало' in html
+
+        html = client.get('/search?mode=city&q=Москва&sort=3&cursor=много|8').get_data(as_text=True)
+        assert 'Некорректная ссылка на следующую страницу результатов' in html
+
+
+@patch('app.app.get_db_connection')
+def test_search_by_facets(mock_get_db):
+    """Мёд и оплата картой в Москве: пересечение массивов market_facets и счётчики по фасетам"""
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_get_db.return_value = mock_conn
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_cursor.fetchall.side_effect = [
+        [{'market_id': 1, 'market_name': 'Центральный рынок', 'city': 'Москва', 'state': 'Москва',
+          'avg_rating': 0, 'rank_rating': 0}],
+        [{'facet': 'payment', 'id': 2, 'name': 'Карта', 'count': 1},
+         {'facet': 'product', 'id': 3, 'name': 'Мёд', 'count': 1},
+         {'facet': 'product', 'id': 7, 'name': 'Овощи', 'count': 1},
+         {'facet': 'product', 'id': 1, 'name': 'Сыр', 'count': 0}]
+    ]
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['authenticated'] = True
+
+        html = client.get('/search?mode=city&q=Москва&product=3&product=1&payment=2').get_data(as_text=True)
+        assert 'Центральный рынок' in html
+        assert 'value="3" checked> Мёд (1)' in html and 'value="7" > Овощи (1)' in html
+        assert 'value="1" checked> Сыр (0)' in html and 'value="2" checked> Карта (1)' in html
+
+        sql, params = mock_cursor.execute.call_args_list[0][0]
+        assert 'JOIN market_facets f ON f.market_id = fm.market_id' in sql
+        assert 'f.product_ids @> %s::int[]' in sql and 'f.payment_ids @> %s::int[]' in sql
+        assert params[:3] == ('москва', [1, 3], [2])
+
+        facet_sql, facet_params = mock_cursor.execute.call_args_list[1][0]
+        assert facet_sql.strip().startswith('WITH matched AS') and 'unnest(f.product_ids)' in facet_sql
+        assert facet_params == ('москва', [1, 3], [2], [1, 3], [2])
+
+
+@patch('app.app.get_db_connection')
+def test_search_by_facets_without_location(mock_get_db):
+    """Только фасеты, без города — поиск по всем рынкам"""
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_get_db.return_value = mock_conn
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_cursor.fetchall.side_effect = [[], []]
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['authenticated'] = True
+
+        response = client.get('/search?mode=city&product=3')
+        assert 'введите значение' not in response.get_data(as_text=True)
+        sql, params = mock_cursor.execute.call_args_list[0][0]
+        assert 'LOWER(TRIM' not in sql and params[0] == [3]
+
+
+@patch('app.app.get_db_connection')
+def test_search_facets_ignore_non_ascii_digits(mock_get_db):
+    """'²'.isdigit() истинно, но int('²') падает — такое значение фасета просто отбрасывается"""
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_get_db.return_value = mock_conn
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_cursor.fetchall.side_effect = [[], []]
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['authenticated'] = True
+
+        response = client.get('/search?mode=city&q=Москва&product=²&product=٣')
+        assert response.status_code == 200
+        sql, params = mock_cursor.execute.call_args_list[0][0]
+        assert 'product_ids' not in sql and params[0] == 'москва'
+
+
+@patch('app.app.get_db_connection')
+def test_search_pdf_link_keeps_facets(mock_get_db):
+    """Ссылка на ZIP передаёт выбранные фасеты — архив совпадает с выдачей на экране"""
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_get_db.return_value = mock_conn
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_cursor.fetchall.side_effect = [
+        [{'market_id': 1, 'market_name': 'Центральный рынок', 'city': 'Москва', 'state': 'Москва',
+          'avg_rating': 0, 'rank_rating': 0}],
+        []
+    ]
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['authenticated'] = True
+
+        html = client.get('/search?mode=city&q=Москва&product=3&payment=2').get_data(as_text=True)
+        link = html.split('download_pdf_batch?', 1)[1].split('"', 1)[0]
+        assert 'product=3' in link and 'payment=2' in link
+
+
+@patch('app.app.get_db_connection')
+def test_search_rejects_unknown_mode(mock_get_db):
+    """Тип поиска подставляется в SQL как имя столбца — только из белого списка"""
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['authenticated'] = True
+
+        response = client.get('/search?mode=market_name)--&q=x')
+        assert 'Неизвестный тип поиска' in response.get_data(as_text=True)
+        mock_get_db.assert_not_called()
 
 
 @patch('app.app.get_db_connection')
@@ -354,6 +605,92 @@ def test_search_db_error(mock_get_db):
         assert response.status_code == 200
         assert 'Ошибка подключения к БД' in response.get_data(as_text=True)
 
+def empty_autocomplete_index():
+    return {'markets': {}, 'keys': {f: [] for f in app_module.AUTOCOMPLETE_FIELDS},
+            'values': {f: {} for f in app_module.AUTOCOMPLETE_FIELDS}, 'synced_at': None, 'checked_at': None}
+
+
+def test_autocomplete_index_prefix_and_updates():
+    """Префиксный поиск по отсортированному списку; изменение и удаление рынка правят индекс на месте"""
+    with patch.object(app_module, 'autocomplete_index', empty_autocomplete_index()):
+        app_module._autocomplete_add({'market_id': 1, 'market_name': 'Центральный рынок', 'city': 'Москва', 'state': 'Москва'})
+        app_module._autocomplete_add({'market_id': 2, 'market_name': 'Цветочный базар', 'city': ' Москва', 'state': 'Москва'})
+        app_module._autocomplete_add({'market_id': 3, 'market_name': 'Овощной', 'city': 'Мурманск', 'state': None})
+
+        assert app_module.autocomplete_suggestions('market_name', 'ц') == ['Цветочный базар', 'Центральный рынок']
+        assert app_module.autocomplete_suggestions('market_name', 'ЦЕН') == ['Центральный рынок']
+        assert app_module.autocomplete_suggestions('city', 'м') == ['Москва', 'Мурманск']
+        assert app_module.autocomplete_suggestions('city', 'м', limit=1) == ['Москва']
+        assert app_module.autocomplete_index['values']['city']['москва'][1] == 2
+
+        # Рынок переехал: старый город остаётся, пока на него ссылается другой рынок
+        app_module._autocomplete_add({'market_id': 2, 'market_name': 'Цветочный базар', 'city': 'Тверь', 'state': 'Тверская обл.'})
+        assert app_module.autocomplete_suggestions('city', 'м') == ['Москва', 'Мурманск']
+        app_module._autocomplete_remove(1)
+        assert app_module.autocomplete_suggestions('city', 'м') == ['Мурманск']
+        assert app_module.autocomplete_suggestions('market_name', 'ц') == ['Цветочный базар']
+        assert app_module.autocomplete_index['keys']['state'] == ['тверская обл.']
+
+
+@patch('app.app.get_db_connection')
+def test_autocomplete_endpoint_loads_once_then_syncs_changes(mock_get_db):
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_get_db.return_value = mock_conn
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    synced_at = datetime(2025, 1, 15, 12, 0)
+    mock_cursor.fetchone.return_value = {'now': synced_at}
+    mock_cursor.fetchall.return_value = [
+        {'market_id': 1, 'market_name': 'Центральный рынок', 'city': 'Москва', 'state': 'Москва'}
+    ]
+
+    with patch.object(app_module, 'autocomplete_index', empty_autocomplete_index()), app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['authenticated'] = True
+
+        data = client.get('/autocomplete?field=market_name&q=цент').get_json()
+        assert data == {'field': 'market_name', 'suggestions': ['Центральный рынок']}
+        assert 'updated_at' not in mock_cursor.execute.call_args[0][0]
+
+        # Повторный запрос — из памяти
+        mock_get_db.reset_mock()
+        client.get('/autocomplete?field=city&q=мо')
+        mock_get_db.assert_not_called()
+
+        # После изменения рынков в этом воркере — догрузка только изменений
+        app_module.mark_autocomplete_stale()
+        mock_cursor.fetchall.side_effect = [[], [{'market_id': 1}]]
+        data = client.get('/autocomplete?field=market_name&q=цент').get_json()
+        assert data['suggestions'] == []
+        delta_sql, delta_params = mock_cursor.execute.call_args_list[-2][0]
+        assert 'updated_at > %s' in delta_sql and delta_params == (synced_at - app_module.AUTOCOMPLETE_SYNC_OVERLAP,)
+        assert 'market_tombstones' in mock_cursor.execute.call_args[0][0]
+
+        assert client.get('/autocomplete?field=zip&q=1').status_code == 400
+
+
+@patch('app.app.refresh_autocomplete_index')
+def test_autocomplete_refreshes_right_after_boot(mock_refresh):
+    """Монотонные часы только что запущенной машины меньше интервала обновления — индекс всё равно грузится"""
+    def refresh():
+        app_module.autocomplete_index.update(synced_at=datetime(2025, 1, 15), checked_at=app_module.time.monotonic())
+    mock_refresh.side_effect = refresh
+
+    with patch.object(app_module, 'autocomplete_index', empty_autocomplete_index()), \
+            patch('app.app.time.monotonic', return_value=5.0), app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['authenticated'] = True
+
+        assert client.get('/autocomplete?q=цент').status_code == 200
+        assert mock_refresh.call_count == 1
+        client.get('/autocomplete?q=цент')
+        assert mock_refresh.call_count == 1
+
+        app_module.mark_autocomplete_stale()
+        client.get('/autocomplete?q=цент')
+        assert mock_refresh.call_count == 2
+
+
 @patch('app.app.get_db_connection')
 def test_detail_requires_auth(mock_get_db):
     """Попытка доступа без авторизации → редирект на /login"""
@@ -423,6 +760,10 @@ def test_detail_success(mock_get_db):
             mock_cursor.fetchall.return_value = payments
         elif 'market_social_links' in query:
             mock_cursor.fetchall.return_value = socials
+        elif 'market_rating_stats' in query:
+            mock_cursor.fetchall.return_value = [
+                {'market_id': 1, 'stars_1': 0, 'stars_2': 0, 'stars_3': 1, 'stars_4': 0, 'stars_5': 3}
+            ]
         elif 'reviews' in query:
             mock_cursor.fetchall.return_value = reviews
         else:
@@ -451,6 +792,51 @@ def test_detail_success(mock_get_db):
         assert 'Иван' in html
         assert '★★★★★' in html
         assert '15.01.2025' in html
+        # Средний рейтинг и распределение — из market_rating_stats
+        assert 'Отзывы (4, средний рейтинг 4.50)' in html
+        assert '★★★★★ ███████████████ 3' in html and '★★★☆☆ █████ 1' in html and '★☆☆☆☆  0' in html
+        assert not any('FROM reviews' in c[0][0] and 'GROUP BY' in c[0][0] for c in mock_cursor.execute.call_args_list)
+
+
+def test_fetch_reviews_page_keyset():
+    """Отзывы страницами: LIMIT n+1 определяет, есть ли продолжение; курсор — (created_at, review_id)"""
+    cur = MagicMock()
+    cur.fetchall.return_value = [
+        {'review_id': 10 - i, 'user_name': 'Иван', 'rating': 5, 'review_text': None,
+         'created_at': datetime(2025, 1, 15 - i)}
+        for i in range(3)
+    ]
+
+    rows, cursor = app_module.fetch_reviews_page(cur, 7, limit=2)
+    assert len(rows) == 2 and cursor == '2025-01-14T00:00:00|9'
+    assert cur.execute.call_args[0][1] == (7, 3)
+
+    cur.fetchall.return_value = cur.fetchall.return_value[2:]
+    rows, next_cursor = app_module.fetch_reviews_page(cur, 7, cursor, limit=2)
+    sql, params = cur.execute.call_args[0]
+    assert '(created_at, review_id) < (%s, %s)' in sql
+    assert params == (7, datetime(2025, 1, 14), 9, 3)
+    assert len(rows) == 1 and next_cursor is None
+
+
+@patch('app.app.get_db_connection')
+def test_detail_reviews_load_more(mock_get_db):
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_get_db.return_value = mock_conn
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_cursor.fetchall.return_value = [
+        {'review_id': 3, 'user_name': 'Пётр', 'rating': 4, 'review_text': 'Хорошо', 'created_at': datetime(2025, 1, 10)}
+    ]
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['authenticated'] = True
+
+        data = client.get('/detail/reviews?market_id=7&cursor=2025-01-14T00:00:00|9').get_json()
+        assert data == {'reviews': [{'user': 'Пётр', 'stars': '★★★★☆', 'rating': 4, 'date': '10.01.2025',
+                                     'text': 'Хорошо'}], 'next_cursor': None}
+        assert client.get('/detail/reviews?market_id=7&cursor=вчера').status_code == 400
 
 
 @patch('app.app.get_db_connection')
@@ -553,7 +939,7 @@ def test_feedback_success(mock_get_db):
     mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
 
     # Настройка: первый fetchone() вернёт market_id, второй — ничего (для INSERT не используется)
-    mock_cursor.fetchone.return_value = {'market_id': 123}
+    mock_cursor.fetchone.side_effect = [{'market_id': 123}, {'review_id': 77}]
 
     with app.test_client() as client:
         with client.session_transaction() as sess:
@@ -586,8 +972,92 @@ def test_feedback_success(mock_get_db):
         args = insert_calls[0][0]  # (query, params)
         assert args[1] == (123, 'Иван', 5, 'Отличный рынок!')
 
+        # Новый отзыв сразу попадает в дневные сводки — в той же транзакции
+        rollup_sql, rollup_params = mock_cursor.execute.call_args[0]
+        assert 'review_daily_market' in rollup_sql and 'review_daily_state' in rollup_sql
+        assert 'market_rating_stats' in rollup_sql
+        assert rollup_params == ([77],)
+
         mock_conn.commit.assert_called_once()
 
+@patch('app.app.execute_values')
+@patch('app.app.get_db_connection')
+def test_bulk_reviews_json_per_row_results(mock_get_db, mock_execute_values):
+    """Пакет JSON: одна выборка рынков, одна вставка, одно обновление сводок, результат по строкам"""
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_get_db.return_value = mock_conn
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_cursor.fetchall.return_value = [{'name_key': 'центральный рынок', 'market_id': 1}]
+    # RETURNING может вернуть строки не в порядке VALUES — результат сопоставляется по значениям
+    mock_execute_values.return_value = [
+        {'review_id': 502, 'market_id': 1, 'user_name': 'Анна', 'rating': 3, 'review_text': None},
+        {'review_id': 501, 'market_id': 1, 'user_name': 'Иван', 'rating': 5, 'review_text': 'Отлично'}
+    ]
+
+    batch = {'reviews': [
+        {'market_name': 'Центральный рынок', 'user_name': 'Иван', 'rating': 5, 'review_text': 'Отлично'},
+        {'market_name': 'Неизвестный', 'user_name': 'Пётр', 'rating': 4},
+        {'market_name': 'центральный рынок ', 'user_name': 'Анна', 'rating': '3'},
+        {'market_name': 'Центральный рынок', 'user_name': 'Олег', 'rating': 9}
+    ]}
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['authenticated'] = True
+
+        data = client.post('/reviews/bulk', json=batch).get_json()
+
+    assert data['created'] == 2 and data['failed'] == 2
+    assert [r['status'] for r in data['results']] == ['created', 'error', 'created', 'error']
+    assert data['results'][1]['error'] == 'Рынок не найден'
+    assert data['results'][0]['review_id'] == 501 and data['results'][2]['review_id'] == 502
+    assert mock_cursor.execute.call_args_list[0][0][1] == (['неизвестный', 'центральный рынок'],)
+    assert mock_execute_values.call_args[0][2] == [(1, 'Иван', 5, 'Отлично'), (1, 'Анна', 3, None)]
+    assert sorted(mock_cursor.execute.call_args[0][1][0]) == [501, 502]
+    mock_conn.commit.assert_called_once()
+
+
+def test_validate_bulk_review_rating_types():
+    """Рейтинг принимается только целым: 4.9 и true не округляются молча"""
+    def check(rating):
+        return app_module.validate_bulk_review({'market_name': 'Рынок', 'user_name': 'Иван', 'rating': rating})
+
+    error = "Рейтинг должен быть числом от 1 до 5"
+    assert check(4.9) == error
+    assert check(True) == error
+    assert check('4.5') == error and check('пять') == error and check('²') == error and check(None) == error
+    assert check('5') == ('Рынок', 'Иван', 5, None)
+    assert check(4.0) == ('Рынок', 'Иван', 4, None)
+    assert check(0) == error
+
+
+@patch('app.app.execute_values')
+@patch('app.app.get_db_connection')
+def test_bulk_reviews_csv(mock_get_db, mock_execute_values):
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_get_db.return_value = mock_conn
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_cursor.fetchall.return_value = [{'name_key': 'зелёный базар', 'market_id': 2}]
+    mock_execute_values.return_value = [
+        {'review_id': 7, 'market_id': 2, 'user_name': 'Мария', 'rating': 4, 'review_text': 'Свежие овощи'}
+    ]
+    csv_data = "market_name,user_name,rating,review_text\nЗелёный базар,Мария,4,Свежие овощи\n".encode('utf-8-sig')
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['authenticated'] = True
+
+        data = client.post('/reviews/bulk', data={'file': (BytesIO(csv_data), 'reviews.csv')},
+                           content_type='multipart/form-data').get_json()
+        assert data['created'] == 1
+        assert mock_execute_values.call_args[0][2] == [(2, 'Мария', 4, 'Свежие овощи')]
+
+        response = client.post('/reviews/bulk', data=b'name;rating\n', content_type='text/csv')
+        assert response.status_code == 400
+
+
 @patch('app.app.get_db_connection')
 def test_delete_requires_auth(mock_get_db):
     """Неавторизованный пользователь → редирект на /login"""
@@ -682,10 +1152,10 @@ def test_delete_success(mock_get_db):
 
         # Или: проверяем, что flash-сообщение было добавлено (косвенно через контекст)
         # Но проще — довериться логике и проверить SQL
-        mock_cursor.execute.assert_any_call(
-            "DELETE FROM farmers_markets WHERE LOWER(TRIM(market_name)) = %s RETURNING market_id",
-            ("центральный рынок",)
-        )
+        query, params = mock_cursor.execute.call_args[0]
+        assert "DELETE FROM farmers_markets" in query
+        assert "INSERT INTO market_tombstones" in query
+        assert params == ("центральный рынок",)
         mock_conn.commit.assert_called_once()
 
 @patch('app.app.get_db_connection')
@@ -821,6 +1291,8 @@ def test_add_market_success(mock_get_db):
         assert any("INSERT INTO market_products" in q for q, _ in calls)
         assert any("INSERT INTO market_payments" in q for q, _ in calls)
         assert any("INSERT INTO market_social_links" in q for q, _ in calls)
+        # Фасеты поиска пересобираются в той же транзакции
+        assert any("INSERT INTO market_facets" in q for q, _ in calls)
 
         mock_conn.commit.assert_called_once()
 
@@ -917,8 +1389,9 @@ def test_import_markets_success(mock_get_db, mock_save_file):
         assert response.status_code == 302
         assert response.location.endswith('/markets')
 
-        # Проверяем, что save_file_to_minio_and_log был вызван
+        # Проверяем, что save_file_to_minio_and_log был вызван — с байтами файла, без временного файла
         mock_save_file.assert_called_once()
+        assert isinstance(mock_save_file.call_args[0][0], bytes)
 
         # Проверяем, что основной INSERT выполнен
         insert_calls = [call for call in mock_cursor.execute.call_args_list if 'INSERT INTO farmers_markets' in call[0][0]]
@@ -927,6 +1400,53 @@ def test_import_markets_success(mock_get_db, mock_save_file):
         # Теперь commit вызывается ТОЛЬКО один раз — в основном блоке
         mock_conn.commit.assert_called_once()
 
+@patch('app.app.archive_file')
+@patch('app.app.get_db_connection')
+def test_import_markets_archives_only_committed_import(mock_get_db, mock_archive):
+    """Файл архивируется после commit; неудачный импорт в file_logs не попадает"""
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_get_db.return_value = mock_conn
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_cursor.fetchall.return_value = []
+    mock_cursor.fetchone.return_value = {'market_id': 999}
+
+    df = pd.DataFrame({'market_name': ['Новый рынок'], 'street': ['Ленина, 1'], 'city': ['Москва'],
+                       'state': ['Москва'], 'zip': ['101000']})
+    file_data = io.BytesIO()
+    df.to_excel(file_data, index=False)
+    workbook = file_data.getvalue()
+
+    def post():
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess['authenticated'] = True
+                sess['is_admin'] = True
+            return client.post('/import_markets', data={'excel_file': (io.BytesIO(workbook), 'test.xlsx')},
+                               content_type='multipart/form-data')
+
+    # commit не прошёл — архива нет
+    mock_conn.commit.side_effect = Exception("could not serialize access")
+    assert post().location.endswith('/import_markets')
+    mock_archive.assert_not_called()
+
+    # Строка с ошибкой откатывается до точки сохранения; ни одного рынка — архива нет
+    mock_conn.commit.side_effect = None
+    mock_cursor.execute.side_effect = lambda sql, *args: (_ for _ in ()).throw(Exception("duplicate key")) \
+        if 'INSERT INTO farmers_markets' in sql else None
+    post()
+    statements = [c[0][0] for c in mock_cursor.execute.call_args_list]
+    assert 'ROLLBACK TO SAVEPOINT import_row' in statements
+    mock_archive.assert_not_called()
+
+    # Успешный импорт — архивируется после commit
+    mock_cursor.execute.side_effect = None
+    mock_conn.commit.side_effect = lambda: mock_archive.assert_not_called()
+    post()
+    mock_archive.assert_called_once()
+    assert mock_archive.call_args[0][1:3] == ('test.xlsx', 'import')
+
+
 @patch('app.app.get_db_connection')
 def test_import_markets_missing_columns(mock_get_db):
     mock_conn = MagicMock()
@@ -1257,129 +1777,1173 @@ def test_download_pdf_success(mock_get_db, mock_save_file):
         # Проверяем, что PDF не пустой
         assert len(response.data) > 1000
 
-@patch('app.app.save_file_to_minio_and_log')
-@patch('app.app.create_engine')
-def test_export_all_success(mock_create_engine, mock_save_file):
-    mock_conn = MagicMock()
-    mock_result = MagicMock()
-    mock_engine = MagicMock()
-    mock_create_engine.return_value = mock_engine
-    mock_engine.connect.return_value.__enter__.return_value = mock_conn
+PDF_MARKET = {
+    "name": "Центральный рынок",
+    "address": "Ленина, 1, Москва, Москва 101000",
+    "coords": "(55.7558, 37.6176)",
+    "location": "У фонтана",
+    "products": ["Овощи"],
+    "payments": ["Наличные"],
+    "socials": [{"name": "Instagram", "url": "https://insta.com"}],
+    "reviews": [{"user": "Иван", "stars": "★★★★★", "rating": 5, "date": "15.01.2025", "text": "Отлично!"}]
+}
 
-    mock_result.keys.return_value = ['market_name', 'city', 'state', 'zip']
-    mock_result.fetchmany.side_effect = [
-        [('Центральный рынок', 'Москва', 'Москва', '101000')],
-        []
-    ]
-    mock_conn.execution_options.return_value.execute.return_value = mock_result
 
-    with app.test_client() as client:
-        with client.session_transaction() as sess:
-            sess['authenticated'] = True
+@patch('app.app.save_file_to_minio_and_log')
+@patch('app.app.render_market_pdf', return_value=b'%PDF-1.4 cached')
+@patch('app.app.fetch_market_pdf_data')
+@patch('app.app.get_db_connection')
+def test_download_pdf_uses_cache(mock_get_db, mock_fetch, mock_render, mock_save_file, tmp_path):
+    """Повторная загрузка неизменившегося рынка не вызывает reportlab; изменение данных — вызывает"""
+    mock_fetch.return_value = dict(PDF_MARKET)
+
+    with patch.object(app_module, 'PDF_CACHE_DIR', str(tmp_path)):
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess['authenticated'] = True
+
+            first = client.get('/download_pdf?name=Центральный+рынок')
+            second = client.get('/download_pdf?name=Центральный+рынок')
+            assert first.data == second.data == b'%PDF-1.4 cached'
+            assert mock_render.call_count == 1
+
+            # Новый отзыв меняет хеш содержимого → PDF строится заново
+            changed = dict(PDF_MARKET)
+            changed['reviews'] = PDF_MARKET['reviews'] + [
+                {"user": "Пётр", "stars": "★★★☆☆", "rating": 3, "date": "16.01.2025", "text": ""}
+            ]
+            mock_fetch.return_value = changed
+            client.get('/download_pdf?name=Центральный+рынок')
+            assert mock_render.call_count == 2
 
-        response = client.get('/export_all')
-        assert response.status_code == 200
-        assert response.headers['Content-Type'] == 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    content_key = mock_save_file.call_args.kwargs['content_key']
+    assert content_key == f"pdf:{app_module.market_content_hash(changed)}"
 
-        # Проверяем, что имя файла содержит .xlsx (имя может быть закодировано)
-        content_disp = response.headers.get('Content-Disposition', '')
-        assert '.xlsx' in content_disp
 
-        # Проверяем Excel
-        excel_data = io.BytesIO(response.data)
-        df = pd.read_excel(excel_data)
-        assert list(df.columns) == ['market_name', 'city', 'state', 'zip']
-        assert len(df) == 1
+def test_fetch_markets_pdf_data_is_set_based():
+    """Пакетная выборка делает один запрос на таблицу и группирует строки по рынкам"""
+    mock_cursor = MagicMock()
+    rows = [
+        {'market_id': 1, 'market_name': 'А', 'street': 'ул. 1', 'city': 'Москва', 'state': 'Москва',
+         'zip': '101000', 'x': None, 'y': None, 'location': None},
+        {'market_id': 2, 'market_name': 'Б', 'street': 'ул. 2', 'city': 'Москва', 'state': 'Москва',
+         'zip': '101001', 'x': 37.6, 'y': 55.7, 'location': 'У метро'}
+    ]
+    mock_cursor.fetchall.side_effect = [
+        rows,
+        [{'market_id': 1, 'product_name': 'Мёд'}, {'market_id': 2, 'product_name': 'Овощи'}],
+        [{'market_id': 2, 'payment_name': 'Карта'}],
+        [],
+        [{'market_id': 1, 'user_name': 'Иван', 'rating': 4, 'review_text': None, 'created_at': datetime(2025, 1, 15)}],
+        [{'market_id': 1, 'stars_1': 10, 'stars_2': 10, 'stars_3': 20, 'stars_4': 30, 'stars_5': 50}]
+    ]
 
-        mock_save_file.assert_called_once()
+    markets = app_module.fetch_markets_pdf_data(mock_cursor, "LOWER(TRIM(city)) = %s", ('москва',))
 
+    assert mock_cursor.execute.call_count == 6
+    calls = mock_cursor.execute.call_args_list
+    assert all('ANY(%s)' in c[0][0] for c in calls[1:4] + calls[5:])
+    # Отзывы — не больше PDF_REVIEW_LIMIT на рынок
+    assert 'LATERAL' in calls[4][0][0] and calls[4][0][1][1] == app_module.PDF_REVIEW_LIMIT
+    assert markets[0]['review_count'] == 120 and markets[1]['review_count'] == 0
+    assert markets[0]['avg_rating'] == 3.83 and markets[1]['avg_rating'] is None
+    assert [m['name'] for m in markets] == ['А', 'Б']
+    assert markets[0]['products'] == ['Мёд'] and markets[0]['payments'] == []
+    assert markets[0]['coords'] == 'не указаны'
+    assert markets[0]['reviews'][0]['stars'] == '★★★★☆'
+    assert markets[1]['payments'] == ['Карта'] and markets[1]['reviews'] == []
 
-@patch('app.app.create_engine')
-def test_export_all_db_error(mock_create_engine):
-    mock_create_engine.side_effect = Exception("Connection failed")
 
+def test_download_pdf_batch_requires_filter():
+    """Без названий и фильтра → возврат к поиску"""
     with app.test_client() as client:
         with client.session_transaction() as sess:
             sess['authenticated'] = True
 
-        response = client.get('/export_all')
+        response = client.get('/download_pdf_batch')
         assert response.status_code == 302
-        assert response.location.endswith('/markets')
+        assert response.location.endswith('/search')
+
 
+@patch('app.app.save_file_to_minio_and_log')
+@patch('app.app.render_market_pdf', side_effect=lambda m: f"%PDF {m['name']}".encode())
+@patch('app.app.fetch_markets_pdf_data')
 @patch('app.app.get_db_connection')
-def test_stats_requires_auth(mock_get_db):
-    """Неавторизованный → редирект на /login"""
-    with app.test_client() as client:
-        response = client.get('/stats', follow_redirects=False)
-        assert response.status_code == 302
-        assert response.location.endswith('/')
+def test_download_pdf_batch_streams_zip(mock_get_db, mock_fetch, mock_render, mock_save_file, tmp_path):
+    """Архив содержит PDF каждого рынка, одинаковые названия не перетирают друг друга"""
+    from concurrent.futures import ThreadPoolExecutor
+    import zipfile
+
+    first = dict(PDF_MARKET)
+    second = dict(PDF_MARKET, address='Другой адрес')
+    mock_fetch.return_value = [first, second]
+    mock_get_db.return_value.cursor.return_value.__enter__.return_value.fetchone.return_value = {'found': 2}
+
+    with patch.object(app_module, 'PDF_CACHE_DIR', str(tmp_path)), \
+         patch('app.app.ProcessPoolExecutor', ThreadPoolExecutor):
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess['authenticated'] = True
+
+            response = client.get('/download_pdf_batch?mode=city&q=Москва')
+            assert response.status_code == 200
+            assert response.headers['Content-Type'] == 'application/zip'
+            data = response.get_data()
 
+    where_sql, params = mock_fetch.call_args[0][1:]
+    assert 'city' in where_sql and params == ('москва',)
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert sorted(zf.namelist()) == ['Рынок_Центральный_рынок.pdf', 'Рынок_Центральный_рынок_2.pdf']
+    assert mock_render.call_count == 2
+    assert mock_save_file.call_args[0][2] == 'pdf_batch_export'
 
+
+@patch('app.app.fetch_markets_pdf_data')
 @patch('app.app.get_db_connection')
-def test_stats_db_error(mock_get_db):
-    """Ошибка подключения к БД → flash и редирект на /login"""
-    mock_get_db.return_value = None
+def test_download_pdf_batch_refuses_over_limit(mock_get_db, mock_fetch):
+    """Рынков больше PDF_BATCH_LIMIT — архив не обрезается молча: сообщение и возврат к тому же поиску"""
+    mock_cursor = mock_get_db.return_value.cursor.return_value.__enter__.return_value
+    mock_cursor.fetchone.return_value = {'found': 3}
+
+    with patch.object(app_module, 'PDF_BATCH_LIMIT', 2):
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess['authenticated'] = True
+
+            response = client.get('/download_pdf_batch?mode=city&q=Москва&product=3')
+            assert response.status_code == 302
+            assert '/search?' in response.location and 'product=3' in response.location
+            with client.session_transaction() as sess:
+                assert 'Найдено больше 2 рынков' in sess['_flashes'][0][1]
+
+    count_sql, count_params = mock_cursor.execute.call_args[0]
+    assert 'COUNT(*)' in count_sql and count_params[-1] == 3
+    mock_fetch.assert_not_called()
+
+
+@patch('app.app.get_db_connection')
+def test_search_hides_pdf_link_over_limit(mock_get_db):
+    """Найдено больше, чем помещается в архив, — вместо ссылки подсказка"""
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_get_db.return_value = mock_conn
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_cursor.fetchall.side_effect = [
+        [{'market_id': i, 'market_name': f'Рынок {i}', 'city': 'Москва', 'state': 'Москва',
+          'avg_rating': 0, 'rank_rating': 0} for i in range(3)],
+        []
+    ]
+
+    with patch.object(app_module, 'PDF_BATCH_LIMIT', 2):
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess['authenticated'] = True
+
+            html = client.get('/search?mode=city&q=Москва').get_data(as_text=True)
+            assert 'download_pdf_batch' not in html
+            assert 'не больше чем для 2 рынков' in html
+
+
+@patch('app.app.fetch_markets_pdf_data', return_value=[])
+@patch('app.app.get_db_connection')
+def test_download_pdf_batch_applies_facets(mock_get_db, mock_fetch):
+    """Фасеты из ссылки поиска сужают выборку архива так же, как на странице"""
+    mock_get_db.return_value.cursor.return_value.__enter__.return_value.fetchone.return_value = {'found': 0}
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['authenticated'] = True
+
+        client.get('/download_pdf_batch?mode=city&q=Москва&product=3&product=1&payment=2&payment=²')
+
+    where_sql, params = mock_fetch.call_args[0][1:]
+    assert 'LOWER(TRIM(city)) = %s' in where_sql
+    assert 'product_ids @> %s::int[]' in where_sql and 'payment_ids @> %s::int[]' in where_sql
+    assert params == ('москва', [1, 3], [2])
+
+
+def test_make_mixed_text_wraps_emoji():
+    """Эмодзи выводятся отдельным шрифтом, текст — основным"""
+    result = app_module.make_mixed_text("🌾 Рынки")
+    assert result == (f'<font name="{app_module.emoji_font}">🌾</font>'
+                      f'<font name="{app_module.base_font}"> Рынки</font>')
+
+
+def test_pdf_cache_expires(tmp_path):
+    """Запись старше PDF_CACHE_TTL не отдаётся"""
+    with patch.object(app_module, 'PDF_CACHE_DIR', str(tmp_path)):
+        app_module.store_cached_pdf('abc', b'pdf')
+        assert app_module.get_cached_pdf('abc') == b'pdf'
+
+        old = os.path.getmtime(app_module.pdf_cache_path('abc')) - app_module.PDF_CACHE_TTL - 1
+        os.utime(app_module.pdf_cache_path('abc'), (old, old))
+        assert app_module.get_cached_pdf('abc') is None
+
+
+@patch('app.app.find_prebuilt_export', return_value=None)
+@patch('app.app.save_file_to_minio_and_log')
+@patch('app.app.get_engine')
+def test_export_all_success(mock_get_engine, mock_save_file, mock_find_prebuilt):
+    mock_conn = MagicMock()
+    mock_result = MagicMock()
+    mock_engine = MagicMock()
+    mock_get_engine.return_value = mock_engine
+    mock_engine.connect.return_value.__enter__.return_value = mock_conn
+
+    mock_result.keys.return_value = ['market_name', 'city', 'state', 'zip']
+    mock_result.fetchmany.side_effect = [
+        [('Центральный рынок', 'Москва', 'Москва', '101000')],
+        []
+    ]
+    mock_conn.execution_options.return_value.execute.return_value = mock_result
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['authenticated'] = True
+
+        response = client.get('/export_all')
+        assert response.status_code == 200
+        assert response.headers['Content-Type'] == 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+        # Проверяем, что имя файла содержит .xlsx (имя может быть закодировано)
+        content_disp = response.headers.get('Content-Disposition', '')
+        assert '.xlsx' in content_disp
+
+        # Проверяем Excel
+        excel_data = io.BytesIO(response.data)
+        df = pd.read_excel(excel_data)
+        assert list(df.columns) == ['market_name', 'city', 'state', 'zip']
+        assert len(df) == 1
+
+        mock_save_file.assert_called_once()
+
+
+def test_write_export_rows_typed_cells():
+    """Числовые колонки пишутся числами, пустые значения пропускаются"""
+    import xlsxwriter
+    from openpyxl import load_workbook
+
+    output = io.BytesIO()
+    workbook = xlsxwriter.Workbook(output, {'in_memory': True})
+    worksheet = workbook.add_worksheet('Рынки')
+    columns = ['market_name', 'x', 'location', 'market_id']
+    rows = [('Центральный рынок', 37.6176, '', 12), ('Зелёный базар', None, 'У метро', 13)]
+
+    written = app_module.write_export_rows(
+        workbook, worksheet, columns, iter(rows),
+        {'market_name': 'string', 'x': 'number', 'location': 'string', 'market_id': 'number'}
+    )
+    workbook.close()
+
+    assert written == 2
+    sheet = load_workbook(io.BytesIO(output.getvalue())).active
+    assert [c.value for c in sheet[1]] == columns
+    assert sheet['B2'].value == 37.6176
+    assert sheet['B2'].data_type == 'n'
+    # Шесть знаков — только у координат, целые в формате по умолчанию
+    assert sheet['B2'].number_format == '0.000000'
+    assert sheet['D2'].value == 12 and sheet['D2'].number_format == 'General'
+    assert sheet['C2'].value is None
+    assert sheet['C3'].value == 'У метро'
+
+
+def test_export_shard_ranges_and_query():
+    """Границы превращаются в непересекающиеся диапазоны, NULL — в последней части"""
+    ranges = app_module.export_shard_ranges(['Б', 'М'])
+    assert ranges == [(None, 'Б'), ('Б', 'М'), ('М', None)]
+
+    sql, params = app_module.export_shard_query(None, 'Б')
+    assert 'market_name < :hi' in sql and params == {'hi': 'Б'}
+
+    sql, params = app_module.export_shard_query('М', None)
+    assert 'market_name >= :lo' in sql and 'IS NULL' in sql and params == {'lo': 'М'}
+
+    sql, params = app_module.export_shard_query(None, None)
+    assert 'WHERE' not in sql and params == {}
+
+
+def test_export_shard_bounds_keep_db_collation_order():
+    """Границы в порядке collation БД (регистр, «кавычки») не пересортировываются в Python"""
+    conn = MagicMock()
+    # en_US.utf8: 'apple' < 'Banana' < '«Дары»' < 'дары' — в Python порядок был бы другим
+    db_bounds = ['apple', 'Banana', 'Banana', '«Дары»', None, 'дары']
+    conn.execute.return_value.scalar.return_value = db_bounds
+
+    bounds = app_module.get_export_shard_bounds(conn, 6)
+    assert bounds == ['apple', 'Banana', '«Дары»', 'дары']
+    assert bounds != sorted(bounds)
+
+    # Полуинтервалы идут подряд: верхняя граница каждой части — нижняя следующей
+    ranges = app_module.export_shard_ranges(bounds)
+    assert ranges[0] == (None, 'apple') and ranges[-1] == ('дары', None)
+    assert all(ranges[i][1] == ranges[i + 1][0] for i in range(len(ranges) - 1))
+    assert len({lo for lo, _ in ranges}) == len(ranges)
+
+
+@patch('app.app.export_shard')
+@patch('app.app.get_export_shard_bounds', return_value=['М'])
+@patch('app.app.get_export_column_types', return_value={})
+@patch('app.app.get_engine')
+def test_build_sharded_export_zips_parts(mock_get_engine, mock_types, mock_bounds, mock_export_shard, tmp_path):
+    """Части собираются в пуле и складываются в zip по порядку"""
+    from concurrent.futures import ThreadPoolExecutor
+    import zipfile
+
+    def fake_shard(part_path, lo, hi, column_types):
+        with open(part_path, 'wb') as f:
+            f.write(b'xlsx')
+        return part_path, 3
+
+    mock_export_shard.side_effect = fake_shard
+    zip_path = tmp_path / 'export.zip'
+
+    with patch('app.app.ProcessPoolExecutor', ThreadPoolExecutor):
+        total = app_module.build_sharded_export(str(zip_path), shards=2)
+
+    assert total == 6
+    with zipfile.ZipFile(zip_path) as zf:
+        assert zf.namelist() == ['часть_01.xlsx', 'часть_02.xlsx']
+    ranges = [call.args[1:3] for call in mock_export_shard.call_args_list]
+    assert ranges == [(None, 'М'), ('М', None)]
+
+
+@patch('app.app.save_file_to_minio_and_log')
+@patch('app.app.build_sharded_export')
+def test_export_all_parallel(mock_build, mock_save_file):
+    """parallel=1 → отдаётся zip с частями"""
+    def fake_build(zip_path):
+        import zipfile
+        with zipfile.ZipFile(zip_path, 'w') as zf:
+            zf.writestr('часть_01.xlsx', b'xlsx')
+        return 1
+
+    mock_build.side_effect = fake_build
 
     with app.test_client() as client:
         with client.session_transaction() as sess:
             sess['authenticated'] = True
 
-        response = client.get('/stats')
+        response = client.get('/export_all?parallel=1')
+        assert response.status_code == 200
+        assert response.headers['Content-Type'] == 'application/zip'
+        assert '.zip' in response.headers.get('Content-Disposition', '')
+        mock_save_file.assert_called_once()
+
+
+@patch('app.app.event')
+@patch('app.app.create_engine')
+def test_get_engine_is_shared(mock_create_engine, mock_event):
+    """Движок создаётся один раз на процесс и переиспользуется"""
+    with patch.object(app_module, 'engine', None):
+        first = app_module.get_engine()
+        second = app_module.get_engine()
+
+    assert first is second
+    mock_create_engine.assert_called_once()
+    assert mock_create_engine.call_args.kwargs['pool_pre_ping'] is True
+
+
+@patch('app.app.get_engine')
+def test_get_db_connection_uses_pool(mock_get_engine):
+    """Соединение берётся из пула движка и отдаёт RealDictCursor"""
+    from psycopg2.extras import RealDictCursor
+    raw_conn = MagicMock()
+    mock_get_engine.return_value.raw_connection.return_value = raw_conn
+
+    conn = app_module.get_db_connection()
+
+    assert conn is raw_conn
+    assert raw_conn.driver_connection.cursor_factory is RealDictCursor
+
+
+@patch('app.app.get_engine')
+def test_export_all_db_error(mock_get_engine):
+    mock_get_engine.side_effect = Exception("Connection failed")
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['authenticated'] = True
+
+        response = client.get('/export_all')
         assert response.status_code == 302
-        assert response.location.endswith('/')
+        assert response.location.endswith('/markets')
+
+@patch('app.app.log_file_operation')
+@patch('app.app.get_minio_client')
+@patch('app.app.find_prebuilt_export')
+@patch('app.app.build_export_workbook')
+def test_export_all_serves_prebuilt(mock_build, mock_find, mock_minio, mock_log):
+    """Есть свежая заранее собранная выгрузка → отдаётся из MinIO без сборки"""
+    mock_find.return_value = {
+        'hashed_filename': 'abc.xlsx',
+        'original_filename': 'все_рынки_20250101_040000.xlsx',
+        'content_key': 'export:all',
+        'created_at': datetime(2025, 1, 1, 4, 0)
+    }
+    mock_minio.return_value.get_object.return_value = io.BytesIO(b'prebuilt-xlsx')
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['authenticated'] = True
+
+        response = client.get('/export_all')
+        assert response.status_code == 200
+        assert response.data == b'prebuilt-xlsx'
+        assert '.xlsx' in response.headers.get('Content-Disposition', '')
+
+    mock_build.assert_not_called()
+    mock_minio.return_value.get_object.assert_called_once_with('farmers-markets', 'abc.xlsx')
+    assert mock_log.call_args[0][2] == 'export'
+
+
+@patch('app.app.log_file_operation')
+@patch('app.app.get_minio_client')
+@patch('app.app.find_prebuilt_export')
+def test_export_all_prebuilt_via_nginx(mock_find, mock_minio, mock_log):
+    """FILE_DELIVERY_MODE=nginx → пустой ответ с X-Accel-Redirect на подписанный путь MinIO"""
+    mock_find.return_value = {
+        'hashed_filename': 'abc.xlsx',
+        'original_filename': 'все_рынки.xlsx',
+        'content_key': 'export:all',
+        'created_at': datetime(2025, 1, 1, 4, 0)
+    }
+    mock_minio.return_value = app_module.Minio('minio:9000', access_key='k', secret_key='s',
+                                               secure=False, region='us-east-1')
+
+    with patch.object(app_module, 'FILE_DELIVERY_MODE', 'nginx'):
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess['authenticated'] = True
+
+            response = client.get('/export_all')
+
+    accel = response.headers['X-Accel-Redirect']
+    assert response.status_code == 200 and response.data == b''
+    assert accel.startswith('/minio-internal/farmers-markets/abc.xlsx?')
+    assert 'X-Amz-Signature=' in accel and 'response-content-disposition=' in accel
+
+
+@patch('app.app.log_file_operation')
+@patch('app.app.render_market_pdf')
+@patch('app.app.find_archived_artifact')
+@patch('app.app.fetch_market_pdf_data')
+@patch('app.app.get_db_connection')
+def test_download_pdf_redirects_to_presigned_artifact(mock_get_db, mock_fetch, mock_find, mock_render, mock_log):
+    """PDF того же содержимого уже в MinIO → редирект на presigned-ссылку без рендера"""
+    mock_fetch.return_value = dict(PDF_MARKET)
+    mock_find.return_value = {'hashed_filename': 'ff.pdf', 'content_key': 'pdf:x', 'cold_key': None}
+
+    with patch.object(app_module, 'FILE_DELIVERY_MODE', 'presigned'), \
+            patch.object(app_module, 'MINIO_PUBLIC_ENDPOINT', 'files.example.ru'):
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess['authenticated'] = True
+
+            response = client.get('/download_pdf?name=Центральный+рынок')
+
+    assert response.status_code == 302
+    assert response.location.startswith('http://files.example.ru/farmers-markets/ff.pdf?')
+    assert mock_find.call_args[0][1] == f"pdf:{app_module.market_content_hash(PDF_MARKET)}"
+    mock_render.assert_not_called()
+    assert mock_log.call_args[0][1:3] == ('ff.pdf', 'pdf_export')
 
 
 @patch('app.app.get_db_connection')
-def test_stats_success(mock_get_db):
-    """Успешная загрузка статистики"""
+def test_recent_files_limits_non_admins_to_shared_types(mock_get_db):
+    """Список недавних файлов: обычный пользователь видит только общие выгрузки и PDF"""
     mock_conn = MagicMock()
     mock_cursor = MagicMock()
     mock_get_db.return_value = mock_conn
     mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_cursor.fetchall.return_value = [{
+        'hashed_filename': 'ff.pdf', 'original_filename': 'Рынок_А.pdf', 'operation_type': 'pdf_export',
+        'content_key': 'pdf:x', 'created_at': datetime(2025, 1, 1, 12, 0), 'size_bytes': 2048
+    }]
 
-    # Эмуляция последовательных fetchone/fetchall
-    def execute_side_effect(query, params=None):
-        if 'COUNT(*) AS total FROM farmers_markets' in query:
-            mock_cursor.fetchone.return_value = {'total': 150}
-        elif 'COUNT(*) AS total FROM reviews' in query:
-            mock_cursor.fetchone.return_value = {'total': 300}
-        elif 'COUNT(*) AS total FROM products' in query:
-            mock_cursor.fetchone.return_value = {'total': 20}
-        elif 'COUNT(*) AS total FROM payment_methods' in query:
-            mock_cursor.fetchone.return_value = {'total': 5}
-        elif 'COUNT(*) AS total FROM social_networks' in query:
-            mock_cursor.fetchone.return_value = {'total': 3}
-        elif 'COALESCE(ROUND(AVG(rating), 2), 0) AS avg_rating' in query:
-            mock_cursor.fetchone.return_value = {'avg_rating': 4.25}
-        elif 'Топ-5 рынков' in query or 'HAVING COUNT(r.review_id) > 0' in query:
-            mock_cursor.fetchall.return_value = [
-                {'market_name': 'Центральный рынок', 'city': 'Москва', 'state': 'Москва', 'avg_rating': 4.8, 'review_count': 50},
-                {'market_name': 'Зелёный базар', 'city': 'СПб', 'state': 'СПб', 'avg_rating': 4.7, 'review_count': 45}
-            ]
-        elif 'Рынки по субъектам' in query or 'GROUP BY state' in query:
-            mock_cursor.fetchall.return_value = [
-                {'state': 'Москва', 'count': 40},
-                {'state': 'СПб', 'count': 30}
-            ]
-        else:
-            mock_cursor.fetchone.return_value = {'total': 0}
-            mock_cursor.fetchall.return_value = []
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['authenticated'] = True
 
-    mock_cursor.execute.side_effect = execute_side_effect
+        data = client.get('/files/recent?q=Рынок&limit=500').get_json()
+        assert data['files'][0]['url'] == '/files/ff.pdf'
+        params = mock_cursor.execute.call_args[0][1]
+        assert params[1] == list(app_module.SHARED_ARTIFACT_TYPES)
+        assert params[-1] == 200
 
+        with client.session_transaction() as sess:
+            sess['is_admin'] = True
+        client.get('/files/recent')
+        assert mock_cursor.execute.call_args[0][1][1] is None
+
+
+@patch('app.app.save_file_to_minio_and_log')
+@patch('app.app.build_export_workbook')
+@patch('app.app.find_prebuilt_export')
+def test_export_all_fresh_skips_prebuilt(mock_find, mock_build, mock_save_file):
+    """fresh=1 → выгрузка собирается заново (с фильтром по субъекту)"""
     with app.test_client() as client:
         with client.session_transaction() as sess:
             sess['authenticated'] = True
 
-        response = client.get('/stats')
-        html = response.get_data(as_text=True)
+        response = client.get('/export_all?fresh=1&state=Москва')
         assert response.status_code == 200
-        assert 'Статистика' in html
-        assert '150' in html  # total_markets
-        assert '300' in html  # total_reviews
-        assert '4.25' in html  # avg_rating
-        assert 'Центральный рынок' in html
-        assert 'Москва' in html and '40' in html  # markets_by_state
+
+    mock_find.assert_not_called()
+    assert mock_build.call_args[0][1] == 'Москва'
+    assert mock_save_file.call_args.kwargs['content_key'] == 'export:state:москва'
+
+
+@patch('app.app.get_db_connection')
+def test_run_scheduled_job_runs_once(mock_get_db):
+    """Задача выполняется под advisory-блокировкой и не повторяется после выполнения"""
+    from datetime import timezone
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_get_db.return_value = mock_conn
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    due_at = datetime(2025, 1, 1, 4, 0, tzinfo=timezone.utc)
+    job = MagicMock()
+
+    # Ещё не выполнялась
+    mock_cursor.fetchone.side_effect = [{'locked': True}, None]
+    assert app_module.run_scheduled_job('job', job, due_at) is True
+    job.assert_called_once()
+    assert any('pg_advisory_unlock' in c[0][0] for c in mock_cursor.execute.call_args_list)
+
+    # Уже выполнена другим воркером
+    job.reset_mock()
+    mock_cursor.fetchone.side_effect = [{'locked': True}, {'last_run_at': due_at}]
+    assert app_module.run_scheduled_job('job', job, due_at) is True
+    job.assert_not_called()
+
+    # Блокировка занята — попробуем позже
+    mock_cursor.fetchone.side_effect = [{'locked': False}]
+    assert app_module.run_scheduled_job('job', job, due_at) is False
+    job.assert_not_called()
+
+
+def test_export_changes_invalid_since():
+    """Некорректный since → 400"""
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['authenticated'] = True
+
+        response = client.get('/export_changes?since=вчера')
+        assert response.status_code == 400
+        assert 'error' in response.get_json()
+
+
+@patch('app.app.get_db_connection')
+def test_export_changes_success(mock_get_db):
+    """Возвращаются только изменённые и удалённые рынки и новый курсор"""
+    from datetime import timezone
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_get_db.return_value = mock_conn
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+    updated = datetime(2025, 3, 1, 10, 0, tzinfo=timezone.utc)
+    mock_cursor.fetchall.side_effect = [
+        [{
+            'market_id': 7, 'market_name': 'Новый рынок', 'street': 'Ленина, 1', 'city': 'Москва',
+            'state': 'Москва', 'zip': '101000', 'x': 37.6, 'y': 55.7, 'location': '',
+            'products': 'Мёд', 'payments': 'Карта', 'socials': '', 'updated_at': updated
+        }],
+        [{'market_id': 3, 'market_name': 'Старый рынок', 'deleted_at': updated}]
+    ]
+    mock_cursor.fetchone.return_value = {'safe_cursor': datetime(2025, 3, 2, tzinfo=timezone.utc)}
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['authenticated'] = True
+
+        response = client.get('/export_changes?since=2025-03-01T00:00:00')
+        assert response.status_code == 200
+        data = response.get_json()
+        assert [m['market_name'] for m in data['changed']] == ['Новый рынок']
+        assert data['changed'][0]['products'] == 'Мёд'
+        assert data['deleted'] == [{'market_id': 3, 'market_name': 'Старый рынок', 'deleted_at': updated.isoformat()}]
+        assert data['cursor'].startswith('2025-03-02')
+
+        # Курсор берётся до чтения изменений и не новее самой старой открытой транзакции
+        cursor_sql = mock_cursor.execute.call_args_list[0][0][0]
+        assert 'min(xact_start) FROM pg_stat_activity' in cursor_sql
+        since_param = mock_cursor.execute.call_args_list[1][0][1][0]
+        assert since_param.tzinfo is not None
+
+
+@patch('app.app.get_db_connection')
+def test_export_changes_cursor_never_moves_back(mock_get_db):
+    """Открытая транзакция старше since не отодвигает курсор назад"""
+    from datetime import timezone
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_get_db.return_value = mock_conn
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_cursor.fetchall.side_effect = [[], []]
+    mock_cursor.fetchone.return_value = {'safe_cursor': datetime(2025, 2, 1, tzinfo=timezone.utc)}
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['authenticated'] = True
+
+        data = client.get('/export_changes?since=2025-03-01T00:00:00').get_json()
+        assert data['cursor'] == '2025-03-01T00:00:00+00:00'
+
+
+@patch('app.app.get_minio_client')
+def test_upload_to_minio_accepts_bytes_streams_and_paths(mock_minio):
+    """Байты и потоки грузятся через put_object без временных файлов, пути — через fput_object"""
+    client = mock_minio.return_value
+
+    app_module.upload_to_minio('a.pdf', b'%PDF', content_type='application/pdf')
+    args, kwargs = client.put_object.call_args
+    assert args[0] == 'farmers-markets' and args[1] == 'a.pdf'
+    assert args[2].read() == b'%PDF' and args[3] == 4
+    assert kwargs['content_type'] == 'application/pdf'
+    assert kwargs['num_parallel_uploads'] == app_module.MINIO_PARALLEL_UPLOADS
+
+    stream = io.BytesIO(b'zipdata')
+    app_module.upload_to_minio('b.zip', stream)
+    args, kwargs = client.put_object.call_args
+    assert args[2] is stream and args[3] == -1
+    assert kwargs['part_size'] == app_module.MINIO_PART_SIZE
+
+    app_module.upload_to_minio('c.xlsx', '/tmp/c.xlsx')
+    client.fput_object.assert_called_once()
+    assert client.fput_object.call_args[0][2] == '/tmp/c.xlsx'
+
+
+@patch('app.app.get_minio_client')
+@patch('app.app.get_db_connection')
+def test_save_file_is_content_addressed_and_skips_existing(mock_get_db, mock_minio, tmp_path):
+    """Имя объекта — sha256 содержимого; существующий объект повторно не загружается"""
+    import hashlib
+    from minio.error import S3Error
+
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_get_db.return_value = mock_conn
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_cursor.fetchone.return_value = {'cold_key': None}
+    client = mock_minio.return_value
+    digest = hashlib.sha256(b'same bytes').hexdigest()
+
+    client.stat_object.side_effect = S3Error(MagicMock(), 'NoSuchKey', 'нет', 'r', 'req', 'host')
+    name = app_module.save_file_to_minio_and_log(b'same bytes', 'a.xlsx', 'import', '1.2.3.4')
+    assert name == digest + '.xlsx'
+    assert client.put_object.call_args[0][1] == name
+
+    # Тот же файл с диска — новая ссылка, но без загрузки
+    path = tmp_path / 'b.xlsx'
+    path.write_bytes(b'same bytes')
+    client.stat_object.side_effect = None
+    client.put_object.reset_mock()
+    assert app_module.save_file_to_minio_and_log(str(path), 'b.xlsx', 'import', '1.2.3.4') == name
+    client.put_object.assert_not_called()
+    client.fput_object.assert_not_called()
+
+    upsert = mock_cursor.execute.call_args_list[-2][0]
+    assert 'INSERT INTO file_objects' in upsert[0] and upsert[1] == (name, 10)
+    assert 'INSERT INTO file_logs' in mock_cursor.execute.call_args_list[-1][0][0]
+    assert mock_conn.commit.call_count == 2
+
+
+@patch('app.app.get_minio_client')
+@patch('app.app.get_db_connection')
+def test_save_file_uploads_outside_transaction_and_releases_on_failure(mock_get_db, mock_minio):
+    """Ссылка фиксируется до загрузки; при ошибке MinIO строка file_logs и ссылка снимаются"""
+    from minio.error import S3Error
+
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_get_db.return_value = mock_conn
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_cursor.fetchone.side_effect = [{'cold_key': None}, {'created_at': datetime(2025, 1, 15), 'id': 42}]
+    client = mock_minio.return_value
+    client.stat_object.side_effect = S3Error(MagicMock(), 'NoSuchKey', 'нет', 'r', 'req', 'host')
+
+    state_at_upload = {}
+    def failing_upload(*args, **kwargs):
+        state_at_upload.update(commits=mock_conn.commit.call_count, open=mock_conn.close.call_count)
+        raise S3Error(MagicMock(), 'SlowDown', 'медленно', 'r', 'req', 'host')
+    client.put_object.side_effect = failing_upload
+
+    try:
+        app_module.save_file_to_minio_and_log(b'data', 'a.csv', 'export', '1.2.3.4')
+        assert False, "ожидалась ошибка MinIO"
+    except Exception as e:
+        assert 'Ошибка MinIO' in str(e)
+
+    # Во время загрузки транзакция уже зафиксирована и соединение возвращено в пул
+    assert state_at_upload == {'commits': 1, 'open': 1}
+    release = [c[0] for c in mock_cursor.execute.call_args_list[2:]]
+    assert 'DELETE FROM file_logs' in release[0][0] and release[0][1] == (datetime(2025, 1, 15), 42)
+    assert 'ref_count = ref_count - 1' in release[1][0]
+    assert mock_conn.commit.call_count == 2
+
+
+def test_hash_source_spools_unseekable_streams():
+    """Поток без seek() хешируется и копируется для последующей загрузки"""
+    class Pipe(io.RawIOBase):
+        def __init__(self, data):
+            self.data = io.BytesIO(data)
+        def readable(self):
+            return True
+        def read(self, n=-1):
+            return self.data.read(n)
+
+    digest, size, upload = app_module.hash_source(Pipe(b'x' * 100))
+    assert size == 100
+    assert upload.read() == b'x' * 100
+
+
+@patch('app.app.get_minio_client')
+@patch('app.app.get_db_connection')
+def test_collect_unreferenced_objects(mock_get_db, mock_minio):
+    """Объекты без ссылок удаляются из MinIO, считаются освобождённые байты"""
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_get_db.return_value = mock_conn
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_cursor.fetchall.return_value = [
+        {'hashed_filename': 'aa.pdf', 'size_bytes': 100, 'cold_key': None, 'stored_bytes': None},
+        {'hashed_filename': 'bb.csv', 'size_bytes': 500, 'cold_key': 'cold/bb.csv.gz', 'stored_bytes': 40}
+    ]
+    mock_minio.return_value.remove_objects.return_value = iter([])
+
+    removed = app_module.collect_unreferenced_objects(batch_size=10)
+
+    assert removed == {'objects': 2, 'bytes': 140}
+    deleted = [d.name for d in mock_minio.return_value.remove_objects.call_args[0][1]]
+    # Горячая копия могла пережить перенос — удаляются оба ключа
+    assert deleted == ['aa.pdf', 'bb.csv', 'cold/bb.csv.gz']
+    assert 'ref_count <= 0' in mock_cursor.execute.call_args[0][0]
+    mock_conn.commit.assert_called_once()
+
+
+@patch('app.app.collect_unreferenced_objects')
+@patch('app.app.get_minio_client')
+@patch('app.app.get_db_connection')
+def test_apply_retention_policy_tiers_and_expires(mock_get_db, mock_minio, mock_collect):
+    """Старые файлы сжимаются в холодный префикс, устаревшие строки file_logs удаляются пачками"""
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_get_db.return_value = mock_conn
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    touched = datetime(2024, 1, 1)
+    mock_cursor.fetchall.return_value = [{'hashed_filename': 'aa.csv', 'size_bytes': 10000, 'last_referenced_at': touched}]
+    mock_cursor.fetchone.side_effect = [
+        {'hashed_filename': 'aa.csv'},                                    # cold_key записан
+        {'cold_key': 'cold/aa.csv.gz', 'last_referenced_at': touched},    # под блокировкой ничего не изменилось
+        {'deleted': 2}, {'deleted': 1}
+    ]
+    client = mock_minio.return_value
+    client.get_object.return_value = io.BytesIO(b'market;city\n' * 800)
+    client.get_object.return_value.release_conn = MagicMock()
+    mock_collect.return_value = {'objects': 3, 'bytes': 500}
+
+    policy = {'import': {'cold_days': 30, 'expire_days': 365}}
+    report = app_module.apply_retention_policy(policy, batch_size=2)
+
+    stats = report['operations']['import']
+    assert stats['tiered_objects'] == 1 and stats['expired_rows'] == 3
+    claim_sql, claim_params = mock_cursor.execute.call_args_list[1][0]
+    assert 'last_referenced_at = %s' in claim_sql
+    cold_key, stored = claim_params[:2]
+    assert cold_key == 'cold/aa.csv.gz' and stored < 10000 and claim_params[3] == touched
+    assert 'FOR UPDATE' in mock_cursor.execute.call_args_list[2][0][0]
+    assert client.put_object.call_args[0][1] == 'cold/aa.csv.gz'
+    client.remove_object.assert_called_once_with(app_module.MINIO_BUCKET_NAME, 'aa.csv')
+    assert report['reclaimed_bytes'] == stats['saved_bytes'] + 500
+
+
+@patch('app.app.get_minio_client')
+@patch('app.app.get_db_connection')
+def test_tier_cold_objects_keeps_hot_copy_when_referenced_again(mock_get_db, mock_minio):
+    """К объекту обратились во время переноса — горячая копия остаётся, холодная удаляется"""
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_get_db.return_value = mock_conn
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    touched = datetime(2024, 1, 1)
+    mock_cursor.fetchall.return_value = [{'hashed_filename': 'aa.pdf', 'size_bytes': 100, 'last_referenced_at': touched}]
+    mock_cursor.fetchone.side_effect = [
+        {'hashed_filename': 'aa.pdf'},
+        {'cold_key': 'cold/aa.pdf', 'last_referenced_at': datetime(2025, 1, 15)}
+    ]
+    client = mock_minio.return_value
+    client.stat_object.return_value.size = 100
+
+    assert app_module.tier_cold_objects(client, 'import', 30, 10) == []
+    assert 'SET cold_key = NULL' in mock_cursor.execute.call_args[0][0]
+    client.remove_object.assert_called_once_with(app_module.MINIO_BUCKET_NAME, 'cold/aa.pdf')
+
+
+@patch('app.app.get_minio_client')
+@patch('app.app.get_db_connection')
+def test_tier_cold_objects_removes_unrecorded_copy_on_failure(mock_get_db, mock_minio):
+    """Ошибка БД после копирования — холодная копия удаляется, сиротой не остаётся"""
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_get_db.return_value = mock_conn
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_cursor.fetchall.return_value = [{'hashed_filename': 'aa.pdf', 'size_bytes': 100,
+                                          'last_referenced_at': datetime(2024, 1, 1)}]
+    mock_cursor.execute.side_effect = [None, Exception("connection lost")]
+    client = mock_minio.return_value
+    client.stat_object.return_value.size = 100
+
+    try:
+        app_module.tier_cold_objects(client, 'import', 30, 10)
+        assert False, "ожидалась ошибка БД"
+    except Exception as e:
+        assert str(e) == "connection lost"
+    client.remove_object.assert_called_once_with(app_module.MINIO_BUCKET_NAME, 'cold/aa.pdf')
+    mock_conn.rollback.assert_called_once()
+
+
+@patch('app.app.get_minio_client')
+@patch('app.app.get_db_connection')
+def test_restore_cold_object_gunzips_and_clears_cold_key(mock_get_db, mock_minio):
+    """Восстановление: обращение фиксируется до копирования, gzip распаковывается, cold_key снимается"""
+    import gzip
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_get_db.return_value = mock_conn
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_cursor.fetchone.return_value = {'cold_key': 'cold/aa.csv.gz'}
+    client = mock_minio.return_value
+    client.get_object.return_value = io.BytesIO(gzip.compress(b'market;city\n' * 10))
+    client.get_object.return_value.release_conn = MagicMock()
+    uploaded = {}
+    client.put_object.side_effect = lambda bucket, name, data, length, **kw: uploaded.update(
+        name=name, data=data.read(), length=length)
+
+    assert app_module.restore_cold_object('aa.csv') is True
+
+    touch_sql = mock_cursor.execute.call_args_list[0][0][0]
+    assert 'last_referenced_at = now()' in touch_sql and 'cold_key IS NOT NULL' in touch_sql
+    client.get_object.assert_called_once_with(app_module.MINIO_BUCKET_NAME, 'cold/aa.csv.gz')
+    assert uploaded == {'name': 'aa.csv', 'data': b'market;city\n' * 10, 'length': 120}
+    clear_sql, clear_params = mock_cursor.execute.call_args_list[1][0]
+    assert 'SET cold_key = NULL' in clear_sql and clear_params == ('aa.csv', 'cold/aa.csv.gz')
+    client.remove_object.assert_called_once_with(app_module.MINIO_BUCKET_NAME, 'cold/aa.csv.gz')
+
+
+@patch('app.app.restore_cold_object')
+@patch('app.app.log_file_operation')
+@patch('app.app.get_db_connection')
+def test_download_archived_file_restores_cold_object(mock_get_db, mock_log, mock_restore):
+    """Файл в холодном хранилище по-прежнему скачивается: перед отдачей он восстанавливается"""
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_get_db.return_value = mock_conn
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_cursor.fetchone.return_value = {'original_filename': 'markets.csv', 'cold_key': 'cold/aa.csv.gz'}
+
+    with patch.object(app_module, 'FILE_DELIVERY_MODE', 'presigned'), \
+            patch.object(app_module, 'MINIO_PUBLIC_ENDPOINT', 'files.example.ru'):
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess['authenticated'] = True
+                sess['is_admin'] = True
+
+            response = client.get('/files/aa.csv')
+
+    assert response.status_code == 302
+    assert 'cold_key IS NULL' not in mock_cursor.execute.call_args[0][0]
+    mock_restore.assert_called_once_with('aa.csv')
+
+
+@patch('app.app.get_minio_client')
+@patch('app.app.get_db_connection')
+def test_save_file_reuploads_cold_object(mock_get_db, mock_minio):
+    """Файл в холодном префиксе загружается заново, даже если горячая копия ещё видна"""
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_get_db.return_value = mock_conn
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_cursor.fetchone.side_effect = [{'cold_key': 'cold/x.csv.gz'}, {'created_at': datetime(2025, 1, 15), 'id': 1}]
+    client = mock_minio.return_value
+
+    name = app_module.save_file_to_minio_and_log(b'data', 'x.csv', 'export', '1.2.3.4')
+
+    client.stat_object.assert_not_called()
+    assert client.put_object.call_args[0][1] == name
+    restore_sql, restore_params = mock_cursor.execute.call_args[0]
+    assert 'cold_key = NULL' in restore_sql and restore_params == (name, 'cold/x.csv.gz')
+    client.remove_object.assert_called_once_with(app_module.MINIO_BUCKET_NAME, 'cold/x.csv.gz')
+
+
+@patch('app.app.Minio')
+def test_minio_client_is_created_once_per_process(mock_minio_cls):
+    """Клиент и проверка бакета — один раз на процесс; после fork клиент создаётся заново"""
+    mock_minio_cls.return_value.bucket_exists.return_value = True
+    with patch.object(app_module, 'minio_client', None), patch.object(app_module, 'minio_client_pid', None):
+        first = app_module.get_minio_client()
+        assert app_module.get_minio_client() is first
+        assert mock_minio_cls.call_count == 1
+        kwargs = mock_minio_cls.call_args[1]
+        assert kwargs['region'] == app_module.MINIO_REGION
+        assert kwargs['http_client'].connection_pool_kw['maxsize'] == app_module.MINIO_POOL_SIZE
+
+        app_module._reset_minio_after_fork()
+        app_module.get_minio_client()
+        assert mock_minio_cls.call_count == 2
+        assert mock_minio_cls.return_value.bucket_exists.call_count == 2
+
+
+@patch('app.app.get_minio_client')
+@patch('app.app.get_db_connection')
+def test_health_reports_each_dependency(mock_get_db, mock_minio):
+    """/health доступен без входа и возвращает 503, если MinIO недоступен"""
+    mock_get_db.return_value = MagicMock()
+    mock_minio.return_value.bucket_exists.return_value = True
+
+    with app.test_client() as client:
+        response = client.get('/health')
+        assert response.status_code == 200
+        assert response.get_json()['minio']['ok'] is True
+
+        mock_minio.side_effect = Exception("connection refused")
+        response = client.get('/health')
+        data = response.get_json()
+        assert response.status_code == 503
+        assert data['db']['ok'] is True
+        assert data['minio'] == {'ok': False, 'error': 'connection refused', 'ms': data['minio']['ms']}
+
+
+@patch('app.app.get_db_connection')
+def test_file_logs_partition_moves_rows_from_default(mock_get_db):
+    """Секции месяца нет, его строки уже в file_logs_default: default отсоединяется, строки переносятся"""
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_get_db.return_value = mock_conn
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_cursor.fetchone.side_effect = [
+        {'existing': None, 'fallback': 'file_logs_default'},
+        {'existing': 'file_logs_2025_04', 'fallback': 'file_logs_default'}
+    ]
+    utc = app_module.timezone.utc
+
+    with patch('app.app.datetime') as mock_datetime:
+        mock_datetime.now.return_value = datetime(2025, 3, 17, 23, 30, tzinfo=utc)
+        app_module.ensure_file_logs_partitions(months_ahead=1)
+
+    statements = [c[0][0] for c in mock_cursor.execute.call_args_list]
+    assert 'DETACH PARTITION file_logs_default' in statements[1]
+    create_sql, create_params = mock_cursor.execute.call_args_list[2][0]
+    assert 'CREATE TABLE file_logs_2025_03' in create_sql and '%s::timestamptz' in create_sql
+    assert create_params == (datetime(2025, 3, 1, tzinfo=utc), datetime(2025, 4, 1, tzinfo=utc))
+    move_sql, move_params = mock_cursor.execute.call_args_list[3][0]
+    assert 'DELETE FROM file_logs_default' in move_sql and 'INSERT INTO file_logs SELECT * FROM moved' in move_sql
+    assert move_params == create_params
+    assert 'ATTACH PARTITION file_logs_default DEFAULT' in statements[4]
+    # Следующий месяц уже есть — только проверка
+    assert len(statements) == 6
+    mock_conn.commit.assert_called_once()
+
+
+@patch('app.app.get_db_connection')
+def test_file_logs_audit_filters_and_keyset(mock_get_db):
+    """Аудит file_logs: фильтры в WHERE, следующая страница — по (created_at, id) из cursor"""
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_get_db.return_value = mock_conn
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    created = datetime(2025, 3, 1, 12, 0, tzinfo=app_module.timezone.utc)
+    mock_cursor.fetchall.return_value = [
+        {'id': 10 - i, 'created_at': created, 'operation_type': 'import', 'original_filename': 'a.xlsx',
+         'hashed_filename': 'aa.xlsx', 'file_extension': '.xlsx', 'user_ip': '1.2.3.4', 'content_key': None}
+        for i in range(2)
+    ]
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['authenticated'] = True
+            sess['is_admin'] = True
+
+        data = client.get('/admin/file_logs?operation_type=import&ip=1.2.3.4&from=2025-03-01&limit=2').get_json()
+        assert len(data['items']) == 2
+        assert data['next_cursor'] == f"{created.isoformat()}|9"
+        sql, params = mock_cursor.execute.call_args[0]
+        assert 'operation_type = ANY(%s)' in sql and 'user_ip = %s' in sql
+        assert params[0] == ['import'] and params[-1] == 2
+
+        client.get('/admin/file_logs', query_string={'cursor': data['next_cursor']})
+        sql, params = mock_cursor.execute.call_args[0]
+        assert '(created_at, id) < (%s, %s)' in sql
+        assert params[:2] == (created, 9)
+
+        assert client.get('/admin/file_logs?from=вчера').status_code == 400
+
+
+def test_file_logs_audit_requires_admin():
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['authenticated'] = True
+        assert client.get('/admin/file_logs').status_code == 302
+
+
+@patch('app.app.time.sleep')
+@patch('app.app.save_file_to_minio_and_log')
+def test_process_archive_job_retries_and_reports_failure(mock_save_file, mock_sleep, tmp_path):
+    """Неудачная загрузка повторяется, затем попадает в метрики; файл удаляется"""
+    file_path = tmp_path / 'export.xlsx'
+    file_path.write_bytes(b'data')
+    mock_save_file.side_effect = Exception("MinIO недоступен")
+    before = app_module.get_archive_metrics()
+
+    with patch.object(app_module, 'ARCHIVE_MAX_RETRIES', 2):
+        ok = app_module.process_archive_job((str(file_path), 'export.xlsx', 'export', '127.0.0.1', None, None))
+
+    after = app_module.get_archive_metrics()
+    assert ok is False
+    assert mock_save_file.call_count == 3
+    assert after['retried'] - before['retried'] == 2
+    assert after['failed'] - before['failed'] == 1
+    assert after['recent_failures'][-1]['error'] == 'MinIO недоступен'
+    assert not file_path.exists()
+
+
+@patch('app.app.process_archive_job')
+@patch('app.app.start_background_services')
+def test_archive_file_enqueues_and_falls_back_when_full(mock_start, mock_process):
+    """Файл ставится в очередь; при переполненной очереди загружается сразу"""
+    import queue
+    small_queue = queue.Queue(maxsize=1)
+
+    with patch.object(app_module, 'BACKGROUND_SERVICES_ENABLED', True), \
+         patch.object(app_module, 'archive_queue', small_queue), \
+         patch.object(app_module, 'ARCHIVE_ENQUEUE_TIMEOUT', 0.01):
+        app_module.archive_file('/tmp/a.pdf', 'a.pdf', 'pdf_export', '127.0.0.1')
+        mock_process.assert_not_called()
+        assert small_queue.qsize() == 1
+
+        app_module.archive_file('/tmp/b.pdf', 'b.pdf', 'pdf_export', '127.0.0.1')
+        mock_process.assert_called_once_with(('/tmp/b.pdf', 'b.pdf', 'pdf_export', '127.0.0.1', None, None))
+
+
+def test_archive_metrics_requires_admin():
+    """Метрики архивации доступны только администратору"""
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['authenticated'] = True
+            sess['is_admin'] = False
+
+        response = client.get('/metrics/archive')
+        assert response.status_code == 302
+
+        with client.session_transaction() as sess:
+            sess['is_admin'] = True
+
+        response = client.get('/metrics/archive')
+        assert response.status_code == 200
+        data = response.get_json()
+        assert 'failed' in data and 'queue_size' in data
+
+
+@patch('app.app.get_db_connection')
+def test_stats_requires_auth(mock_get_db):
+    """Неавторизованный → редирект на /login"""
+    with app.test_client() as client:
+        response = client.get('/stats', follow_redirects=False)
+        assert response.status_code == 302
+        assert response.location.endswith('/')
+
+
+@patch('app.app.get_db_connection')
+def test_review_trends_reads_rollups(mock_get_db):
+    """Динамика строится по сводкам рынка/субъекта, без обращения к reviews"""
+    from datetime import date
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_get_db.return_value = mock_conn
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_cursor.fetchall.return_value = [
+        {'period': date(2025, 1, 6), 'reviews': 4, 'avg_rating': 4.5, 'rolling_avg': 4.5},
+        {'period': date(2025, 1, 13), 'reviews': 2, 'avg_rating': 3.0, 'rolling_avg': 4.0}
+    ]
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess['authenticated'] = True
+
+        data = client.get('/stats/trends?market_id=5&bucket=week&window=14').get_json()
+        assert data['points'][1] == {'period': '2025-01-13', 'reviews': 2, 'avg_rating': 3.0, 'rolling_avg': 4.0}
+        sql, params = mock_cursor.execute.call_args[0]
+        assert 'FROM review_daily_market WHERE market_id = %s' in sql and 'reviews r' not in sql
+        assert params == ('week', 5, 365, 13)
+
+        client.get('/stats/trends?state=Москва&bucket=month')
+        sql, params = mock_cursor.execute.call_args[0]
+        assert 'FROM review_daily_state WHERE state = %s' in sql and params[:2] == ('month', 'Москва')
+
+        assert client.get('/stats/trends?bucket=year').status_code == 400
+
+
+@patch('app.app.get_db_connection')
+def test_stats_db_error(mock_get_db):
+    """Ошибка подключения к БД → flash и редирект на /login"""
+    mock_get_db.return_value = None
+
+    with patch.object(app_module, 'stats_cache', {'data': None, 'computed_at': 0.0}):
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess['authenticated'] = True
+
+            response = client.get('/stats')
+            assert response.status_code == 302
+            assert response.location.endswith('/')
+
+
+@patch('app.app.get_table_counts', return_value={
+    'farmers_markets': {'value': 150, 'mode': 'estimate'},
+    'products': {'value': 20, 'mode': 'exact'},
+    'payment_methods': {'value': 5, 'mode': 'exact'},
+    'social_networks': {'value': 3, 'mode': 'exact'}
+})
+@patch('app.app.get_db_connection')
+def test_stats_success(mock_get_db, mock_counts):
+    """Успешная загрузка статистики: один запрос, повторные просмотры — из снимка"""
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_get_db.return_value = mock_conn
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+
+    mock_cursor.fetchone.return_value = {
+        'total_reviews': 300,
+        'avg_rating': 4.25,
+        'rating_distribution': {'5': 180, '4': 60, '3': 30, '2': 15, '1': 15},
+        'top_markets': [
+            {'market_name': 'Центральный рынок', 'city': 'Москва', 'state': 'Москва', 'avg_rating': 4.8, 'review_count': 50},
+            {'market_name': 'Зелёный базар', 'city': 'СПб', 'state': 'СПб', 'avg_rating': 4.7, 'review_count': 45}
+        ],
+        'markets_by_state': [
+            {'state': 'Москва', 'count': 40},
+            {'state': 'СПб', 'count': 30}
+        ]
+    }
+
+    with patch.object(app_module, 'stats_cache', {'data': None, 'computed_at': 0.0}):
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess['authenticated'] = True
+
+            response = client.get('/stats')
+            html = response.get_data(as_text=True)
+            assert response.status_code == 200
+            assert 'Статистика' in html
+            assert '≈150' in html  # total_markets — оценка планировщика
+            assert '300' in html  # total_reviews
+            assert '4.25' in html  # avg_rating
+            assert 'Центральный рынок' in html
+            assert 'Москва' in html and '40' in html  # markets_by_state
+            assert '180' in html and '60%' in html  # распределение оценок
+            assert 'market_rating_stats' in mock_cursor.execute.call_args[0][0]
+
+            client.get('/stats')
+            assert mock_cursor.execute.call_count == 1
 
 def test_help_requires_auth():
     """Неавторизованный пользователь → редирект на /login"""